@@ -0,0 +1,3 @@
+from rp_alias.asgi import app
+
+# the same webhooks as `main.py`, natively on asyncio: `uvicorn asgi:app`.
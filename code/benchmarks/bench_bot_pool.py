@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-update latency of creating a fresh `Bot(api_key)` for every update versus using the :class:`BotPool`.
+Every simulated update does what a prefixed public post costs: one send and two deletes.
+
+Run from the `code` folder: ``python -m benchmarks.bench_bot_pool``
+"""
+import argparse
+import statistics
+from time import perf_counter
+
+from pytgbot import Bot
+
+from rp_alias.bot_pool import BotPool
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+API_KEYS = [f'{1000 + i}:stub-key-{i}' for i in range(5)]
+
+
+def run_update(rp_bot: Bot):
+    rp_bot.send_message(chat_id=1, text='hello', parse_mode='html')
+    rp_bot.delete_message(chat_id=1, message_id=1)
+    rp_bot.delete_message(chat_id=1, message_id=1)
+# end def
+
+
+def measure(get_bot, updates: int):
+    timings = []
+    for i in range(updates):
+        api_key = API_KEYS[i % len(API_KEYS)]
+        start = perf_counter()
+        run_update(get_bot(api_key))
+        timings.append(perf_counter() - start)
+    # end for
+    return timings
+# end def
+
+
+def report(label, timings, connections):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f'{label:>8}: mean {statistics.mean(timings) * 1000:7.2f} ms, '
+        f'p50 {statistics.median(timings) * 1000:7.2f} ms, p95 {p95 * 1000:7.2f} ms, '
+        f'{connections} connections'
+    )
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the stub server takes per call')
+    parser.add_argument('--handshake-delay', type=float, default=0.03, help='seconds a new connection costs, like a TLS handshake')
+    args = parser.parse_args()
+
+    server = StubBotApiServer(latency=args.latency, handshake_delay=args.handshake_delay)
+    server.start_background()
+    try:
+        timings = measure(lambda api_key: Bot(api_key, base_url=server.base_url), args.updates)
+        report('fresh', timings, server.connections)
+
+        server.connections = 0
+        pool = BotPool(base_url=server.base_url)
+        timings = measure(pool.get, args.updates)
+        report('pooled', timings, server.connections)
+    finally:
+        server.shutdown()
+    # end try
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end latency and throughput of the RP bot webhook, per kind of update,
+with every api call going to the local stub bot api server.
+
+The updates are posted to the flask app in-process (its test client), at the given concurrency,
+so it measures everything the webhook does, apart from the http server in front of it.
+Run from the `code` folder: ``python -m benchmarks.bench_e2e [--concurrency 8] [--latency 0.05] [--mongomock]``
+
+The usual environment variables apply (e.g. `EDIT_COALESCE_WINDOW`, `WEBHOOK_REPLY`),
+sensible defaults are set for the ones needed to start without a real deployment.
+Rate limiting is off unless `--rate-limit` is given, otherwise it would measure telegram's limits.
+"""
+import argparse
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from time import perf_counter, sleep
+
+from benchmarks.corpus import synthetic_update, OWNER_ID, BOT_ID, PREFIX
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+
+PATHS = ('private', 'owner_private', 'public', 'edit', 'delete', 'inline')
+RP_API_KEY = f'{BOT_ID}:AAHbenchmarkbenchmarkbenchmarkbenchmark'
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """ Nearest rank. """
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+# end def
+
+
+def set_up_app(server: StubBotApiServer, rate_limit: bool, mongomock: bool):
+    """
+    Points the app at the stub server, before it is imported, and registers the RP bot.
+    Returns the url and headers to post its updates with.
+    """
+    os.environ['TG_API_URL'] = server.base_url
+    os.environ.setdefault('TG_API_KEY', '1:AAHbenchmarkmainbotbenchmarkmainbot')
+    os.environ.setdefault('URL_PATH', '')
+    os.environ.setdefault('URL_HOSTNAME', 'localhost')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('RATE_LIMIT', 'true' if rate_limit else 'false')
+    for name in ('MONGO_HOST', 'MONGO_USER', 'MONGO_PASSWORD', 'MONGO_DB'):
+        os.environ.setdefault(name, 'localhost' if name == 'MONGO_HOST' else 'benchmark')
+    # end for
+    if mongomock:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    # end if
+
+    from rp_alias.main import registrations
+    from rp_alias.registry import Registration
+    from rp_alias.webhook_auth import SECRET_TOKEN_HEADER, new_secret_token
+
+    registration = Registration.new(owner_id=OWNER_ID, prefix=PREFIX, api_key=RP_API_KEY, secret_token=new_secret_token())
+    registrations.save(registration)
+    return f'/rp_bot/{registration.token}', {SECRET_TOKEN_HEADER: registration.secret_token}
+# end def
+
+
+def run_path(app, url, headers, updates, concurrency):
+    clients = local()
+
+    def post(update):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        # end if
+        start = perf_counter()
+        response = clients.client.post(url, json=update, headers=headers)
+        return perf_counter() - start, response.status_code
+    # end def
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, updates))
+    # end with
+    return perf_counter() - start, results
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=200, help='updates per path')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every api call takes')
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of api calls failing with a 400')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='fraction of api calls failing with a 429')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the rate limiting on')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongo (needs the mongomock package)')
+    args = parser.parse_args()
+
+    server = StubBotApiServer(
+        latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate, flood_rate=args.flood_rate,
+    )
+    server.start_background()
+    url, headers = set_up_app(server, rate_limit=args.rate_limit, mongomock=args.mongomock)
+
+    from rp_alias.main import app
+    from rp_alias.secrets import EDIT_COALESCE_WINDOW
+
+    rng = random.Random(4458)
+    update_id = 1000
+    print(f'{args.updates} updates per path, concurrency {args.concurrency}, api latency {args.latency * 1000:.0f}+{args.latency_jitter * 1000:.0f} ms')
+    print(f'{"path":>14} {"updates/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for path in args.paths:
+        updates = []
+        for _ in range(args.updates):
+            update_id += 2  # leaves room for the bot message replied to.
+            updates.append(synthetic_update(rng, update_id, path))
+        # end for
+        wall, results = run_path(app, url, headers, updates, args.concurrency)
+        latencies = sorted(latency for latency, _ in results)
+        errors = sum(1 for _, status in results if status != 200)
+        print(
+            f'{path:>14} {len(results) / wall:10.1f} {percentile(latencies, 0.50) * 1000:8.1f} '
+            f'{percentile(latencies, 0.95) * 1000:8.1f} {percentile(latencies, 0.99) * 1000:8.1f} {errors:7d}'
+        )
+    # end for
+    if 'edit' in args.paths:
+        # the edits themselves happen after the coalescing window.
+        sleep(EDIT_COALESCE_WINDOW + 0.5)
+    # end if
+    print(f'api calls: {dict(server.calls.most_common())}')
+    if server.failures:
+        print(f'injected failures: {dict(server.failures)}')
+    # end if
+    server.shutdown()
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The flask app (one update per worker, like the meinheld-gunicorn workers) against the asyncio one (`rp_alias.asgi`),
+under the same load: `--concurrency` webhook requests in flight all the time, every api call going to the
+local stub bot api server, which takes `--latency` seconds for each.
+
+Both get their requests in-process (flask's test client, and httpx's ASGI transport),
+so it measures the engines, not the http servers in front of them.
+Run from the `code` folder: ``python -m benchmarks.bench_engines [--concurrency 256] [--workers 8] [--mongomock]``
+"""
+import argparse
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, local
+from time import perf_counter
+
+from benchmarks.bench_e2e import percentile, set_up_app
+from benchmarks.corpus import synthetic_update
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+
+KINDS = ('public', 'public', 'public', 'chatter', 'chatter', 'reply', 'private', 'inline')
+
+
+def run_flask(url, headers, updates, concurrency: int, workers: int):
+    from rp_alias.main import app
+
+    clients = local()
+    busy_workers = BoundedSemaphore(workers)
+
+    def post(update):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        # end if
+        start = perf_counter()
+        with busy_workers:  # the others wait in the listen queue.
+            response = clients.client.post(url, json=update, headers=headers)
+        # end with
+        return perf_counter() - start, response.status_code
+    # end def
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(post, updates))
+    # end with
+    return perf_counter() - start, results
+# end def
+
+
+async def run_asgi(url, headers, updates, concurrency: int):
+    import httpx
+    from rp_alias.asgi import app
+
+    await app.startup()
+    in_flight = asyncio.Semaphore(concurrency)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+            async def post(update):
+                async with in_flight:
+                    start = perf_counter()
+                    response = await client.post(url, json=update, headers=headers)
+                    return perf_counter() - start, response.status_code
+                # end with
+            # end def
+
+            start = perf_counter()
+            results = await asyncio.gather(*(post(update) for update in updates))
+            return perf_counter() - start, results
+        # end with
+    finally:
+        await app.shutdown()
+    # end try
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=256, help='webhook requests in flight')
+    parser.add_argument('--workers', type=int, default=8, help='sync workers of the flask app')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every api call takes')
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongo (needs the mongomock package)')
+    args = parser.parse_args()
+
+    server = StubBotApiServer(latency=args.latency, latency_jitter=args.latency_jitter)
+    server.start_background()
+    url, headers = set_up_app(server, rate_limit=False, mongomock=args.mongomock)
+
+    rng = random.Random(4458)
+    updates = [synthetic_update(rng, update_id, rng.choice(KINDS)) for update_id in range(1000, 1000 + 2 * args.updates, 2)]
+    print(f'{args.updates} updates, {args.concurrency} in flight, api latency {args.latency * 1000:.0f}+{args.latency_jitter * 1000:.0f} ms')
+    print(f'{"engine":>16} {"updates/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for engine, (wall, results) in (
+        (f'flask ({args.workers} workers)', run_flask(url, headers, updates, args.concurrency, args.workers)),
+        ('asgi', asyncio.run(run_asgi(url, headers, updates, args.concurrency))),
+    ):
+        latencies = sorted(latency for latency, _ in results)
+        errors = sum(1 for _, status in results if status != 200)
+        print(
+            f'{engine:>16} {len(results) / wall:10.1f} {percentile(latencies, 0.50) * 1000:8.1f} '
+            f'{percentile(latencies, 0.95) * 1000:8.1f} {percentile(latencies, 0.99) * 1000:8.1f} {errors:7d}'
+        )
+    # end for
+    server.shutdown()
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Removing fake reply headers: the single pass parser versus the old regex, on regular posts and on adversarial ones
+(lots of spaces), where the regex backtracks in roughly cubic time.
+
+Run from the `code` folder: ``python -m benchmarks.bench_fake_reply [--sizes 250 500 1000]``
+"""
+import argparse
+from time import perf_counter
+
+from rp_alias.fake_reply import REGEX, remove_fake_reply, build_fake_reply, BAR, _render
+
+__author__ = 'luckydonald'
+
+
+def cases(size: int):
+    header = build_fake_reply(chat_id=-1001309571967, user_id=133378542, name='Littlepip', reply_id=4458, old_text='some old post')
+    return {
+        'header + post': header + 'The pony trots over to the bar. ' * (size // 32),
+        'post without header': 'The pony trots over to the bar. ' * (size // 32),
+        'bar, spaces': BAR + ' ' * size + 'x',
+        'bar, spaces, newline, spaces': BAR + ' ' * size + '\n' + ' ' * size + 'x',
+        'bars and spaces': (BAR + ' ') * (size // 2) + '\n',
+    }
+# end def
+
+
+def measure(fn, text, max_seconds=2.0):
+    """ Seconds per call, stopping early for slow ones. """
+    rounds = 0
+    start = perf_counter()
+    while True:
+        fn(text)
+        rounds += 1
+        elapsed = perf_counter() - start
+        if elapsed > max_seconds or rounds >= 1000:
+            return elapsed / rounds
+        # end if
+    # end while
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[250, 500, 1000], help='amount of spaces etc.')
+    parser.add_argument('--regex-max', type=int, default=1000, help='bigger sizes are skipped for the regex, it takes ages')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f'size {size}:')
+        for name, text in cases(size).items():
+            parser_time = measure(remove_fake_reply, text)
+            if size > args.regex_max:
+                print(f'  {name:30} parser {parser_time * 1e6:10.1f} µs, regex skipped')
+                continue
+            # end if
+            assert REGEX.sub('', text) == remove_fake_reply(text), name
+            regex_time = measure(lambda t: REGEX.sub('', t), text)
+            print(f'  {name:30} parser {parser_time * 1e6:10.1f} µs, regex {regex_time * 1e6:12.1f} µs ({regex_time / parser_time:.1f}x)')
+        # end for
+    # end for
+
+    _render.cache_clear()
+    start = perf_counter()
+    for i in range(10000):
+        build_fake_reply(chat_id=-1001309571967, user_id=133378542, name='Littlepip', reply_id=i % 20, old_text='some old post')
+    # end for
+    print(f'build_fake_reply, 20 distinct headers: {(perf_counter() - start) / 10000 * 1e6:.1f} µs per call, {_render.cache_info()}')
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Wall-clock time of a prefixed post (echo plus racing deletes by two bots), serial versus fanned out.
+
+Run from the `code` folder: ``python -m benchmarks.bench_fanout``
+"""
+import argparse
+import statistics
+
+from pytgbot.exceptions import TgApiServerException
+
+from rp_alias.bot_pool import BotPool
+from rp_alias.fanout import FanOut, CallTimer
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+
+def post(fan_out: FanOut, main_bot, rp_bot):
+    timer = CallTimer('bench_post')
+    echo = fan_out.submit(timer.timed(rp_bot.send_message), chat_id=1, text='hello', parse_mode='html')
+
+    def delete_with(delete_bot):
+        try:
+            delete_bot.delete_message(chat_id=1, message_id=1)
+            return True
+        except TgApiServerException:
+            return False
+        # end try
+    # end def
+    delete_with = timer.timed(delete_with)
+    fan_out.first_success(lambda: delete_with(main_bot), lambda: delete_with(rp_bot))
+    echo.result()
+    return timer.finish()
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stub server takes per call')
+    args = parser.parse_args()
+
+    server = StubBotApiServer(latency=args.latency)
+    server.start_background()
+    pool = BotPool(base_url=server.base_url)
+    main_bot, rp_bot = pool.get('1:main'), pool.get('2:rp')
+    try:
+        for label, fan_out in (('serial', FanOut(workers=0)), ('fan-out', FanOut(workers=8))):
+            results = [post(fan_out, main_bot, rp_bot) for _ in range(args.posts)]
+            wall = statistics.mean(r[0] for r in results)
+            serial = statistics.mean(r[1] for r in results)
+            print(f'{label:>8}: {wall * 1000:7.2f} ms wall-clock per post, calls added up {serial * 1000:7.2f} ms, saved {(serial - wall) * 1000:7.2f} ms')
+        # end for
+    finally:
+        server.shutdown()
+    # end try
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
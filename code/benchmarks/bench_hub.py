@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ingest cost of a group scene with `--bots` RP bots, each of another owner: every bot getting every message
+through its own webhook (json, prefilter, and parsing the ones left), against hub mode, where our bot gets each
+message once, parses the ones of owners, and looks the owner's prefix up in the :class:`rp_alias.hub.HubIndex`.
+Only the ingest is measured, the echo is the same in both.
+
+Run from the `code` folder: ``python -m benchmarks.bench_hub [--bots 15] [--count 2000]``
+"""
+import argparse
+import json
+import random
+from time import perf_counter
+
+from pytgbot.api_types.receivable.updates import Message, Update
+
+from rp_alias.hub import HubIndex
+from rp_alias.prefilter import prefilter
+from rp_alias.registry import Registration
+from benchmarks.corpus import synthetic_update
+
+__author__ = 'luckydonald'
+
+
+def per_bot(raw: bytes, registrations) -> int:
+    """ Every bot's webhook, returns how many parsed it. """
+    parsed = 0
+    for registration in registrations:
+        update_json = json.loads(raw)
+        if prefilter(update_json, admin_user_id=registration.owner_id, rp_bot_id=registration.bot_id, prefix=registration.prefix):
+            continue
+        # end if
+        Update.from_array(update_json)
+        parsed += 1
+    # end for
+    return parsed
+# end def
+
+
+def hub(raw: bytes, hub_index: HubIndex) -> int:
+    """ Our bot's webhook, like :func:`rp_alias.main.hub_ingest`. """
+    message = json.loads(raw)['message']
+    if not hub_index.owns(message['from']['id']):
+        return 0
+    # end if
+    msg = Message.from_array(message)
+    return 1 if hub_index.match(msg.from_peer.id, msg.text or msg.caption) else 0
+# end def
+
+
+def measure(fn, corpus, arg, rounds):
+    start = perf_counter()
+    for _ in range(rounds):
+        for raw in corpus:
+            fn(raw, arg)
+        # end for
+    # end for
+    return (perf_counter() - start) / (rounds * len(corpus))
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bots', type=int, default=15, help='RP bots in the group')
+    parser.add_argument('--count', type=int, default=2000, help='group messages')
+    parser.add_argument('--posts', type=float, default=0.5, help='share of the messages being prefixed posts')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    registrations = [
+        Registration.new(owner_id=10000 + i, prefix=f'c{i}:', api_key=f'{20000 + i}:AAHbenchmarkhubbenchmarkhubbenchmark')
+        for i in range(args.bots)
+    ]
+    hub_index = HubIndex()
+    for registration in registrations:
+        hub_index.update(None, registration)
+    # end for
+    rng = random.Random(4458)
+    corpus = []
+    for update_id in range(1, args.count + 1):
+        registration = rng.choice(registrations)
+        kind = 'public' if rng.random() < args.posts else 'chatter'
+        update = synthetic_update(
+            rng, update_id, kind, owner_id=registration.owner_id, bot_id=registration.bot_id, prefix=registration.prefix,
+        )
+        corpus.append(json.dumps(update).encode())
+    # end for
+
+    print(f'{args.count} group messages, {args.bots} RP bots, {args.posts:.0%} of them prefixed posts')
+    print(f'{"mode":>8} {"requests":>9} {"MB received":>12} {"parsed":>7} {"µs per message":>15}')
+    for mode, fn, arg, requests in (('per bot', per_bot, registrations, args.bots), ('hub', hub, hub_index, 1)):
+        parsed = sum(fn(raw, arg) for raw in corpus)
+        seconds = measure(fn, corpus, arg, args.rounds)
+        received = sum(len(raw) for raw in corpus) * requests
+        print(f'{mode:>8} {requests * len(corpus):9d} {received / 1e6:12.2f} {parsed:7d} {seconds * 1e6:15.1f}')
+    # end for
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput of long polling with 1, 2, 4, … processes (nodes), the bots split between them by consistent hashing,
+and each node spreading the chats over its partitions. Checks that the updates of every chat were handled in order.
+
+Every update costs one `sendMessage` to the stub bot api, which takes `--latency` seconds.
+Run from the `code` folder: ``python -m benchmarks.bench_partition [--nodes 1 2 4] [--partitions 4]``
+"""
+import argparse
+import multiprocessing
+import random
+from queue import Empty
+from time import perf_counter
+from typing import Dict
+
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+
+class MemoryOffsets(object):
+    """ Instead of the mongo backed :class:`rp_alias.polling.OffsetStore`, every node starts fresh anyway. """
+    def load(self, bot_id: int):
+        return None
+    # end def
+
+    def save(self, bot_id: int, offset: int):
+        pass
+    # end def
+# end class
+
+
+def run_node(index: int, nodes: int, bots: Dict[int, str], api_url: str, partitions: int, results, ready):
+    from rp_alias.bot_pool import BotPool
+    from rp_alias.partition import HashRing
+    from rp_alias.polling import LongPoller
+
+    ring = HashRing(range(nodes))
+    mine = {bot_id: api_key for bot_id, api_key in bots.items() if ring.owner(bot_id) == index}
+    bot_pool = BotPool(base_url=api_url)
+
+    def handler(bot_id: int, update: dict):
+        message = update['message']
+        bot_pool.get(mine[bot_id]).send_message(chat_id=message['chat']['id'], text=message['text'])
+        results.put((bot_id, message['chat']['id'], update['update_id']))
+    # end def
+
+    poller = LongPoller(
+        targets=lambda: mine, handler=handler, offsets=MemoryOffsets(), api_url=api_url,
+        workers=partitions, min_timeout=1, max_timeout=2, sync_interval=1.0,
+    )
+    ready.put(index)
+    poller.run()
+# end def
+
+
+def run(nodes: int, args) -> None:
+    server = StubBotApiServer(latency=args.latency)
+    server.start_background()
+    bots = {1000 + i: f'{1000 + i}:AAHpartitionpartitionpartitionpartition' for i in range(args.bots)}
+    context = multiprocessing.get_context('spawn')
+    results, ready = context.Queue(), context.Queue()
+    processes = [
+        context.Process(target=run_node, args=(index, nodes, bots, server.base_url, args.partitions, results, ready), daemon=True)
+        for index in range(nodes)
+    ]
+    for process in processes:
+        process.start()
+    # end for
+    for _ in processes:
+        ready.get(timeout=60)
+    # end for
+
+    rng = random.Random(4458)
+    update_ids = dict.fromkeys(bots, 0)
+    for _ in range(args.updates):
+        bot_id = rng.choice(list(bots))
+        update_ids[bot_id] += 1
+        chat_id = -1001000000000 - rng.randrange(args.chats)
+        server.queue_update(bots[bot_id], {'update_id': update_ids[bot_id], 'message': {
+            'message_id': update_ids[bot_id], 'date': 0, 'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'x'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'A'}, 'text': f'post {update_ids[bot_id]}',
+        }})
+    # end for
+
+    start = perf_counter()
+    last_seen: Dict[tuple, int] = {}
+    out_of_order = 0
+    handled = 0
+    try:
+        while handled < args.updates:
+            bot_id, chat_id, update_id = results.get(timeout=30)
+            handled += 1
+            if last_seen.get((bot_id, chat_id), 0) > update_id:
+                out_of_order += 1
+            # end if
+            last_seen[(bot_id, chat_id)] = update_id
+        # end while
+    except Empty:
+        print(f'  stopped waiting, only {handled} of {args.updates} updates were handled.')
+    # end try
+    duration = perf_counter() - start
+    print(f'{nodes:>5} {nodes * args.partitions:>10} {handled / duration:10.1f} {out_of_order:>12}')
+
+    for process in processes:
+        process.terminate()
+    # end for
+    server.shutdown()
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4], help='process counts to compare')
+    parser.add_argument('--partitions', type=int, default=4, help='partitions (handler threads) per node')
+    parser.add_argument('--bots', type=int, default=16)
+    parser.add_argument('--chats', type=int, default=8, help='chats per bot')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every api call takes')
+    args = parser.parse_args()
+
+    print(f'{args.updates} updates of {args.bots} bots in {args.chats} chats each, api latency {args.latency * 1000:.0f} ms')
+    print(f'{"nodes":>5} {"partitions":>10} {"updates/s":>10} {"out of order":>12}')
+    for nodes in args.nodes:
+        run(nodes, args)
+    # end for
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cost per update of deciding whether to drop it: the raw json prefilter versus building the `pytgbot` objects first.
+
+Run from the `code` folder: ``python -m benchmarks.bench_prefilter [--corpus updates.jsonl]``
+"""
+import argparse
+import json
+from collections import Counter
+from time import perf_counter
+
+from pytgbot.api_types.receivable.updates import Update
+
+from rp_alias.prefilter import prefilter
+from benchmarks.corpus import synthetic_corpus, load_corpus, OWNER_ID, BOT_ID, PREFIX
+
+__author__ = 'luckydonald'
+
+
+def full_parse(raw: bytes):
+    """ What the webhook did for every update before. """
+    update = Update.from_array(json.loads(raw))
+    if not update.message and not update.inline_query:
+        return 'drop'
+    # end if
+    if update.message and update.message.chat.type != 'private' and not update.message.text and not update.message.caption:
+        return 'drop'
+    # end if
+    return 'keep'
+# end def
+
+
+def prefiltered(raw: bytes):
+    return prefilter(json.loads(raw), admin_user_id=OWNER_ID, rp_bot_id=BOT_ID, prefix=PREFIX)
+# end def
+
+
+def measure(fn, corpus, rounds):
+    start = perf_counter()
+    for _ in range(rounds):
+        for raw in corpus:
+            fn(raw)
+        # end for
+    # end for
+    return (perf_counter() - start) / (rounds * len(corpus))
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--corpus', help='json updates, one per line (.gz works too). Default is a synthetic busy group.')
+    parser.add_argument('--count', type=int, default=2000, help='size of the synthetic corpus')
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    updates = list(load_corpus(args.corpus)) if args.corpus else synthetic_corpus(args.count)
+    corpus = [json.dumps(update).encode() for update in updates]
+    reasons = Counter(prefiltered(raw) for raw in corpus)
+    print(f'{len(corpus)} updates, {sum(v for k, v in reasons.items() if k) / len(corpus):.0%} dropped by the prefilter:')
+    for reason, count in reasons.most_common():
+        print(f'  {reason or "processed"}: {count}')
+    # end for
+
+    full = measure(full_parse, corpus, args.rounds)
+    fast = measure(prefiltered, corpus, args.rounds)
+    print(f'Update.from_array: {full * 1e6:8.1f} µs per update')
+    print(f'prefilter:         {fast * 1e6:8.1f} µs per update ({full / fast:.1f}x faster)')
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
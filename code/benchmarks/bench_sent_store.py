@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory of the :class:`rp_alias.sent.SentStore` per 10k echoed messages (measured with `tracemalloc`),
+against keeping the same as plain dicts, and the time of a lookup for `/edit`, from memory and from the disk spill.
+
+Run from the `code` folder: ``python -m benchmarks.bench_sent_store [--messages 100000] [--chats 200]``
+"""
+import argparse
+import os
+import random
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from rp_alias.fake_reply import build_fake_reply
+from rp_alias.sent import SentMessage, SentStore
+from benchmarks.corpus import WORDS, CHAT_ID
+
+__author__ = 'luckydonald'
+
+
+def messages(count: int, chats: int, seed: int = 4458):
+    """ (chat id, record), like the echoes of a busy group: a third with a fake reply. """
+    rng = random.Random(seed)
+    header = build_fake_reply(chat_id=CHAT_ID, user_id=1, name='Some Character', reply_id=1, old_text='what they said before')
+    for message_id in range(1, count + 1):
+        body = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+        yield CHAT_ID - rng.randrange(chats), SentMessage(message_id, header if rng.random() < 0.33 else '', body, 'text')
+    # end for
+# end def
+
+
+def measure_memory(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del kept
+    return size
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--per-chat', type=int, default=256)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+    corpus = list(messages(args.messages, args.chats))
+
+    def build_store():
+        store = SentStore(per_chat=args.per_chat, chats=args.chats)
+        for chat_id, record in messages(args.messages, args.chats):
+            store.add(chat_id, record)
+        # end for
+        return store
+    # end def
+
+    def build_dicts():
+        # the obvious alternative: a dict per chat of dicts, trimmed to the same size.
+        chats = {}
+        for chat_id, record in messages(args.messages, args.chats):
+            chat = chats.setdefault(chat_id, {})
+            chat[record.message_id] = {'message_id': record.message_id, 'header': record.header, 'body': record.body, 'kind': record.kind}
+            if len(chat) > args.per_chat:
+                del chat[next(iter(chat))]
+            # end if
+        # end for
+        return chats
+    # end def
+
+    store = build_store()
+    stored = len(store)
+    print(f'{args.messages} echoes in {args.chats} chats, {stored} kept in memory ({args.per_chat} per chat)')
+    for name, build in (('SentStore', build_store), ('dicts', build_dicts)):
+        print(f'{name:>10}: {measure_memory(build) / stored * 10000 / 1e6:6.2f} MB per 10k messages')
+    # end for
+
+    rng = random.Random(1)
+    kept = [(chat_id, record.message_id) for chat_id, record in corpus[-stored:]]
+    start = perf_counter()
+    for _ in range(args.lookups):
+        store.get(*rng.choice(kept))
+    # end for
+    print(f'lookup from memory: {(perf_counter() - start) / args.lookups * 1e6:6.2f} µs')
+
+    with tempfile.TemporaryDirectory() as folder:
+        spilling = SentStore(per_chat=args.per_chat, chats=args.chats, spill_path=os.path.join(folder, 'sent.sqlite'))
+        start = perf_counter()
+        for chat_id, record in corpus:
+            spilling.add(chat_id, record)
+        # end for
+        print(f'add with spill:     {(perf_counter() - start) / len(corpus) * 1e6:6.2f} µs')
+        spilled = [(chat_id, record.message_id) for chat_id, record in corpus[:len(corpus) - stored]]
+        if spilled:
+            lookups = min(args.lookups, 2000)
+            start = perf_counter()
+            found = sum(1 for _ in range(lookups) if spilling.get(*rng.choice(spilled)))
+            print(f'lookup from spill:  {(perf_counter() - start) / lookups * 1e6:6.2f} µs ({found} of {lookups} found)')
+        # end if
+    # end with
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+How long a fresh worker takes until it answers its first request, with and without `FAST_START`,
+every api call going to the local stub bot api server, which takes `--latency` seconds (telegram's round trip).
+Each run is a new interpreter, so it includes everything a recycled or newly scaled up gunicorn worker pays.
+
+Fails (exit code 1) if the median with `FAST_START` is over `--budget` seconds.
+`--report` adds the slowest imports of the app, from python's ``-X importtime``.
+Run from the `code` folder: ``python -m benchmarks.bench_startup [--runs 5] [--budget 0.5] [--mongomock] [--report]``
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+from time import time
+from typing import Dict, List, Tuple
+
+from benchmarks.stub_bot_api import StubBotApiServer
+
+__author__ = 'luckydonald'
+
+
+WORKER = '''
+import json, sys, time
+if sys.argv[1] == 'mongomock':
+    import mongomock, pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+# end if
+start = time.time()
+from rp_alias.main import app
+imported = time.time()
+status = app.test_client().get('/healthcheck').status_code
+print(json.dumps({'start': start, 'imported': imported, 'served': time.time(), 'status': status}))
+'''
+
+
+def start_worker(env: Dict[str, str], mongomock: bool, importtime: bool = False) -> Tuple[float, float, str]:
+    """ Returns the seconds until it answered, the seconds importing the app took, and what it logged. """
+    started = time()
+    process = subprocess.run(
+        [sys.executable, *(['-X', 'importtime'] if importtime else []), '-c', WORKER, 'mongomock' if mongomock else 'mongo'],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f'the worker failed:\n{process.stderr}')
+    # end if
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    return result['served'] - started, result['imported'] - result['start'], process.stderr
+# end def
+
+
+def slowest_imports(importtime_log: str, top: int) -> List[Tuple[int, str]]:
+    """ The modules imported by the app directly, by their cumulative microseconds. """
+    modules = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # end if
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    # end for
+    in_app = False
+    direct = []
+    for cumulative, name in reversed(modules):  # a module's line comes after the ones it imported.
+        if name.strip() == 'rp_alias.main':
+            in_app = True
+            depth = len(name) - len(name.lstrip())
+            continue
+        # end if
+        if in_app:
+            if len(name) - len(name.lstrip()) <= depth:
+                break
+            # end if
+            if len(name) - len(name.lstrip()) == depth + 2:
+                direct.append((cumulative, name.strip()))
+            # end if
+        # end if
+    # end for
+    return sorted(direct, reverse=True)[:top]
+# end def
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='workers started per mode')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds every api call takes')
+    parser.add_argument('--budget', type=float, default=0.5, help='seconds a worker may take with FAST_START')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongo (needs the mongomock package)')
+    parser.add_argument('--report', action='store_true', help='list the slowest imports')
+    parser.add_argument('--top', type=int, default=15, help='imports to list in the report')
+    args = parser.parse_args()
+
+    server = StubBotApiServer(latency=args.latency)
+    server.start_background()
+    env = dict(os.environ, PYTHONPATH=os.getcwd(), TG_API_URL=server.base_url)
+    env.setdefault('TG_API_KEY', '1:AAHbenchmarkmainbotbenchmarkmainbot')
+    env.setdefault('URL_PATH', '')
+    env.setdefault('URL_HOSTNAME', 'localhost')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    for name in ('MONGO_HOST', 'MONGO_USER', 'MONGO_PASSWORD', 'MONGO_DB'):
+        env.setdefault(name, 'localhost' if name == 'MONGO_HOST' else 'benchmark')
+    # end for
+
+    print(f'{args.runs} workers per mode, api latency {args.latency * 1000:.0f} ms, budget {args.budget * 1000:.0f} ms')
+    print(f'{"mode":>10} {"first request ms":>17} {"max ms":>8} {"import ms":>10} {"api calls":>10}')
+    medians = {}
+    for mode, fast_start in (('default', 'false'), ('fast_start', 'true')):
+        calls_before = sum(server.calls.values())
+        results = [start_worker(dict(env, FAST_START=fast_start), args.mongomock) for _ in range(args.runs)]
+        medians[mode] = median(served for served, _, _ in results)
+        print(
+            f'{mode:>10} {medians[mode] * 1000:17.0f} {max(served for served, _, _ in results) * 1000:8.0f} '
+            f'{median(imported for _, imported, _ in results) * 1000:10.0f} '
+            f'{(sum(server.calls.values()) - calls_before) / args.runs:10.1f}'
+        )
+    # end for
+
+    if args.report:
+        _, _, log = start_worker(dict(env, FAST_START='true'), args.mongomock, importtime=True)
+        print(f'\nslowest imports of rp_alias.main (cumulative ms):')
+        for cumulative, name in slowest_imports(log, args.top):
+            print(f'{cumulative / 1000:8.1f}  {name}')
+        # end for
+    # end if
+    server.shutdown()
+
+    if medians['fast_start'] > args.budget:
+        print(f'\nover budget: {medians["fast_start"] * 1000:.0f} ms > {args.budget * 1000:.0f} ms')
+        sys.exit(1)
+    # end if
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic telegram updates, shaped like the traffic a RP bot sees in a busy group.
+Recorded updates (one json update per line) can be loaded with :func:`load_corpus` instead.
+"""
+import gzip
+import json
+import random
+from typing import Dict, Iterator, List
+
+__author__ = 'luckydonald'
+
+
+OWNER_ID = 10717954
+BOT_ID = 133378542
+PREFIX = 'pip:'
+CHAT_ID = -1001309571967
+
+WORDS = 'the pony trots over to the bar and orders a drink while glancing at the stranger in the corner'.split()
+
+
+def _user(user_id: int, is_bot=False) -> Dict:
+    return {'id': user_id, 'is_bot': is_bot, 'first_name': f'User {user_id}'}
+# end def
+
+
+def _text(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+# end def
+
+
+def synthetic_update(rng: random.Random, update_id: int, kind: str, chat_id=CHAT_ID, owner_id=OWNER_ID, bot_id=BOT_ID, prefix=PREFIX) -> Dict:
+    """
+    :param kind: one of `chatter`, `reply`, `public`, `edit`, `delete`, `private`, `owner_private`, `inline`, `service`.
+    """
+    message = {
+        'message_id': update_id, 'date': 1600000000 + update_id,
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'RP Scene'},
+        'from': _user(owner_id),
+    }
+    bot_message = {
+        'message_id': max(1, update_id - 1), 'date': 1600000000, 'chat': message['chat'],
+        'from': _user(bot_id, is_bot=True), 'text': _text(rng),
+    }
+    if kind == 'chatter':
+        message['from'] = _user(rng.randint(1000, 9999))
+        message['text'] = _text(rng)
+    elif kind == 'reply':
+        message['from'] = _user(rng.randint(1000, 9999))
+        message['text'] = _text(rng)
+        message['reply_to_message'] = bot_message
+    elif kind == 'public':
+        message['text'] = f'{prefix} {_text(rng)}'
+    elif kind == 'edit':
+        message['text'] = f'/edit {_text(rng)}'
+        message['reply_to_message'] = bot_message
+    elif kind == 'delete':
+        message['text'] = '/delete'
+        message['reply_to_message'] = bot_message
+    elif kind in ('private', 'owner_private'):
+        user_id = owner_id if kind == 'owner_private' else rng.randint(1000, 9999)
+        message['chat'] = {'id': user_id, 'type': 'private', 'first_name': f'User {user_id}'}
+        message['from'] = _user(user_id)
+        message['text'] = _text(rng)
+    elif kind == 'inline':
+        return {'update_id': update_id, 'inline_query': {
+            'id': str(update_id), 'from': _user(owner_id), 'query': _text(rng), 'offset': '',
+        }}
+    elif kind == 'service':
+        message['from'] = _user(rng.randint(1000, 9999))
+        message['new_chat_members'] = [message['from']]
+    else:
+        raise ValueError(f'unknown kind {kind!r}')
+    # end if
+    return {'update_id': update_id, 'message': message}
+# end def
+
+
+# roughly what a group with a handful of players and one RP bot gets.
+BUSY_GROUP_MIX = {
+    'chatter': 70, 'service': 5, 'reply': 3, 'public': 15, 'edit': 3, 'delete': 1, 'private': 1, 'owner_private': 1, 'inline': 1,
+}
+
+
+def synthetic_corpus(count: int, mix: Dict[str, int] = None, seed: int = 4458, **kwargs) -> List[Dict]:
+    mix = mix or BUSY_GROUP_MIX
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix.keys()), weights=list(mix.values()), k=count)
+    return [synthetic_update(rng, i + 1, kind, **kwargs) for i, kind in enumerate(kinds)]
+# end def
+
+
+def load_corpus(path: str) -> Iterator[Dict]:
+    """ Reads json updates, one per line. Gzipped files (`.gz`) work as well. """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+            # end if
+        # end for
+    # end with
+# end def
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replays captured webhook traffic (see `CAPTURE_DIR`) against a running instance, and reports how it kept up.
+
+The updates are sent with their original spacing (`--speed 1`), N times faster (`--speed N`),
+or as fast as possible (`--speed max`). Updates of the same chat are always sent in their original order,
+one after another; different chats go in parallel on `--lanes` connections.
+The captured bots get fake api keys, so point the instance's `TG_API_URL` to the stub bot api
+(``python -m benchmarks.stub_bot_api``), which knows every bot by the id in front of its key.
+
+Run from the `code` folder: ``python -m benchmarks.replay http://localhost:8080 captures/*.jsonl.gz [--speed 10]``
+"""
+import argparse
+import threading
+from base64 import urlsafe_b64encode
+from collections import defaultdict
+from time import perf_counter, sleep
+from typing import Dict, List, Tuple
+
+import requests
+
+from benchmarks.corpus import load_corpus
+
+__author__ = 'luckydonald'
+
+
+def load_capture(path: str) -> List[dict]:
+    """ The file of a still running capture has no gzip end marker yet, everything up to there is fine. """
+    entries = []
+    try:
+        for entry in load_corpus(path):
+            entries.append(entry)
+        # end for
+    except (EOFError, ValueError):
+        pass  # cut off in the middle of the last line.
+    # end try
+    return entries
+# end def
+
+
+def chat_of(update: dict):
+    """ What has to stay in order: the chat of a message, or the user of an inline query. """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key].get('chat', {}).get('id')
+        # end if
+    # end for
+    if 'inline_query' in update:
+        return update['inline_query'].get('from', {}).get('id')
+    # end if
+    return None
+# end def
+
+
+def webhook_url(target: str, entry: dict) -> str:
+    """ Old style url, with everything in it, so the instance doesn't need the bot registered. """
+    api_key = f'{entry["bot"]}:AAHreplayreplayreplayreplayreplay'
+    prefix = urlsafe_b64encode(entry['prefix'].encode()).decode()
+    return f'{target.rstrip("/")}/rp_bot_webhooks/{entry["owner"]}/{prefix}/{urlsafe_b64encode(api_key.encode()).decode()}'
+# end def
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """ Nearest rank. """
+    if not sorted_values:
+        return 0.0
+    # end if
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+# end def
+
+
+class Lane(threading.Thread):
+    """ Sends its share of the chats, in order, each update not before its scheduled time. """
+    def __init__(self, target: str, entries: List[dict], start_at: float, first_arrival: float, speed: float):
+        super().__init__(daemon=True)
+        self.target = target
+        self.entries = entries
+        self.start_at = start_at
+        self.first_arrival = first_arrival
+        self.speed = speed
+        self.results: List[Tuple[float, float, int]] = []  # lag, latency, status (0 for connection errors)
+    # end def
+
+    def run(self):
+        session = requests.Session()
+        for entry in self.entries:
+            scheduled = self.start_at + (entry['t'] - self.first_arrival) / self.speed if self.speed else self.start_at
+            wait = scheduled - perf_counter()
+            if wait > 0:
+                sleep(wait)
+            # end if
+            sent = perf_counter()
+            try:
+                status = session.post(webhook_url(self.target, entry), json=entry['update'], timeout=60).status_code
+            except requests.RequestException:
+                status = 0
+            # end try
+            self.results.append((sent - scheduled, perf_counter() - sent, status))
+        # end for
+    # end def
+# end class
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('target', help='base url of the running instance, e.g. http://localhost:8080')
+    parser.add_argument('captures', nargs='+', help='capture files (.jsonl.gz)')
+    parser.add_argument('--speed', default='1', help='1 for real time, N for N times faster, max for no waiting at all')
+    parser.add_argument('--lanes', type=int, default=16, help='parallel connections, chats are spread over them')
+    args = parser.parse_args()
+
+    speed = 0.0 if args.speed == 'max' else float(args.speed)
+    entries = sorted((entry for path in args.captures for entry in load_capture(path)), key=lambda entry: entry['t'])
+    if not entries:
+        parser.error('no updates in the captures.')
+    # end if
+    lanes_entries: Dict[int, List[dict]] = defaultdict(list)
+    for entry in entries:
+        lanes_entries[hash((entry['bot'], chat_of(entry['update']))) % args.lanes].append(entry)
+    # end for
+    captured_duration = entries[-1]['t'] - entries[0]['t']
+    print(f'{len(entries)} updates of {len({e["bot"] for e in entries})} bots, captured over {captured_duration:.1f} s, speed {args.speed}')
+
+    start_at = perf_counter() + 0.5
+    lanes = [Lane(args.target, lane_entries, start_at, entries[0]['t'], speed) for lane_entries in lanes_entries.values()]
+    for lane in lanes:
+        lane.start()
+    # end for
+    for lane in lanes:
+        lane.join()
+    # end for
+    duration = perf_counter() - start_at
+
+    results = [result for lane in lanes for result in lane.results]
+    lags = sorted(max(0.0, lag) for lag, _, _ in results)
+    latencies = sorted(latency for _, latency, _ in results)
+    errors = sum(1 for _, _, status in results if status != 200)
+    statuses = defaultdict(int)
+    for _, _, status in results:
+        statuses[status] += 1
+    # end for
+    print(f'replayed in {duration:.1f} s: {len(results) / duration:.1f} updates/s (captured {len(entries) / max(captured_duration, 1e-9):.1f}/s)')
+    print(f'errors: {errors} ({errors / len(results):.1%}), statuses {dict(statuses)}')
+    print(f'latency ms: p50 {percentile(latencies, 0.5) * 1000:.1f}, p95 {percentile(latencies, 0.95) * 1000:.1f}, p99 {percentile(latencies, 0.99) * 1000:.1f}')
+    if speed:
+        # lag: how much later than scheduled an update went out, because its chat was still waiting on the server.
+        print(
+            f'lag ms: p50 {percentile(lags, 0.5) * 1000:.1f}, p95 {percentile(lags, 0.95) * 1000:.1f}, '
+            f'p99 {percentile(lags, 0.99) * 1000:.1f}, max {lags[-1] * 1000:.1f}; '
+            f'{sum(1 for lag in lags if lag > 0.1)} updates queued for more than 100 ms'
+        )
+    # end if
+# end def
+
+
+if __name__ == '__main__':
+    main()
+# end if
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the telegram bot api, implementing the methods this bot uses with plausible results:
+messages get increasing ids per chat and carry the text or caption sent, the bot's identity comes from its api key.
+Latency and errors (including 429 flood waits) can be injected, and every call is counted.
+`getUpdates` long polls for updates put in with :meth:`StubBotApiServer.queue_update`.
+
+Point a bot's `base_url` (or the `TG_API_URL` environment variable) to ``http://127.0.0.1:{port}/bot{api_key}/{command}``.
+"""
+import json
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from typing import Dict, List, Set, Tuple, Union
+from urllib.parse import parse_qsl
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+SEND_MEDIA_METHODS = {
+    'sendPhoto': 'photo', 'sendSticker': 'sticker', 'sendAnimation': 'animation', 'sendVideo': 'video',
+    'sendVideoNote': 'video_note', 'sendVoice': 'voice', 'sendDocument': 'document', 'sendAudio': 'audio',
+}
+TRUE_METHODS = {'setWebhook', 'deleteWebhook', 'deleteMessage', 'deleteMessages', 'answerInlineQuery'}
+# where errors get injected, we don't want the setup calls to fail.
+FAILING_PREFIXES = ('send', 'forward', 'copy', 'edit', 'delete', 'answer')
+
+
+class StubBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+    wbufsize = -1  # send header and body in one go, flushed after every request.
+    server: 'StubBotApiServer'
+
+    def setup(self):
+        super().setup()
+        # emulates the extra round trips of a TLS handshake, which only a new connection has to pay.
+        self.server.count_connection()
+        if self.server.handshake_delay:
+            sleep(self.server.handshake_delay)
+        # end if
+    # end def
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        path, _, query = self.path.partition('?')
+        bot_part, command = path.rsplit('/', 2)[-2:]
+        params = dict(parse_qsl(query))
+        content_type = self.headers.get('Content-Type') or ''
+        if content_type.startswith('application/json'):
+            params.update(json.loads(raw or b'{}'))
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(raw.decode()))
+        # end if
+        status, answer = self.server.answer(bot_part[len('bot'):], command, params)
+        body = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    # end def
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass  # way too noisy for benchmarks.
+    # end def
+# end class
+
+
+class StubBotApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 drops connections under load, they'd retry a second later.
+
+    def __init__(
+        self, host='127.0.0.1', port=0, latency=0.0, handshake_delay=0.0, latency_jitter=0.0,
+        error_rate=0.0, flood_rate=0.0, retry_after=1, seed=4458, deleters: Union[Set[int], None] = None,
+        outsiders: Union[Set[Tuple[int, int]], None] = None,
+    ):
+        """
+        :param latency: seconds every request takes.
+        :param handshake_delay: extra seconds every new connection takes.
+        :param latency_jitter: up to that many seconds are added to the latency, randomly.
+        :param error_rate: fraction of sending/editing/deleting calls failing with a 400.
+        :param flood_rate: fraction of sending/editing/deleting calls failing with a 429.
+        :param retry_after: seconds the 429s tell to wait.
+        :param deleters: ids of the bots which may delete messages (admins), `None` for all of them.
+        :param outsiders: `(chat id, bot id)` of the bots not in a chat, for `getChatMember`. All others are.
+        """
+        super().__init__((host, port), StubBotApiHandler)
+        self.latency = latency
+        self.handshake_delay = handshake_delay
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.deleters = deleters
+        self.outsiders = outsiders or set()
+        self.connections = 0
+        self.calls = Counter()  # method -> count
+        self.failures = Counter()  # (method, error_code) -> count
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_ids: Dict[Tuple[str, str], int] = {}
+        self._updates: Dict[str, List[dict]] = {}
+        self._updates_changed = threading.Condition(self._lock)
+    # end def
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/bot{{api_key}}/{{command}}'
+    # end def
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+        # end with
+    # end def
+
+    def answer(self, api_key: str, command: str, params: dict) -> Tuple[int, dict]:
+        """ :return: http status and json body. """
+        with self._lock:
+            self.calls[command] += 1
+            delay = self.latency + (self._random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+            roll = self._random.random() if command.startswith(FAILING_PREFIXES) else 1.0
+        # end with
+        if delay:
+            sleep(delay)
+        # end if
+        if roll < self.flood_rate:
+            return self._error(command, 429, f'Too Many Requests: retry after {self.retry_after}', {'retry_after': self.retry_after})
+        # end if
+        if roll < self.flood_rate + self.error_rate:
+            return self._error(command, 400, 'Bad Request: injected error')
+        # end if
+        if command in ('deleteMessage', 'deleteMessages') and self.deleters is not None and self.bot_user(api_key)['id'] not in self.deleters:
+            return self._error(command, 400, "Bad Request: message can't be deleted")
+        # end if
+        if command == 'getUpdates':
+            result = self.get_updates(api_key, int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        else:
+            result = self.result_for(command, api_key, params)
+        # end if
+        if result is None:
+            return self._error(command, 404, 'Not Found: method not found')
+        # end if
+        return 200, {'ok': True, 'result': result}
+    # end def
+
+    def _error(self, command: str, error_code: int, description: str, parameters: Union[dict, None] = None) -> Tuple[int, dict]:
+        with self._lock:
+            self.failures[(command, error_code)] += 1
+        # end with
+        answer = {'ok': False, 'error_code': error_code, 'description': description}
+        if parameters:
+            answer['parameters'] = parameters
+        # end if
+        return error_code, answer
+    # end def
+
+    def queue_update(self, api_key: str, update: dict):
+        """ Makes `getUpdates` of that bot return the update. """
+        with self._updates_changed:
+            self._updates.setdefault(api_key, []).append(update)
+            self._updates_changed.notify_all()
+        # end with
+    # end def
+
+    def get_updates(self, api_key: str, offset: int, timeout: float) -> List[dict]:
+        """ Like telegram, confirms everything below `offset` and waits up to `timeout` seconds for new updates. """
+        deadline = monotonic() + timeout
+        with self._updates_changed:
+            while True:
+                updates = self._updates[api_key] = [u for u in self._updates.get(api_key, []) if u['update_id'] >= offset]
+                remaining = deadline - monotonic()
+                if updates or remaining <= 0:
+                    return updates
+                # end if
+                self._updates_changed.wait(remaining)
+            # end while
+        # end with
+    # end def
+
+    @staticmethod
+    def bot_user(api_key: str) -> dict:
+        bot_id = api_key.split(':', 1)[0]
+        bot_id = int(bot_id) if bot_id.isdigit() else 123456
+        return {'id': bot_id, 'is_bot': True, 'first_name': f'Stub {bot_id}', 'username': f'stub{bot_id}_bot'}
+    # end def
+
+    def result_for(self, command: str, api_key: str = '123456:stub', params: Union[dict, None] = None):
+        """ The result of a successful call, `None` for unknown methods. """
+        params = params or {}
+        if command == 'getMe':
+            return self.bot_user(api_key)
+        # end if
+        if command == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        # end if
+        if command in TRUE_METHODS:
+            return True
+        # end if
+        if command == 'getChatMember':
+            chat_id, user_id = int(params.get('chat_id')), int(params.get('user_id'))
+            status = 'left' if (chat_id, user_id) in self.outsiders else 'member'
+            return {'user': {'id': user_id, 'is_bot': True, 'first_name': f'Stub {user_id}'}, 'status': status}
+        # end if
+        if command == 'sendMessage' or command == 'forwardMessage':
+            return self.message(api_key, params, text=params.get('text', ''))
+        # end if
+        if command in SEND_MEDIA_METHODS:
+            return self.message(api_key, params, caption=params.get('caption'))
+        # end if
+        if command == 'sendMediaGroup':
+            media = params.get('media') or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            # end if
+            return [self.message(api_key, params, caption=item.get('caption')) for item in media]
+        # end if
+        if command == 'editMessageText':
+            return self.message(api_key, params, text=params.get('text', ''), message_id=params.get('message_id'))
+        # end if
+        if command == 'editMessageCaption':
+            return self.message(api_key, params, caption=params.get('caption'), message_id=params.get('message_id'))
+        # end if
+        return None
+    # end def
+
+    def message(self, api_key: str, params: dict, message_id=None, **content) -> dict:
+        chat_id = str(params.get('chat_id', 1))
+        if message_id is None:
+            with self._lock:
+                message_id = self._message_ids[(api_key, chat_id)] = self._message_ids.get((api_key, chat_id), 0) + 1
+            # end with
+        # end if
+        chat_number = int(chat_id) if chat_id.lstrip('-').isdigit() else -1000000000001
+        if chat_number > 0:
+            chat = {'id': chat_number, 'type': 'private', 'first_name': f'User {chat_number}'}
+        else:
+            chat = {'id': chat_number, 'type': 'supergroup', 'title': f'Group {chat_number}'}
+        # end if
+        message = {'message_id': int(message_id), 'date': int(time()), 'chat': chat, 'from': self.bot_user(api_key)}
+        message.update({key: value for key, value in content.items() if value is not None})
+        return message
+    # end def
+
+    def start_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name='stub-bot-api', daemon=True)
+        thread.start()
+        return thread
+    # end def
+# end class
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request takes')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='up to that many seconds are added randomly')
+    parser.add_argument('--handshake-delay', type=float, default=0.0, help='extra seconds every new connection takes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls failing with a 400')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='fraction of calls failing with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds the 429s tell to wait')
+    args = parser.parse_args()
+    server = StubBotApiServer(
+        port=args.port, latency=args.latency, handshake_delay=args.handshake_delay, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, flood_rate=args.flood_rate, retry_after=args.retry_after,
+    )
+    logger.info(f'listening, use TG_API_URL={server.base_url}')
+    server.serve_forever()
+# end if
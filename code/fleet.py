@@ -0,0 +1,56 @@
+import argparse
+import sys
+
+__author__ = 'luckydonald'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Does something for every registered RP bot, configured like the app (environment variables).')
+    parser.add_argument('--concurrency', type=int, default=None, help='bots at the same time (FLEET_CONCURRENCY)')
+    parser.add_argument('--per-second', type=float, default=None, help='api calls per second at most (FLEET_PER_SECOND)')
+    subparsers = parser.add_subparsers(dest='operation')
+    webhooks = subparsers.add_parser('webhooks', help='set the webhooks again, e.g. after HOSTNAME changed. Continues an interrupted run.')
+    webhooks.add_argument('--restart', action='store_true', help='do all bots again, not only the ones an earlier run missed')
+    info = subparsers.add_parser('info', help='pending updates and last errors of the webhooks')
+    info.add_argument('--problems-only', action='store_true', help='only list the bots with pending updates, errors or another url')
+    args = parser.parse_args()
+    if not args.operation:
+        parser.error('which operation?')
+    # end if
+
+    from rp_alias import main as app  # after parsing, `--help` shouldn't need the whole configuration.
+    from rp_alias.fleet import Fleet
+    app.registrations.loaded.wait()
+    if args.concurrency or args.per_second:
+        app.fleet = Fleet(concurrency=args.concurrency or app.FLEET_CONCURRENCY, per_second=args.per_second or app.FLEET_PER_SECOND)
+    # end if
+
+    if args.operation == 'webhooks':
+        report = app.set_all_webhooks(restart=args.restart)
+        for result in report.results:
+            print(f'{result.bot_id:>12}  ' + (result.result['url'] if result.ok else f'failed: {result.error}'))
+        # end for
+    else:
+        report = app.check_all_webhooks()
+        print(f'{"bot":>12} {"pending":>8}  {"url":<7} last error')
+        for result in report.results:
+            if not result.ok:
+                print(f'{result.bot_id:>12}  failed: {result.error}')
+                continue
+            # end if
+            webhook = result.result
+            if args.problems_only and webhook['current'] and not webhook['pending_update_count'] and not webhook['last_error_message']:
+                continue
+            # end if
+            print(f'{result.bot_id:>12} {webhook["pending_update_count"]:8d}  {"ok" if webhook["current"] else "other":<7} {webhook["last_error_message"] or ""}')
+        # end for
+    # end if
+    print(report.summary())
+    sys.exit(1 if report.failed else 0)
+# end def
+
+
+if __name__ == "__main__":
+    # e.g. `FAST_START=true python fleet.py webhooks`, with the same environment variables as the app.
+    main()
+# end if
@@ -0,0 +1,6 @@
+from rp_alias.main import run_polling
+
+if __name__ == "__main__":
+    # long polling instead of webhooks, set UPDATE_MODE=polling.
+    run_polling()
+# end if
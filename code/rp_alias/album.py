@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Message as TGMessage
+from pytgbot.api_types.sendable.input_media import InputMedia, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# what happened to a buffered album.
+ALBUM_ECHOED = 'echoed'
+ALBUM_ONE_BY_ONE = 'one_by_one'
+ALBUM_NO_PREFIX = 'no_prefix'
+
+album_items = counter('album_items_total', 'Messages of albums buffered')
+albums_flushed = counter('albums_flushed_total', 'Buffered albums, by what happened to them', ('result',))
+
+
+class Album(object):
+    """ The messages of one album (`media_group_id`) seen so far. """
+    __slots__ = ('key', 'messages', 'ticket')
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.messages: List[TGMessage] = []
+        self.ticket: Any = None  # what `start(album)` of the buffer returned.
+    # end def
+
+    def sorted_messages(self) -> List[TGMessage]:
+        """ In the order they were posted, not the order the updates arrived. """
+        return sorted(self.messages, key=lambda msg: msg.message_id)
+    # end def
+# end class
+
+
+class AlbumBuffer(object):
+    """
+    Telegram sends every item of an album as its own update, only one of them carrying the caption.
+    This collects the items of the same album for `window` seconds after the first one arrived,
+    and then hands them over together.
+
+    `start(album)` is called when the first item of an album arrives, e.g. to reserve its place in line,
+    and what it returns is kept as `album.ticket`.
+    `flush(album)` is called once per album, in the single thread of the buffer, so it should be quick.
+    Items arriving after that start a new album with the same key.
+    """
+    def __init__(self, window: float, flush: Callable[[Album], None], start: Union[Callable[[Album], Any], None] = None):
+        self.window = window
+        self.flush = flush
+        self.start = start
+        self._albums: Dict[Hashable, Album] = {}
+        self._deadlines: List[Tuple[float, int, Hashable]] = []  # heap of (flush at, tie breaker, key).
+        self._order = count()
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._thread = None
+    # end def
+
+    def add(self, key: Hashable, msg: TGMessage):
+        """
+        :param key: which album it is, e.g. `(bot_id, chat_id, media_group_id)`.
+        """
+        album_items.inc()
+        with self._lock:
+            album = self._albums.get(key)
+            if album is None:
+                album = self._albums[key] = Album(key)
+                if self.start:
+                    album.ticket = self.start(album)
+                # end if
+                heappush(self._deadlines, (monotonic() + self.window, next(self._order), key))
+                if self._thread is None:
+                    self._thread = Thread(target=self._flush_forever, name='album-buffer', daemon=True)
+                    self._thread.start()
+                # end if
+                self._changed.notify()
+            # end if
+            album.messages.append(msg)
+        # end with
+    # end def
+
+    def _flush_forever(self):
+        while True:
+            with self._lock:
+                while not self._deadlines or self._deadlines[0][0] > monotonic():
+                    self._changed.wait(self._deadlines[0][0] - monotonic() if self._deadlines else None)
+                # end while
+                _, _, key = heappop(self._deadlines)
+                album = self._albums.pop(key)
+            # end with
+            try:
+                self.flush(album)
+            except Exception:
+                logger.exception('flushing the album failed.')
+            # end try
+        # end while
+    # end def
+# end class
+
+
+def input_media(msg: TGMessage, html_caption: Union[str, None] = None) -> Union[InputMedia, None]:
+    """ The album item to send the same media again. `None` for what can't be part of an album. """
+    caption = dict(caption=html_caption, parse_mode='html') if html_caption else {}
+    if msg.photo:
+        return InputMediaPhoto(media=msg.photo[-1].file_id, **caption)  # the biggest size.
+    # end if
+    if msg.video:
+        return InputMediaVideo(media=msg.video.file_id, **caption)
+    # end if
+    if msg.document:
+        return InputMediaDocument(media=msg.document.file_id, **caption)
+    # end if
+    if msg.audio:
+        return InputMediaAudio(media=msg.audio.file_id, **caption)
+    # end if
+    return None
+# end def
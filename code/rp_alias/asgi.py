@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+The webhooks served natively on asyncio, as ASGI app (e.g. ``uvicorn asgi:app``), next to the flask one in `main`.
+
+Requests are read and answered on the event loop, and the cheap parts (checking them, dropping group chatter,
+capturing) happen right there. What is left runs the very same handlers as the flask app, in a pool of threads,
+but every bot api call they do goes over one shared async client on the event loop (:class:`AsyncTransport`).
+So a thread waiting for telegram is parked instead of holding a worker process, and a single process
+keeps thousands of updates in flight.
+"""
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+
+from . import main
+from .bot_pool import AsyncTransport
+from .webhook_auth import MAX_UPDATE_BYTES, REJECT_TOO_LARGE, reject
+from .webhook_reply import WebhookReply
+from .secrets import ASGI_THREADS, ASGI_CONNECTIONS, WEBHOOK_REPLY
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+class Headers(dict):
+    """ The request headers, looked up case insensitive like flask's. """
+    def __init__(self, raw_headers: List[Tuple[bytes, bytes]]):
+        super().__init__((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in raw_headers)
+    # end def
+
+    def get(self, name: str, default=None):
+        return super().get(name.lower(), default)
+    # end def
+# end class
+
+
+class WebhookEngine(object):
+    """ A plain ASGI app, without any framework: the few routes we have don't need one. """
+    def __init__(self, threads: int = 512, connections: int = 256):
+        self.threads = threads
+        self.transport = AsyncTransport(connections=connections)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-handler')
+        self._routes: List[Tuple[str, re.Pattern, Callable]] = [
+            ('GET', re.compile(r'\A/\Z'), self.hello),
+            ('GET', re.compile(r'\A/healthcheck\Z'), self.healthcheck),
+            ('GET', re.compile(r'\A/metrics\Z'), self.metrics),
+            ('GET', re.compile(r'\A/spool\Z'), self.spool),
+            ('POST', re.compile(r'\A/rp_bot/(?P<token>[^/]+)\Z'), self.rp_bot_webhook),
+            (
+                'POST', re.compile(r'\A/rp_bot_webhooks/(?P<admin_user_id>\d+)/(?P<base64_prefix>[^/]+)/(?P<base64_api_key>[^/]+)\Z'),
+                self.rp_bot_webhooks,
+            ),
+        ]
+        for rule in main.app.url_map.iter_rules():
+            if rule.endpoint == 'webhook':
+                # our own bot, the commands are handled by teleflask.
+                self._routes.append(('POST', re.compile(r'\A' + re.escape(rule.rule) + r'\Z'), self.main_bot_webhook))
+            # end if
+        # end for
+    # end def
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        # end if
+        if scope['type'] != 'http':
+            return
+        # end if
+        allowed = False
+        for method, pattern, view in self._routes:
+            match = pattern.match(scope['path'])
+            if not match:
+                continue
+            # end if
+            allowed = True
+            if method != scope['method']:
+                continue
+            # end if
+            try:
+                response = await view(scope, receive, **match.groupdict())
+            except Exception:
+                logger.exception(f'handling {scope["method"]} {scope["path"]} failed.')
+                response = 500, 'Internal Server Error'
+            # end try
+            await self.respond(send, *response)
+            return
+        # end for
+        await self.respond(send, 405 if allowed else 404, 'Method Not Allowed' if allowed else 'Not Found')
+    # end def
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+            # end if
+        # end while
+    # end def
+
+    async def startup(self):
+        """ From now on, every bot api call goes over our event loop. """
+        await self.transport.start()
+        main.bot_pool.set_transport(self.transport)
+        main.bot.bot.transport = self.transport  # it stays around even if the pool drops it.
+        if main.fan_out.enabled and main.fan_out.workers < self.threads:
+            # waiting calls are cheap now, the handlers shouldn't queue up for a few fan-out threads.
+            main.fan_out.resize(self.threads)
+        # end if
+    # end def
+
+    async def shutdown(self):
+        main.bot_pool.set_transport(None)
+        main.bot.bot.transport = None
+        # handlers still running finish their calls first.
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        await self.transport.close()
+    # end def
+
+    async def in_thread(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    # end def
+
+    @staticmethod
+    async def respond(send, status: int, body: Union[str, bytes, dict, WebhookReply], content_type: str = 'text/html; charset=utf-8'):
+        if isinstance(body, WebhookReply):
+            body = body.to_array()
+        # end if
+        if isinstance(body, dict):
+            body, content_type = json.dumps(body), 'application/json'
+        # end if
+        if isinstance(body, str):
+            body = body.encode()
+        # end if
+        await send({
+            'type': 'http.response.start', 'status': status,
+            'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+    # end def
+
+    @staticmethod
+    async def read_json(receive) -> Union[dict, None]:
+        """ The request body, `None` if it is bigger than any update could be. """
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_UPDATE_BYTES:
+                return None
+            # end if
+            if not message.get('more_body'):
+                return json.loads(body)
+            # end if
+        # end while
+    # end def
+
+    async def hello(self, scope, receive):
+        return 200, main.hello()
+    # end def
+
+    async def healthcheck(self, scope, receive):
+        body, status = main.url_healthcheck()
+        return status, body
+    # end def
+
+    async def metrics(self, scope, receive):
+        body, status, headers = main.url_metrics()
+        return status, body, headers['Content-Type']
+    # end def
+
+    async def spool(self, scope, receive):
+        body, status = main.url_spool()
+        return status, body
+    # end def
+
+    async def rp_bot_webhook(self, scope, receive, token: str):
+        headers = Headers(scope['headers'])
+        if main.registrations.loaded.is_set():
+            registration, reason = main.token_webhook_registration(token, headers, self.content_length(headers))
+        else:
+            # still loading (`FAST_START`), the lookup may have to wait for it.
+            registration, reason = await self.in_thread(main.token_webhook_registration, token, headers, self.content_length(headers))
+        # end if
+        if reason:
+            return self.reject(reason)
+        # end if
+        return await self.handle_webhook(registration, headers, receive)
+    # end def
+
+    async def rp_bot_webhooks(self, scope, receive, admin_user_id: str, base64_prefix: str, base64_api_key: str):
+        headers = Headers(scope['headers'])
+        # unknown bots have to be checked with telegram.
+        registration, reason = await self.in_thread(
+            main.legacy_webhook_registration, int(admin_user_id), base64_prefix, base64_api_key, headers, self.content_length(headers),
+        )
+        if reason:
+            return self.reject(reason)
+        # end if
+        return await self.handle_webhook(registration, headers, receive)
+    # end def
+
+    async def handle_webhook(self, registration, headers: Headers, receive):
+        update_json = await self.read_json(receive)
+        if update_json is None:
+            return self.reject(REJECT_TOO_LARGE)
+        # end if
+        return 200, await self.in_thread(self.process, registration, update_json, headers)
+    # end def
+
+    @staticmethod
+    def process(registration, update_json: dict, headers: Headers) -> Union[str, WebhookReply]:
+        """ All the sync handling, in the thread pool. Even the capture and debug log, to keep them off the event loop. """
+        main.receive_webhook_update(registration, update_json, headers)
+        if main.drop_update(registration, update_json):
+            return 'OK'
+        # end if
+        return main.webhook_response(main.accept_update(registration, update_json, allow_webhook_reply=WEBHOOK_REPLY))
+    # end def
+
+    async def main_bot_webhook(self, scope, receive):
+        update_json = await self.read_json(receive)
+        if update_json is None:
+            return self.reject(REJECT_TOO_LARGE)
+        # end if
+        return 200, await self.in_thread(self.process_main_bot, update_json)
+    # end def
+
+    @staticmethod
+    def process_main_bot(update_json: dict) -> dict:
+        """ Like teleflask's own webhook view. """
+        if main.main_bot_ingest(update_json):
+            return {"status": "ok"}
+        # end if
+        try:
+            result = main.bot.process_update(Update.from_array(update_json))
+        except Exception as e:
+            logger.exception("process_update()")
+            result = {"status": "error", "message": str(e)}
+        # end try
+        return result if result else {"status": "probably ok"}
+    # end def
+
+    @staticmethod
+    def content_length(headers: Headers) -> Union[int, None]:
+        value = headers.get('content-length')
+        return int(value) if value and value.isdigit() else None
+    # end def
+
+    @staticmethod
+    def reject(reason: str) -> Tuple[int, str]:
+        body, status = reject(reason)
+        return status, body
+    # end def
+# end class
+
+
+app = WebhookEngine(threads=ASGI_THREADS, connections=ASGI_CONNECTIONS)
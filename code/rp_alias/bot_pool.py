@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import OrderedDict
+from itertools import count
+from threading import RLock
+from time import monotonic, perf_counter
+from typing import Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from luckydonaldUtils.logger import logging
+from pytgbot import Bot
+from pytgbot.bot.base import DEFAULT_BASE_URL
+from pytgbot.exceptions import TgApiServerException
+
+from .ratelimit import RateLimiter
+from .stats import counter, histogram
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# result label of the api calls, besides telegram's error codes.
+RESULT_OK = 'ok'
+RESULT_NETWORK = 'network_error'
+
+# httpx' connection pool looks at every connection for every queued request, which gets slow with many of them.
+# So the async transport spreads its connections over several small clients instead.
+CONNECTIONS_PER_CLIENT = 4
+
+api_calls = counter('bot_api_calls_total', 'Requests to the bot api, by method and result (ok, the error code, or network_error)', ('method', 'result'))
+api_call_seconds = histogram('bot_api_call_seconds', 'Duration of requests to the bot api, rate limit waits not included', ('method',))
+
+
+class AsyncTransport(object):
+    """
+    Does the bot api requests on an asyncio event loop, all of them sharing a few `httpx.AsyncClient`s
+    with up to `connections` connections. A request waiting for telegram then costs a coroutine, not a worker.
+
+    The synchronous code calling the bots keeps running in threads,
+    which just wait for the loop to get the answer (:meth:`post_blocking`).
+    """
+    def __init__(self, connections: int = 256, timeout: float = 30.0):
+        self.connections = connections
+        self.timeout = timeout
+        self._loop = None
+        self._clients = []
+        self._next_client = count()
+    # end def
+
+    async def start(self):
+        """ Has to be called on the event loop the requests should run on. """
+        import httpx
+
+        self._loop = asyncio.get_running_loop()
+        limits = httpx.Limits(max_connections=CONNECTIONS_PER_CLIENT, max_keepalive_connections=CONNECTIONS_PER_CLIENT)
+        self._clients = [
+            httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(self.timeout))
+            for _ in range(max(1, -(-self.connections // CONNECTIONS_PER_CLIENT)))
+        ]
+    # end def
+
+    async def close(self):
+        clients, self._clients = self._clients, []
+        for client in clients:
+            await client.aclose()
+        # end for
+    # end def
+
+    async def post(self, url: str, params: dict, files: dict, timeout: Union[float, None] = None):
+        """ :rtype: httpx.Response """
+        client = self._clients[next(self._next_client) % len(self._clients)]
+        return await client.post(url, params=params, files=files or None, timeout=timeout or self.timeout)
+    # end def
+
+    def post_blocking(self, url: str, params: dict, files: dict, timeout: Union[float, None] = None):
+        """ Same as :meth:`post`, for threads other than the one of the event loop. """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        # end try
+        if running is self._loop:
+            raise RuntimeError('waiting for a request on its own event loop would block it forever, call the bot in a thread.')
+        # end if
+        return asyncio.run_coroutine_threadsafe(self.post(url, params, files, timeout), self._loop).result()
+    # end def
+# end class
+
+
+class PooledBot(Bot):
+    """
+    A regular `pytgbot` bot, but doing its requests over a shared keep-alive `requests.Session`,
+    instead of opening a new connection (and TLS handshake) for every single api call.
+    If there is a `transport`, the requests go over that instead.
+    Sending calls go through the `rate_limiter`, if there is one.
+    """
+    def __init__(
+        self, api_key, session: requests.Session, base_url=DEFAULT_BASE_URL, rate_limiter: Union[RateLimiter, None] = None,
+        transport: Union[AsyncTransport, None] = None,
+    ):
+        super().__init__(api_key, base_url=base_url)
+        self._session = session
+        self.bot_id = int(api_key.split(':', 1)[0])
+        self.rate_limiter = rate_limiter
+        self.transport = transport
+        self.last_used = monotonic()
+    # end def
+
+    def do(self, command, files=None, use_long_polling=False, request_timeout=None, **query):
+        """ Same as :meth:`pytgbot.bot.synchronous.SyncBot.do`, but using the shared session. """
+        if self.rate_limiter is None:
+            return self._do(command, files, use_long_polling, request_timeout, query)
+        # end if
+        return self.rate_limiter.call(
+            self.bot_id, query.get('chat_id'), command,
+            lambda: self._do(command, files, use_long_polling, request_timeout, query),
+        )
+    # end def
+
+    def _do(self, command, files, use_long_polling, request_timeout, query):
+        start = perf_counter()
+        result = RESULT_NETWORK
+        try:
+            response = self._request(command, files, use_long_polling, request_timeout, query)
+            result = RESULT_OK
+            return response
+        except TgApiServerException as e:
+            result = e.error_code
+            raise
+        finally:
+            api_call_seconds.observe(perf_counter() - start, command)
+            api_calls.inc(command, result)
+        # end try
+    # end def
+
+    def _request(self, command, files, use_long_polling, request_timeout, query):
+        url, params, files = self._prepare_request(command, query)
+        transport = self.transport
+        if transport is not None:
+            r = transport.post_blocking(url, params, files, timeout=request_timeout)
+            return self._postprocess_request(r.request, response=r, json=r.json())
+        # end if
+        r = self._session.post(
+            url,
+            params=params,
+            files=files,
+            stream=use_long_polling,
+            verify=True,  # No self signed certificates. Telegram should be trustworthy anyway...
+            timeout=request_timeout
+        )
+        json = r.json()
+        return self._postprocess_request(r.request, response=r, json=json)
+    # end def
+# end class
+
+
+class BotPool(object):
+    """
+    Bounded registry of :class:`PooledBot`s, one per api key.
+    The least recently used bot is evicted when `max_size` is reached,
+    and bots not used for `idle_timeout` seconds are dropped as well.
+    All of them share one keep-alive session with up to `connections` open connections to the api server
+    (or the :class:`AsyncTransport`, once one is set), and the `rate_limiter`.
+    """
+    def __init__(
+        self, max_size=256, idle_timeout=600.0, connections=32, base_url=DEFAULT_BASE_URL,
+        rate_limiter: Union[RateLimiter, None] = None,
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connections = connections
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter
+        self._bots = OrderedDict()  # api_key -> PooledBot, least recently used first.
+        self._lock = RLock()
+        self._session = None
+        self._session_last_used = monotonic()
+        self._transport = None
+    # end def
+
+    def set_transport(self, transport: Union[AsyncTransport, None]):
+        """ Moves all the bots, existing and new ones, to that transport. `None` goes back to the session. """
+        with self._lock:
+            self._transport = transport
+            for rp_bot in self._bots.values():
+                rp_bot.transport = transport
+            # end for
+        # end with
+    # end def
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.connections)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    # end def
+
+    def get(self, api_key: str) -> PooledBot:
+        """ Returns the cached bot for that api key, or creates a new one. """
+        now = monotonic()
+        with self._lock:
+            if self._session is None or now - self._session_last_used > self.idle_timeout:
+                # everything in there is stale anyway, don't try to reuse dead connections.
+                self._reset_session()
+            # end if
+            self._session_last_used = now
+            rp_bot = self._bots.get(api_key)
+            if rp_bot is not None:
+                self._bots.move_to_end(api_key)
+                rp_bot.last_used = now
+                return rp_bot
+            # end if
+            self._evict(now)
+            rp_bot = PooledBot(
+                api_key, session=self._session, base_url=self.base_url, rate_limiter=self.rate_limiter, transport=self._transport,
+            )
+            self._bots[api_key] = rp_bot
+            return rp_bot
+        # end with
+    # end def
+
+    def discard(self, api_key: str):
+        """ Forget a bot, e.g. because the key got revoked. """
+        with self._lock:
+            self._bots.pop(api_key, None)
+        # end with
+    # end def
+
+    def _evict(self, now):
+        """ Drops idle bots, and the least recently used ones to make room for a new one. Needs the lock. """
+        while self._bots:
+            api_key, rp_bot = next(iter(self._bots.items()))
+            if len(self._bots) < self.max_size and now - rp_bot.last_used <= self.idle_timeout:
+                break
+            # end if
+            del self._bots[api_key]
+        # end while
+    # end def
+
+    def _reset_session(self):
+        """ Replaces the shared session, existing bots are moved over. Needs the lock. """
+        old_session = self._session
+        self._session = self._new_session()
+        for rp_bot in self._bots.values():
+            rp_bot._session = self._session
+        # end for
+        if old_session is not None:
+            old_session.close()
+        # end if
+    # end def
+
+    def __len__(self):
+        return len(self._bots)
+    # end def
+# end class
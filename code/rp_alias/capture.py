@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import os
+from datetime import datetime
+from hashlib import blake2b
+from queue import Queue, Full
+from secrets import token_bytes
+from threading import Thread
+from time import time
+from typing import Union
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+NAME_FIELDS = ('first_name', 'last_name', 'title')
+REDACTED_FIELDS = ('phone_number', 'email', 'bio', 'description', 'invite_link', 'vcard')
+USER_ID_FIELDS = ('user_id',)  # ids outside of user objects, e.g. of a shared contact.
+SIGNATURE_FIELDS = ('forward_sender_name', 'sender_user_name', 'author_signature', 'forward_signature')  # names as plain strings.
+
+captured = counter('capture_updates_total', 'Webhook updates written to the capture')
+capture_dropped = counter('capture_dropped_total', 'Webhook updates not captured, because the writer was behind')
+
+
+class Redactor(object):
+    """
+    Replaces the identities in updates with pseudonyms: user and chat ids get keyed hashes,
+    names and signatures get replaced. The same id always gets the same pseudonym (for the same salt),
+    so who replies to whom, and who owns which bot, survives.
+    Without knowing the salt the ids can't be brute forced back.
+    """
+    def __init__(self, salt: bytes):
+        self.salt = salt if len(salt) <= blake2b.MAX_KEY_SIZE else blake2b(salt).digest()
+    # end def
+
+    def pseudonym(self, peer_id: int) -> int:
+        digest = blake2b(str(peer_id).encode(), key=self.salt, digest_size=8).digest()
+        pseudonym = int.from_bytes(digest, 'big') % 1000000000 + 1
+        if peer_id < 0:
+            # keep it looking like a group (-…) or supergroup/channel (-100…).
+            return -(1000000000000 + pseudonym) if str(peer_id).startswith('-100') else -pseudonym
+        # end if
+        return pseudonym
+    # end def
+
+    def redact(self, value):
+        """ Returns a redacted copy of the (json) value. """
+        if isinstance(value, list):
+            return [self.redact(item) for item in value]
+        # end if
+        if not isinstance(value, dict):
+            return value
+        # end if
+        is_peer = 'id' in value and ('is_bot' in value or 'type' in value) and isinstance(value['id'], int)
+        is_contact = 'phone_number' in value
+        result = {}
+        for key, item in value.items():
+            if is_peer and key == 'id':
+                result[key] = self.pseudonym(item)
+            elif is_peer and key in NAME_FIELDS:
+                result[key] = f'Peer {self.pseudonym(value["id"])}'
+            elif is_peer and key == 'username':
+                result[key] = f'peer{abs(self.pseudonym(value["id"]))}'
+            elif key in USER_ID_FIELDS and isinstance(item, int):
+                result[key] = self.pseudonym(item)
+            elif is_contact and key in NAME_FIELDS:
+                result[key] = f'Peer {self.pseudonym(value["user_id"])}' if isinstance(value.get('user_id'), int) else 'redacted'
+            elif key in SIGNATURE_FIELDS and isinstance(item, str):
+                result[key] = 'redacted'
+            elif key in REDACTED_FIELDS:
+                result[key] = 'redacted'
+            elif key == 'url' and isinstance(item, str) and item.startswith('tg://user?id='):
+                result[key] = f'tg://user?id={self.pseudonym(int(item[len("tg://user?id="):]))}'
+            else:
+                result[key] = self.redact(item)
+            # end if
+        # end for
+        return result
+    # end def
+# end class
+
+
+class TrafficCapture(object):
+    """
+    Writes incoming updates, redacted, with their arrival time to gzipped json lines files,
+    starting a new file every `max_bytes` (uncompressed) and keeping only the newest `max_files`.
+    Writing happens in a background thread; if it falls behind, updates are skipped rather than slowing the webhook.
+
+    Every line is `{"t": arrival unix time, "bot": bot id, "owner": owner id, "prefix": prefix, "update": update}`,
+    with the ids being pseudonyms. No api keys are written.
+    """
+    def __init__(self, path: str, salt: Union[bytes, None] = None, max_bytes: int = 64 * 1024 * 1024, max_files: int = 24, queue_size: int = 10000):
+        """
+        :param path: folder to write the files to.
+        :param salt: key for the pseudonyms. Random if not given, then the pseudonyms only match within this process.
+        """
+        self.path = path
+        self.redactor = Redactor(salt or token_bytes(16))
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._queue = Queue(maxsize=queue_size)
+        self._file = None
+        self._written = 0
+        self._thread = None
+    # end def
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._thread = Thread(target=self._write_forever, name='traffic-capture', daemon=True)
+        self._thread.start()
+    # end def
+
+    def record(self, bot_id: int, owner_id: int, prefix: str, update: dict):
+        try:
+            self._queue.put_nowait((time(), bot_id, owner_id, prefix, update))
+        except Full:
+            capture_dropped.inc()
+        # end try
+    # end def
+
+    def _write_forever(self):
+        while True:
+            arrival, bot_id, owner_id, prefix, update = self._queue.get()
+            try:
+                self._write(arrival, bot_id, owner_id, prefix, update)
+            except Exception:
+                logger.exception('capturing an update failed.')
+            # end try
+        # end while
+    # end def
+
+    def _write(self, arrival: float, bot_id: int, owner_id: int, prefix: str, update: dict):
+        line = json.dumps({
+            't': arrival, 'bot': self.redactor.pseudonym(bot_id), 'owner': self.redactor.pseudonym(owner_id),
+            'prefix': prefix, 'update': self.redactor.redact(update),
+        }, ensure_ascii=False).encode() + b'\n'
+        if self._file is None or self._written + len(line) > self.max_bytes:
+            self._roll()
+        # end if
+        self._file.write(line)
+        self._written += len(line)
+        if self._queue.empty():
+            self._file.flush()  # readable while still running, without flushing the gzip stream on every line.
+        # end if
+        captured.inc()
+    # end def
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        # end if
+        name = f'capture-{datetime.utcnow():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz'
+        self._file = gzip.open(os.path.join(self.path, name), 'ab')
+        self._written = 0
+        files = sorted(f for f in os.listdir(self.path) if f.startswith('capture-') and f.endswith(f'-{os.getpid()}.jsonl.gz'))
+        for old in files[:-self.max_files]:
+            os.remove(os.path.join(self.path, old))
+        # end for
+    # end def
+# end class
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+from threading import Lock
+from time import time
+from typing import Dict, List, Set
+
+from luckydonaldUtils.logger import logging
+
+from .partition import HashRing
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+lease_changes = counter('bot_lease_changes_total', 'RP bots this node started or stopped polling, because the nodes changed', ('change',))
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+# end def
+
+
+class BotLeases(object):
+    """
+    Splits the polled bots between the running nodes (processes or machines), without any coordinator:
+    every node announces itself in a mongo collection, and they all build the same :class:`HashRing` of the nodes alive.
+
+    A node only polls a bot while it holds the bot's lease. It takes one only once the previous holder gave it back
+    (after handling its last batch and storing the offset) or stopped renewing it for `lease` seconds,
+    so a bot is never polled by two nodes at once, and its updates stay in order when nodes join or leave.
+    """
+    def __init__(self, nodes, leases, node_id: str, lease: float = 30.0):
+        """
+        :param nodes: the `pymongo` collection of the nodes.
+        :param leases: the `pymongo` collection of the leases.
+        :param node_id: unique name of this node.
+        :param lease: seconds until a node not renewing its leases is considered gone.
+            Has to be a good bit longer than the interval :meth:`wanted` is called in.
+        """
+        self.nodes = nodes
+        self.leases = leases
+        self.node_id = node_id
+        self.lease = lease
+        self._held: Set[int] = set()
+        self._lock = Lock()
+    # end def
+
+    def ensure_indexes(self):
+        self.nodes.create_index('node', unique=True)
+        self.leases.create_index('bot_id', unique=True)
+    # end def
+
+    def alive_nodes(self) -> List[str]:
+        """ Renews our own heartbeat, and returns every node which did the same recently. """
+        now = time()
+        self.nodes.update_one({'node': self.node_id}, {'$set': {'seen': now}}, upsert=True)
+        return [document['node'] for document in self.nodes.find({'seen': {'$gt': now - self.lease}}, {'node': 1})]
+    # end def
+
+    def wanted(self, targets: Dict[int, str]) -> Dict[int, str]:
+        """
+        Returns the part of the `{bot_id: api_key}` targets this node should poll now,
+        renewing the leases of those and taking the ones which are free.
+        Bots which moved to another node are left out, so their polling stops,
+        but their leases are kept until :meth:`release` is called for them.
+        """
+        ring = HashRing(self.alive_nodes())
+        now = time()
+        mine = {}
+        for bot_id, api_key in targets.items():
+            if ring.owner(bot_id) == self.node_id:
+                if self._acquire(bot_id, now):
+                    mine[bot_id] = api_key
+                # end if
+            elif bot_id in self._held:
+                self._renew(bot_id, now)  # still busy with it, the poller will release it.
+            # end if
+        # end for
+        return mine
+    # end def
+
+    def _acquire(self, bot_id: int, now: float) -> bool:
+        from pymongo.errors import DuplicateKeyError
+        try:
+            self.leases.update_one(
+                {'bot_id': bot_id, '$or': [{'node': self.node_id}, {'until': {'$lt': now}}]},
+                {'$set': {'node': self.node_id, 'until': now + self.lease}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False  # somebody else has it.
+        # end try
+        with self._lock:
+            if bot_id not in self._held:
+                self._held.add(bot_id)
+                lease_changes.inc('acquired')
+                logger.info(f'node {self.node_id} took over bot {bot_id}.')
+            # end if
+        # end with
+        return True
+    # end def
+
+    def _renew(self, bot_id: int, now: float):
+        # no upsert, if it was released in the meantime it stays that way.
+        self.leases.update_one({'bot_id': bot_id, 'node': self.node_id}, {'$set': {'until': now + self.lease}})
+    # end def
+
+    def release(self, bot_id: int):
+        """ Gives the bot back, once we are really done with it. """
+        with self._lock:
+            if bot_id not in self._held:
+                return
+            # end if
+            self._held.discard(bot_id)
+        # end with
+        self.leases.delete_one({'bot_id': bot_id, 'node': self.node_id})
+        lease_changes.inc('released')
+        logger.info(f'node {self.node_id} handed over bot {bot_id}.')
+    # end def
+
+    def leave(self):
+        """ Gives everything back, e.g. when shutting down, so the others don't have to wait for the leases to run out. """
+        with self._lock:
+            held, self._held = self._held, set()
+        # end with
+        self.leases.delete_many({'bot_id': {'$in': list(held)}, 'node': self.node_id})
+        self.nodes.delete_one({'node': self.node_id})
+    # end def
+# end class
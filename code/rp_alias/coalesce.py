@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import Lock, Timer
+from typing import Callable, Dict, Hashable, List
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+edits_received = counter('edits_received_total', '/edit commands received')
+edits_sent = counter('edits_sent_total', 'Edits actually sent to telegram, after coalescing')
+edits_outdated = counter('edits_outdated_total', '/edit commands arriving after a newer edit of the same message was sent')
+
+
+class PendingEdit(object):
+    """ The newest `/edit` of a message, and all the `/edit` command messages to clean up. """
+    __slots__ = ('key', 'order', 'edit', 'command_message_ids')
+
+    def __init__(self, key: Hashable, order: int, edit: Callable[[], None]):
+        self.key = key
+        self.order = order
+        self.edit = edit
+        self.command_message_ids: List[int] = []
+    # end def
+# end class
+
+
+class EditCoalescer(object):
+    """
+    Collects the `/edit`s of the same message for `window` seconds, and then only sends the newest one.
+    Newest means the highest `order` (the message id of the `/edit` command), not the one arriving last,
+    so edits processed out of order can't overwrite newer ones, not even after the window closed.
+
+    `flush(pending)` is called once per window, in a timer thread.
+    """
+    def __init__(self, window: float, flush: Callable[[PendingEdit], None], remember: int = 1024):
+        """
+        :param window: seconds to wait for more edits of the same message. `0` flushes every edit right away.
+        :param flush: does the edit, and deletes the command messages.
+        :param remember: how many edited messages to remember the newest sent edit of.
+        """
+        self.window = window
+        self.flush = flush
+        self.remember = remember
+        self._pending: Dict[Hashable, PendingEdit] = {}
+        self._sent: Dict[Hashable, int] = OrderedDict()  # key -> order of the newest edit sent.
+        self._lock = Lock()
+    # end def
+
+    def submit(self, key: Hashable, order: int, command_message_id: int, edit: Callable[[], None]):
+        """
+        :param key: what is edited, e.g. `(bot_id, chat_id, message_id)`.
+        :param order: increasing with newer edits, e.g. the message id of the `/edit` command.
+        :param command_message_id: the `/edit` command message, which gets deleted either way.
+        :param edit: does the edit.
+        """
+        edits_received.inc()
+        with self._lock:
+            pending = self._pending.get(key)
+            start_timer = pending is None
+            if pending is None:
+                pending = self._pending[key] = PendingEdit(key, order, edit)
+            elif order > pending.order:
+                pending.order, pending.edit = order, edit
+            # end if
+            pending.command_message_ids.append(command_message_id)
+        # end with
+        if not start_timer:
+            return
+        # end if
+        if self.window <= 0:
+            self._flush(key)
+            return
+        # end if
+        timer = Timer(self.window, self._flush, args=(key,))
+        timer.daemon = True
+        timer.start()
+    # end def
+
+    def _flush(self, key: Hashable):
+        with self._lock:
+            pending = self._pending.pop(key)
+            if self._sent.get(key, -1) > pending.order:
+                # a newer edit made it already, only the cleanup is left.
+                edits_outdated.inc()
+                pending.edit = None
+            else:
+                self._sent[key] = pending.order
+                self._sent.move_to_end(key)
+                while len(self._sent) > self.remember:
+                    self._sent.popitem(last=False)
+                # end while
+            # end if
+        # end with
+        if pending.edit:
+            edits_sent.inc()
+        # end if
+        try:
+            self.flush(pending)
+        except Exception:
+            logger.exception('flushing the edit failed.')
+        # end try
+    # end def
+# end class
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import List, Sequence, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.exceptions import TgApiServerException
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# why a bot wasn't asked to delete a message.
+SKIP_OTHER_CAN = 'other_can'  # another bot is known to be able to.
+SKIP_CANNOT = 'cannot'        # it is known not to be able to.
+
+# where we learned what a bot can do.
+SOURCE_CALL = 'call'
+SOURCE_MEMBER = 'member_update'
+
+# descriptions of 400 errors meaning the bot lacks the rights, not that something was wrong with that message.
+NO_RIGHTS_DESCRIPTIONS = ("can't be deleted", 'not enough rights', 'have no rights', 'not a member')
+
+delete_calls_saved = counter('delete_calls_saved_total', 'Deletions not tried with a bot, because of what we know about its rights', ('reason',))
+delete_rights_learned = counter('delete_rights_learned_total', 'Changes of what we know about the rights of a bot to delete in a chat', ('source', 'can'))
+
+
+def lacks_rights(e: TgApiServerException) -> bool:
+    """ If the error means the bot can't delete in that chat at all (no admin, not a member anymore). """
+    if e.error_code == 403:
+        return True
+    # end if
+    description = (e.description or '').lower()
+    return e.error_code == 400 and any(text in description for text in NO_RIGHTS_DESCRIPTIONS)
+# end def
+
+
+def can_delete_as(member: dict) -> bool:
+    """ If a `ChatMember` (as json) may delete the messages of others. """
+    status = member.get('status')
+    return status == 'creator' or (status == 'administrator' and bool(member.get('can_delete_messages')))
+# end def
+
+
+class DeleteRights(object):
+    """
+    Which bot can delete messages in which chat, per (chat, bot), learned from the deletions we did
+    and from `my_chat_member` / `chat_member` updates. Deletions are then only tried with a bot known to be able to,
+    or with the ones we don't know about yet. A bot known not to be able to is tried again after `reprobe` seconds,
+    it may have been made admin without us noticing.
+    """
+    def __init__(self, reprobe: float = 3600.0, size: int = 100000):
+        self.reprobe = reprobe
+        self.size = size
+        self._rights = OrderedDict()  # (chat id, bot id) -> (can delete, since when), least recently used first.
+        self._lock = Lock()
+    # end def
+
+    def plan(self, chat_id: Union[int, str], bot_ids: Sequence[int], count: bool = True) -> List[int]:
+        """ Which of the bots to try, in that order. Counts the ones skipped, unless `count` is false. """
+        now = monotonic()
+        known: List[Tuple[int, Union[bool, None]]] = []
+        with self._lock:
+            for bot_id in bot_ids:
+                entry = self._rights.get((chat_id, bot_id))
+                if entry is not None:
+                    self._rights.move_to_end((chat_id, bot_id))
+                # end if
+                can = None if entry is None or (not entry[0] and now - entry[1] > self.reprobe) else entry[0]
+                known.append((bot_id, can))
+            # end for
+        # end with
+        able = [bot_id for bot_id, can in known if can]
+        if able:
+            if count and len(bot_ids) > 1:
+                delete_calls_saved.inc(SKIP_OTHER_CAN, amount=len(bot_ids) - 1)
+            # end if
+            return able[:1]
+        # end if
+        plan = [bot_id for bot_id, can in known if can is None]
+        if count and len(plan) < len(bot_ids):
+            delete_calls_saved.inc(SKIP_CANNOT, amount=len(bot_ids) - len(plan))
+        # end if
+        return plan
+    # end def
+
+    def learn(self, chat_id: Union[int, str], bot_id: int, can: bool, source: str = SOURCE_CALL):
+        with self._lock:
+            old = self._rights.get((chat_id, bot_id))
+            self._rights[(chat_id, bot_id)] = (can, monotonic())
+            self._rights.move_to_end((chat_id, bot_id))
+            while len(self._rights) > self.size:
+                self._rights.popitem(last=False)
+            # end while
+        # end with
+        if old is None or old[0] != can:
+            delete_rights_learned.inc(source, 'true' if can else 'false')
+        # end if
+    # end def
+
+    def learn_error(self, chat_id: Union[int, str], bot_id: int, e: TgApiServerException):
+        """ Only errors about the rights count, not e.g. a message which was deleted already. """
+        if lacks_rights(e):
+            self.learn(chat_id, bot_id, False)
+        # end if
+    # end def
+
+    def learn_update(self, update: dict) -> bool:
+        """
+        Learns from a `my_chat_member` or `chat_member` update (as json), if it is about a bot.
+        Returns if it was such an update, no other handling needed.
+        """
+        change = update.get('my_chat_member') or update.get('chat_member')
+        if change is None:
+            return False
+        # end if
+        member = change.get('new_chat_member') or {}
+        user = member.get('user') or {}
+        if user.get('is_bot'):
+            self.learn(change['chat']['id'], user['id'], can_delete_as(member), source=SOURCE_MEMBER)
+        # end if
+        return True
+    # end def
+
+    def __len__(self):
+        return len(self._rights)
+    # end def
+# end class
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import re
+from functools import lru_cache
 from html import escape
 from typing import Union, Optional
 
@@ -19,7 +20,8 @@ ELLIPSIS = '…'
 MAX_LEN = 18
 
 REGEX_STR = rf'{BAR}.*{SPACES[0]}+\s*\n{BAR} .+{ELLIPSIS}?\n'
-REGEX = re.compile(REGEX_STR)
+REGEX = re.compile(REGEX_STR)  # what the parser below does, but that one backtracks horribly on lots of spaces.
+WHITESPACE_REGEX = re.compile(r'\s*')
 
 
 def build_fake_reply(chat_id: Union[int, str], user_id: Union[int, str], name: str, reply_id: int, old_text: str) -> str:
@@ -36,6 +38,12 @@ def build_fake_reply(chat_id: Union[int, str], user_id: Union[int, str], name: s
     # end if
 
     text = old_text[:MAX_LEN-1] + ELLIPSIS if len(old_text) > MAX_LEN else old_text
+    return _render(url, name, text)
+# end def
+
+
+@lru_cache(maxsize=1024)
+def _render(url: str, name: str, text: str) -> str:
     link = lambda t: f'<b><a href="{url}">{{text}}</a></b>'.format(text=escape(t))
     html = link(BAR + ' ' + name + SPACES + '\n' + BAR + ' ')
     html += text + '\n'
@@ -44,8 +52,61 @@ def build_fake_reply(chat_id: Union[int, str], user_id: Union[int, str], name: s
 
 
 def remove_fake_reply(text: str) -> str:
-    """ if it starts with two lines of fake reply, remove that; otherwise return unchanged. """
-    return REGEX.sub('', text)
+    """
+    if it starts with two lines of fake reply, remove that; otherwise return unchanged.
+    Same as `REGEX.sub('', text)`, in a single pass.
+    """
+    parts = []
+    last = 0
+    pos = 0
+    while True:
+        start = text.find(BAR, pos)
+        if start == -1:
+            break
+        # end if
+        line_end = text.find('\n', start)
+        if line_end == -1:
+            break
+        # end if
+        end = _header_end(text, start, line_end)
+        if end is None:
+            # every other BAR on this line would end up with the same line end, so skip the whole line.
+            pos = line_end + 1
+            continue
+        # end if
+        parts.append(text[last:start])
+        last = pos = end
+    # end while
+    if not parts:
+        return text
+    # end if
+    parts.append(text[last:])
+    return ''.join(parts)
+# end def
+
+
+def _header_end(text: str, start: int, line_end: int) -> Union[int, None]:
+    """
+    Where a fake reply header, with its first line ending at `line_end`, ends.
+    That first line has to end in whitespace containing a space, then (after whitespace only, including empty lines)
+    the next line has to start with `BAR + ' '` and have more text.
+    """
+    # the trailing whitespace of the first line needs a real space.
+    trailing = start + len(text[start:line_end].rstrip())
+    if text.find(SPACES[0], trailing, line_end) == -1:
+        return None
+    # end if
+    # skip any whitespace, the last one must be a line break right before the second line.
+    second = WHITESPACE_REGEX.match(text, line_end + 1).end()
+    length = len(text)
+    if text[second - 1] != '\n' or not text.startswith(BAR + ' ', second) or second + 2 >= length or text[second + 2] == '\n':
+        return None
+    # end if
+    second_end = text.find('\n', second + 3)
+    if second_end == -1:
+        return None
+    # end if
+    return second_end + 1
 # end def
 
 
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Tuple
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+fanout_posts = counter('fanout_posts_total', 'Timed fan-out operations', ('operation',))
+fanout_wall_seconds = counter('fanout_wall_seconds_total', 'Wall-clock seconds fan-out operations took', ('operation',))
+fanout_serial_seconds = counter(
+    'fanout_serial_seconds_total', 'Seconds the same api calls took added up, i.e. what running them one after another costs', ('operation',),
+)
+
+
+class FanOut(object):
+    """
+    Runs independent api calls at the same time on a bounded thread pool.
+    With `workers=0` everything runs one after another in the calling thread, like it used to.
+
+    Don't call it from inside a task it runs, a full pool would wait for itself.
+    """
+    def __init__(self, workers: int = 8):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout') if workers > 0 else None
+    # end def
+
+    def resize(self, workers: int):
+        """ Replaces the pool, calls already started finish on the old one. """
+        old_executor = self._executor
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout') if workers > 0 else None
+        self.workers = workers
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+        # end if
+    # end def
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+    # end def
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """ Starts the call, returns the future of it. In serial mode it's already done when returned. """
+        if self._executor:
+            return self._executor.submit(fn, *args, **kwargs)
+        # end if
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        # end try
+        return future
+    # end def
+
+    def first_success(self, *calls: Callable[[], bool]) -> bool:
+        """
+        Races the given calls, each returning if it worked. Returns `True` as soon as the first one did,
+        without waiting for the others. In serial mode the remaining calls aren't even started.
+        """
+        if not self._executor:
+            for call in calls:
+                if call():
+                    return True
+                # end if
+            # end for
+            return False
+        # end if
+        for future in as_completed([self._executor.submit(call) for call in calls]):
+            if future.result():
+                return True
+            # end if
+        # end for
+        return False
+    # end def
+# end class
+
+
+class CallTimer(object):
+    """
+    Compares the wall-clock time of a fan-out operation with the time all of its (finished) calls took added up.
+    Wrap every call with :meth:`timed`, and call :meth:`finish` when the operation is done.
+    """
+    __slots__ = ('operation', 'started', 'serial', '_lock')
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.started = perf_counter()
+        self.serial = 0.0
+        self._lock = Lock()
+    # end def
+
+    def timed(self, fn: Callable) -> Callable:
+        @wraps(fn)
+        def timed_inner(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                duration = perf_counter() - start
+                with self._lock:
+                    self.serial += duration
+                # end with
+            # end try
+        # end def
+        return timed_inner
+    # end def
+
+    def finish(self) -> Tuple[float, float]:
+        """ Returns and records the wall-clock and the added up time. """
+        wall = perf_counter() - self.started
+        with self._lock:
+            serial = self.serial
+        # end with
+        fanout_posts.inc(self.operation)
+        fanout_wall_seconds.inc(self.operation, amount=wall)
+        fanout_serial_seconds.inc(self.operation, amount=serial)
+        logger.debug(f'{self.operation} took {wall:.3f}s, one call after another would have been at least {serial:.3f}s.')
+        return wall, serial
+    # end def
+# end class
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import blake2b
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterable, List, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.exceptions import TgApiServerException
+
+from .ratelimit import TokenBucket, retry_after_of
+from .registry import Registration
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# result label of the calls, besides telegram's error codes.
+RESULT_OK = 'ok'
+RESULT_NETWORK = 'network_error'
+
+fleet_calls = counter('fleet_calls_total', 'Api calls done for all RP bots at once, by operation and result', ('operation', 'result'))
+
+
+class FleetProgress(object):
+    """
+    The bots an operation is done with, in a mongo collection,
+    so running it again after an interruption only does the ones still missing (or failed).
+    A bot counts as done only with the token and secret token it had back then, so a re-registered one is done again.
+    """
+    def __init__(self, collection, operation: str, current: Union[Callable[[int], Union[Registration, None]], None] = None):
+        """
+        :param collection: the `pymongo` collection.
+        :param operation: what is done, including everything which makes it a different run, e.g. the new url.
+        :param current: the registration of a bot id as it is now, if the calls may store a changed one (e.g. a new secret token).
+        """
+        self.collection = collection
+        self.operation = operation
+        self.current = current
+    # end def
+
+    def ensure_indexes(self):
+        self.collection.create_index([('operation', 1), ('bot_id', 1)], unique=True)
+    # end def
+
+    @staticmethod
+    def version_of(registration: Registration) -> str:
+        """ Changes with the token and secret token. Hashed, so the secret isn't stored a second time. """
+        return blake2b(f'{registration.token}:{registration.secret_token}'.encode(), digest_size=16).hexdigest()
+    # end def
+
+    def done(self, registrations: Iterable[Registration]) -> List[Registration]:
+        """ The ones done with their current token and secret token. """
+        versions = {
+            document['bot_id']: document.get('version')
+            for document in self.collection.find({'operation': self.operation, 'ok': True}, {'bot_id': 1, 'version': 1})
+        }
+        return [registration for registration in registrations if versions.get(registration.bot_id) == self.version_of(registration)]
+    # end def
+
+    def record(self, result: 'FleetResult', registration: Registration):
+        if self.current:
+            registration = self.current(registration.bot_id) or registration
+        # end if
+        self.collection.update_one(
+            {'operation': self.operation, 'bot_id': result.bot_id},
+            {'$set': {
+                'ok': result.ok, 'result': result.result, 'error': result.error, 'at': datetime.utcnow(),
+                'token': registration.token, 'version': self.version_of(registration),
+            }},
+            upsert=True,
+        )
+    # end def
+
+    def reset(self):
+        """ Start over, everything gets done again. """
+        self.collection.delete_many({'operation': self.operation})
+    # end def
+# end class
+
+
+class FleetResult(object):
+    """ How the call went for one bot. """
+    __slots__ = ('bot_id', 'ok', 'result', 'error')
+
+    def __init__(self, bot_id: int, ok: bool, result: Union[dict, None] = None, error: Union[str, None] = None):
+        self.bot_id = bot_id
+        self.ok = ok
+        self.result = result
+        self.error = error
+    # end def
+# end class
+
+
+class FleetReport(object):
+    """ How an operation went for all the bots. """
+    def __init__(self, operation: str, results: List[FleetResult], skipped: int):
+        """ :param skipped: bots done by an earlier run already. """
+        self.operation = operation
+        self.results = results
+        self.skipped = skipped
+    # end def
+
+    @property
+    def failed(self) -> List[FleetResult]:
+        return [result for result in self.results if not result.ok]
+    # end def
+
+    def summary(self) -> str:
+        failed = len(self.failed)
+        return f'{self.operation}: {len(self.results) - failed} ok, {failed} failed, {self.skipped} done before.'
+    # end def
+# end class
+
+
+class Fleet(object):
+    """
+    Does an api call for every RP bot, `concurrency` of them at a time, and at most `per_second` calls per second
+    over all of them. A bot telegram answers with a 429 waits as long as it is told, and tries again.
+    """
+    def __init__(self, concurrency: int = 8, per_second: float = 20.0, max_retries: int = 3):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate=per_second, capacity=max(1.0, float(concurrency)))
+        self._lock = Lock()
+    # end def
+
+    def run(
+        self, operation: str, registrations: Iterable[Registration], call: Callable[[Registration], dict],
+        progress: Union[FleetProgress, None] = None,
+    ) -> FleetReport:
+        """
+        :param operation: name of it, for the logs and metrics.
+        :param call: does the api call of a bot, returns what to keep of the result.
+        :param progress: where to remember which bots are done, to skip them in the next run.
+        """
+        registrations = list(registrations)
+        done = {registration.bot_id for registration in progress.done(registrations)} if progress else set()
+        todo = [registration for registration in registrations if registration.bot_id not in done]
+        logger.info(f'{operation}: {len(todo)} bots to do, {len(registrations) - len(todo)} done before.')
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fleet') as executor:
+            results = list(executor.map(lambda registration: self._one(operation, registration, call, progress), todo))
+        # end with
+        report = FleetReport(operation, results, skipped=len(registrations) - len(todo))
+        logger.info(report.summary())
+        return report
+    # end def
+
+    def _one(self, operation: str, registration: Registration, call: Callable[[Registration], dict], progress: Union[FleetProgress, None]) -> FleetResult:
+        for attempt in range(self.max_retries + 1):
+            self._wait()
+            try:
+                result = FleetResult(registration.bot_id, ok=True, result=call(registration))
+                fleet_calls.inc(operation, RESULT_OK)
+            except TgApiServerException as e:
+                fleet_calls.inc(operation, e.error_code)
+                if e.error_code == 429 and attempt < self.max_retries:
+                    sleep(retry_after_of(e))
+                    continue
+                # end if
+                result = FleetResult(registration.bot_id, ok=False, error=f'{e.error_code}: {e.description}')
+            except Exception as e:
+                fleet_calls.inc(operation, RESULT_NETWORK)
+                result = FleetResult(registration.bot_id, ok=False, error=str(e) or e.__class__.__name__)
+            # end try
+            break
+        # end for
+        if progress:
+            try:
+                progress.record(result, registration)
+            except Exception:
+                logger.exception(f'{operation}: storing the progress of bot {registration.bot_id} failed.')
+            # end try
+        # end if
+        return result
+    # end def
+
+    def _wait(self):
+        with self._lock:
+            wait = self._bucket.reserve(monotonic())
+        # end with
+        if wait > 0:
+            sleep(wait)
+        # end if
+    # end def
+# end class
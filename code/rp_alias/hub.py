@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.exceptions import TgApiServerException
+
+from .registry import Registration
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# what happened to a group message the main bot got in hub mode.
+HUB_ECHO = 'echo'
+HUB_ALBUM = 'album'
+HUB_REPLY_TO_BOT = 'reply_to_bot'  # the RP bot got it itself.
+HUB_NO_MATCH = 'no_match'
+HUB_NOT_MEMBER = 'not_member'  # the RP bot isn't in that chat, it couldn't echo it.
+
+# where we learned if a bot is in a chat.
+SOURCE_SEEN = 'seen'
+SOURCE_MEMBER = 'member_update'
+SOURCE_ASKED = 'asked'
+
+# chat member statuses of the ones in the chat, `restricted` ones only with `is_member`.
+MEMBER_STATUSES = ('creator', 'administrator', 'member')
+
+hub_messages = counter('hub_messages_total', 'Group messages of RP bot owners the main bot dispatched in hub mode, by result', ('result',))
+chat_members_learned = counter('hub_chat_members_learned_total', 'Changes of what we know about which bot is in which chat', ('source', 'member'))
+
+
+class PrefixTrie(object):
+    """ Finds the longest of the added prefixes a text starts with, walking the text only once. """
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children: Dict[str, PrefixTrie] = {}
+        self.values: list = []
+    # end def
+
+    def add(self, prefix: str, value):
+        node = self
+        for char in prefix:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = PrefixTrie()
+            # end if
+            node = child
+        # end for
+        node.values.append(value)
+    # end def
+
+    def longest(self, text: str) -> list:
+        """ The values of the longest matching prefix, all of them if several were added with that prefix. """
+        found = self.matching(text)
+        return found[-1] if found else self.values
+    # end def
+
+    def matching(self, text: str) -> List[list]:
+        """ The values of every matching prefix, shortest prefix first. """
+        node, found = self, [self.values] if self.values else []
+        for char in text:
+            node = node.children.get(char)
+            if node is None:
+                break
+            # end if
+            if node.values:
+                found.append(node.values)
+            # end if
+        # end for
+        return found
+    # end def
+# end class
+
+
+class HubIndex(object):
+    """
+    The registered RP bots by owner, each owner with a :class:`PrefixTrie` over the prefixes of their bots.
+    So the main bot can tell with one lookup which RP bot a group post is for, without any of them having to get it.
+    Owners use the same prefix in chats with different bots, so which of the matches is in that chat is up to :class:`ChatMembers`.
+    Kept up to date by :meth:`update`, as listener of :meth:`RegistrationIndex.on_change`.
+    """
+    def __init__(self):
+        self._by_owner: Dict[int, Dict[int, Registration]] = {}
+        self._tries: Dict[int, PrefixTrie] = {}
+        self._lock = Lock()
+    # end def
+
+    def update(self, old: Union[Registration, None], new: Union[Registration, None]):
+        with self._lock:
+            if old:
+                self._by_owner.get(old.owner_id, {}).pop(old.bot_id, None)
+                self._rebuild(old.owner_id)
+            # end if
+            if new:
+                self._by_owner.setdefault(new.owner_id, {})[new.bot_id] = new
+                self._rebuild(new.owner_id)
+            # end if
+        # end with
+    # end def
+
+    def _rebuild(self, owner_id: int):
+        """ Needs the lock. Owners have a handful of bots, building a new trie is cheaper than editing the old one. """
+        registrations = self._by_owner.get(owner_id)
+        if not registrations:
+            self._by_owner.pop(owner_id, None)
+            self._tries.pop(owner_id, None)
+            return
+        # end if
+        trie = PrefixTrie()
+        for registration in registrations.values():
+            trie.add(registration.prefix, registration)
+        # end for
+        self._tries[owner_id] = trie  # lookups meanwhile still see the complete old one.
+    # end def
+
+    def match(self, owner_id: int, text: str, usable: Union[Callable[[Registration], bool], None] = None) -> List[Registration]:
+        """
+        The bots of that owner with the longest prefix the text starts with.
+        With `usable`, only the ones it returns `True` for, the next shorter prefix if none of them is.
+        """
+        trie = self._tries.get(owner_id)
+        if not trie:
+            return []
+        # end if
+        if usable is None:
+            return trie.longest(text)
+        # end if
+        for registrations in reversed(trie.matching(text)):
+            registrations = [registration for registration in registrations if usable(registration)]
+            if registrations:
+                return registrations
+            # end if
+        # end for
+        return []
+    # end def
+
+    def owns(self, user_id: int) -> bool:
+        """ If that user has any RP bots. """
+        return user_id in self._tries
+    # end def
+
+    def of_owner(self, owner_id: int) -> List[Registration]:
+        return list(self._by_owner.get(owner_id, {}).values())
+    # end def
+# end class
+
+
+def is_member(member: dict) -> bool:
+    """ If a `ChatMember` (as json) is in the chat. """
+    status = member.get('status')
+    return status in MEMBER_STATUSES or (status == 'restricted' and bool(member.get('is_member')))
+# end def
+
+
+class ChatMembers(object):
+    """
+    Which bots are in which chat, learned from the updates they get there and from `my_chat_member` / `chat_member` updates.
+    If nothing is known (anymore), :meth:`check` asks telegram once.
+    At most `size` chats, least recently used ones dropped. What we know expires after `ttl` seconds.
+    """
+    def __init__(self, size: int = 100000, ttl: float = 24 * 60 * 60):
+        self.size = size
+        self.ttl = ttl
+        self._chats = OrderedDict()  # chat id -> {bot id: (is member, since when)}, least recently used first.
+        self._lock = Lock()
+    # end def
+
+    def known(self, chat_id: int, bot_id: int) -> Union[bool, None]:
+        """ If the bot is in that chat, `None` if we don't know. """
+        with self._lock:
+            bots = self._chats.get(chat_id)
+            entry = bots.get(bot_id) if bots else None
+            if entry is None or monotonic() - entry[1] > self.ttl:
+                return None
+            # end if
+            self._chats.move_to_end(chat_id)
+        # end with
+        return entry[0]
+    # end def
+
+    def check(self, chat_id: int, bot_id: int, ask: Callable[[], dict]) -> Union[bool, None]:
+        """
+        Like :meth:`known`, but if we don't know, calls `ask()` for the `ChatMember` (as json), i.e. `getChatMember`.
+        Errors of telegram mean it isn't in there. `None` if asking didn't work at all.
+        """
+        member = self.known(chat_id, bot_id)
+        if member is not None:
+            return member
+        # end if
+        try:
+            member = is_member(ask())
+        except TgApiServerException as e:
+            logger.debug(f'asking if bot {bot_id} is in chat {chat_id} failed', exc_info=True)
+            if e.error_code not in (400, 403):
+                return None
+            # end if
+            member = False  # chat not found, bot was kicked, …
+        except Exception:
+            logger.warning(f'asking if bot {bot_id} is in chat {chat_id} failed', exc_info=True)
+            return None
+        # end try
+        self.learn(chat_id, bot_id, member, source=SOURCE_ASKED)
+        return member
+    # end def
+
+    def seen(self, chat_id: int, bot_id: int):
+        """ The bot got an update from that chat, so it is in there. """
+        with self._lock:
+            bots = self._chats.get(chat_id)
+            entry = bots.get(bot_id) if bots else None
+            if entry is not None and entry[0]:
+                bots[bot_id] = (True, monotonic())
+                self._chats.move_to_end(chat_id)
+                return
+            # end if
+        # end with
+        self.learn(chat_id, bot_id, True, source=SOURCE_SEEN)
+    # end def
+
+    def learn(self, chat_id: int, bot_id: int, member: bool, source: str = SOURCE_MEMBER):
+        with self._lock:
+            bots = self._chats.get(chat_id)
+            if bots is None:
+                bots = self._chats[chat_id] = {}
+            # end if
+            old = bots.get(bot_id)
+            bots[bot_id] = (member, monotonic())
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.size:
+                self._chats.popitem(last=False)
+            # end while
+        # end with
+        if old is None or old[0] != member:
+            chat_members_learned.inc(source, 'true' if member else 'false')
+        # end if
+    # end def
+
+    def learn_update(self, update: dict) -> bool:
+        """ Learns from a `my_chat_member` or `chat_member` update (as json) about a bot. Returns if it was such an update. """
+        change = update.get('my_chat_member') or update.get('chat_member')
+        if change is None:
+            return False
+        # end if
+        member = change.get('new_chat_member') or {}
+        user = member.get('user') or {}
+        if user.get('is_bot'):
+            self.learn(change['chat']['id'], user['id'], is_member(member))
+        # end if
+        return True
+    # end def
+
+    def __len__(self):
+        return len(self._chats)
+    # end def
+# end class
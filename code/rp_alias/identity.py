@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot import Bot
+from pytgbot.api_types.receivable.peer import User as TGUser
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# kinds of group messages, as returned by `CommandMatcher.classify(…)`.
+KIND_DELETE = 'delete'            # /delete, /delete …, /delete@bot
+KIND_EDIT = 'edit'                # /edit …, /edit@bot …
+KIND_EDIT_EMPTY = 'edit_empty'    # just /edit
+KIND_OTHER_COMMAND = 'other'      # looks like /delete or /edit, but isn't ours
+KIND_PREFIX = 'prefix'            # a post starting with the prefix
+KIND_NONE = None                  # nothing for us
+
+identity_hits = counter('identity_cache_hits_total', 'RP bot identity lookups answered from cache')
+identity_misses = counter('identity_cache_misses_total', 'RP bot identity lookups needing a getMe call')
+
+
+class CommandMatcher(object):
+    """
+    Classifies a group message for one bot and prefix with a single precompiled regex,
+    with the same rules the command parsing had before, but without needing the bot's username from the api.
+    """
+    __slots__ = ('prefix', 'regex')
+
+    def __init__(self, username: str, prefix: str):
+        self.prefix = prefix
+        mention = re.escape('@' + username)
+        self.regex = re.compile(
+            r'\A(?:/(?:'
+            rf'(?P<{KIND_DELETE}>delete(?:\Z| |{mention}))|'
+            rf'(?P<{KIND_EDIT_EMPTY}>edit\Z)|'
+            rf'(?P<{KIND_EDIT}>edit(?: |{mention} ))|'
+            rf'(?P<{KIND_OTHER_COMMAND}>delete|edit)'
+            rf')|(?P<{KIND_PREFIX}>{re.escape(prefix)}))',
+            re.DOTALL,
+        )
+    # end def
+
+    def classify(self, text: str) -> Tuple[Union[str, None], str]:
+        """
+        Returns the kind of message, and the remaining text (e.g. the new text of an /edit, or a post without prefix).
+        """
+        m = self.regex.match(text)
+        if not m:
+            return KIND_NONE, text
+        # end if
+        return m.lastgroup, text[m.end():].strip()
+    # end def
+# end class
+
+
+class BotIdentity(object):
+    """ What `getMe` told us about a RP bot, and the command matchers for its prefixes. """
+    __slots__ = ('id', 'username', 'first_name', 'loaded_at', '_matchers')
+
+    def __init__(self, user: TGUser, loaded_at: float):
+        self.id = user.id
+        self.username = user.username
+        self.first_name = user.first_name
+        self.loaded_at = loaded_at
+        self._matchers: Dict[str, CommandMatcher] = {}
+    # end def
+
+    def matcher(self, prefix: str) -> CommandMatcher:
+        matcher = self._matchers.get(prefix)
+        if matcher is None:
+            matcher = self._matchers[prefix] = CommandMatcher(self.username, prefix)
+        # end if
+        return matcher
+    # end def
+# end class
+
+
+class IdentityCache(object):
+    """
+    Caches the `getMe` identity of RP bots for `ttl` seconds, keyed by api key.
+    At most `max_size` of them, the least recently used one is dropped first.
+    Use :meth:`put` after an own `getMe` call (e.g. in /add_bot), and :meth:`invalidate` when a bot got renamed.
+    """
+    def __init__(self, ttl=24 * 60 * 60, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._identities: Dict[str, BotIdentity] = OrderedDict()  # least recently used first.
+        self._lock = Lock()
+    # end def
+
+    def get(self, rp_bot: Bot) -> BotIdentity:
+        """ Returns the identity of that bot, calling `getMe` only if it isn't known (anymore). """
+        with self._lock:
+            identity = self._identities.get(rp_bot.api_key)
+            if identity is not None and monotonic() - identity.loaded_at <= self.ttl:
+                self._identities.move_to_end(rp_bot.api_key)
+                identity_hits.inc()
+                return identity
+            # end if
+        # end with
+        identity_misses.inc()
+        return self.put(rp_bot.api_key, rp_bot.get_me())
+    # end def
+
+    def put(self, api_key: str, user: TGUser) -> BotIdentity:
+        identity = BotIdentity(user, loaded_at=monotonic())
+        with self._lock:
+            self._identities[api_key] = identity
+            self._identities.move_to_end(api_key)
+            while len(self._identities) > self.max_size:
+                self._identities.popitem(last=False)
+            # end while
+        # end with
+        return identity
+    # end def
+
+    def invalidate(self, api_key: str):
+        """ Forget the identity, so the next lookup fetches the new name. """
+        with self._lock:
+            self._identities.pop(api_key, None)
+        # end with
+    # end def
+
+    @property
+    def hits(self):
+        return identity_hits.get()
+    # end def
+
+    @property
+    def misses(self):
+        return identity_misses.get()
+    # end def
+# end class
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from hashlib import blake2b
+from html import escape
+from threading import Lock
+from time import monotonic
+from typing import List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.sendable.inline import InlineQueryResultArticle, InputTextMessageContent
+
+from .fake_reply import build_fake_reply
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# first character of the result ids, so the same text gets different ids per variant.
+VARIANT_PLAIN = 'p'
+VARIANT_ACTION = 'a'
+VARIANT_REPLY = 'r'
+
+# others never get results, telegram may as well keep that for a while.
+NOT_OWNER_CACHE_TIME = 3600
+
+inline_answers = counter('inline_answers_total', 'Inline queries of owners answered, by where the results came from', ('source',))
+
+
+def result_id(variant: str, html: str) -> str:
+    """ Short and stable, no matter how long the text is. Telegram allows up to 64 bytes. """
+    return variant + blake2b(html.encode(), digest_size=16).hexdigest()
+# end def
+
+
+class LastMessage(object):
+    """ The last message somebody replied to the bot with, so the owner can fake reply to it. """
+    __slots__ = ('chat_id', 'user_id', 'name', 'message_id', 'text')
+
+    def __init__(self, chat_id: int, user_id: int, name: str, message_id: int, text: str):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.name = name
+        self.message_id = message_id
+        self.text = text
+    # end def
+# end class
+
+
+class InlineAnswers(object):
+    """
+    Builds the inline results for an owner's query: the text as it is, as an action (italic),
+    and as fake reply to the last message replying to the bot, if there is one.
+    Results are kept for `ttl` seconds, so retyping, deleting and the like don't build them again.
+    """
+    def __init__(self, ttl: float = 30.0, size: int = 4096):
+        self.ttl = ttl
+        self.size = size
+        self._results = OrderedDict()  # (bot id, query, last message) -> (expires, results), oldest first.
+        self._last_messages = {}  # bot id -> LastMessage
+        self._lock = Lock()
+    # end def
+
+    def remember_message(self, bot_id: int, message: LastMessage):
+        with self._lock:
+            self._last_messages[bot_id] = message
+        # end with
+    # end def
+
+    def results(self, bot_id: int, query: str) -> List[InlineQueryResultArticle]:
+        text = query.strip()
+        if not text:
+            return []
+        # end if
+        now = monotonic()
+        with self._lock:
+            last_message = self._last_messages.get(bot_id)
+            key = (bot_id, text, (last_message.chat_id, last_message.message_id) if last_message else None)
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > now:
+                self._results.move_to_end(key)
+                inline_answers.inc('cache')
+                return cached[1]
+            # end if
+        # end with
+        results = self._build(text, last_message)
+        inline_answers.inc('built')
+        with self._lock:
+            self._results[key] = (now + self.ttl, results)
+            self._results.move_to_end(key)
+            while len(self._results) > self.size or (self._results and next(iter(self._results.values()))[0] <= now):
+                self._results.popitem(last=False)
+            # end while
+        # end with
+        return results
+    # end def
+
+    @staticmethod
+    def _build(text: str, last_message: Union[LastMessage, None]) -> List[InlineQueryResultArticle]:
+        variants: List[Tuple[str, str, str]] = [
+            (VARIANT_PLAIN, 'Send as this character', escape(text)),
+            (VARIANT_ACTION, 'Send as action', f'<i>{escape(text)}</i>'),
+        ]
+        if last_message:
+            fake_reply = build_fake_reply(
+                chat_id=last_message.chat_id, user_id=last_message.user_id, name=last_message.name,
+                reply_id=last_message.message_id, old_text=last_message.text,
+            )
+            variants.append((VARIANT_REPLY, f'Reply to {last_message.name}', fake_reply + escape(text)))
+        # end if
+        return [
+            InlineQueryResultArticle(
+                id=result_id(variant, html), title=title, description=text,
+                input_message_content=InputTextMessageContent(
+                    message_text=html,
+                    parse_mode='html',
+                    disable_web_page_preview=True,
+                )
+            )
+            for variant, title, html in variants
+        ]
+    # end def
+# end class
@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
-from base64 import urlsafe_b64encode, urlsafe_b64decode
+from base64 import urlsafe_b64decode
 from html import escape
-from flask import Flask, url_for
-from typing import Union
+from flask import Flask, request, url_for
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Tuple, Union
 from datetime import datetime, timedelta
 from DictObject import DictObject
 from luckydonaldUtils.holder import Holder
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.encoding import to_native as n, to_binary as b
-from luckydonaldUtils.tg_bots.gitinfo import version_bp, version_tbp
 from luckydonaldUtils.tg_bots.peer.chat.format import format_chat
 from luckydonaldUtils.tg_bots.peer.user.format import format_user
 from pytgbot import Bot
-from pytgbot.api_types.sendable.inline import InlineQueryResultArticle, InputTextMessageContent
 from pytgbot.exceptions import TgApiServerException
 
 from pytgbot.api_types.receivable.updates import Update
@@ -20,25 +20,261 @@ from pytgbot.api_types.receivable.updates import Message as TGMessage
 from pytgbot.api_types.receivable.peer import User as TGUser, Chat as TGChat
 from pytgbot.api_types.sendable.reply_markup import ForceReply, ReplyKeyboardRemove
 
-from teleflask.new_messages import TextMessage
-from teleflask.messages import HTMLMessage
 from teleflask.server import Teleflask
 
+from .bot_pool import BotPool
+from .version import version_bp, version_tbp
+from .ratelimit import RateLimiter
+from .coalesce import EditCoalescer, PendingEdit
+from .capture import TrafficCapture
+from .cluster import BotLeases, default_node_id
+from .partition import PartitionedExecutor, chat_of
+from .inline import InlineAnswers, LastMessage, NOT_OWNER_CACHE_TIME
+from .album import Album, AlbumBuffer, albums_flushed, input_media, ALBUM_ECHOED, ALBUM_ONE_BY_ONE, ALBUM_NO_PREFIX
+from .stats import Stopwatch, gauge, histogram, render as render_metrics
+from .relay import RelayIndex, RelayStore, relay_lookups, SOURCE_INDEX, SOURCE_FORWARD, SOURCE_NOTICE, SOURCE_NONE
+from .identity import IdentityCache, KIND_DELETE, KIND_EDIT, KIND_EDIT_EMPTY, KIND_OTHER_COMMAND, KIND_PREFIX
+from .spool import UpdateSpool
+from .fanout import FanOut, CallTimer
+from .webhook_reply import WebhookReply
+from .prefilter import should_drop
+from .registry import Registration, RegistrationIndex, RegistrationStore, bot_id_from_api_key
+from .webhook_auth import check_request, reject, new_secret_token, set_webhook, API_KEY_REGEX
+from .webhook_auth import REJECT_UNKNOWN_BOT, REJECT_INVALID_API_KEY, REJECT_CHECK_LIMITED, REJECT_API_UNAVAILABLE, LegacyKeyCache
+from .polling import LongPoller, OffsetStore, ALLOWED_UPDATES
+from .fleet import Fleet, FleetProgress, FleetReport
+from .delete_rights import DeleteRights
+from .sent import SentMessage, SentStore, kind_of_method, KIND_TEXT as SENT_TEXT, CAPTION_KINDS as SENT_CAPTION_KINDS
+from .hub import ChatMembers, HubIndex, hub_messages, HUB_ECHO, HUB_ALBUM, HUB_REPLY_TO_BOT, HUB_NO_MATCH, HUB_NOT_MEMBER
 from .fake_reply import build_fake_reply
 from .anon_reply import build_reply_message, detect_anon_user_id
-from .secrets import API_KEY, HOSTNAME
+from .secrets import API_KEY, HOSTNAME, TG_API_URL, BOT_POOL_SIZE, BOT_POOL_IDLE_TIMEOUT, BOT_POOL_CONNECTIONS
+from .secrets import IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE, SPOOL_DIR, SPOOL_WORKERS, SPOOL_FSYNC, FANOUT_WORKERS
+from .secrets import WEBHOOK_REPLY, DELAYED_CALL_WORKERS, LOG_LEVEL
+from .secrets import MONGO_HOST, MONGO_USER, MONGO_PASSWORD, MONGO_DB, REGISTRY_POLL_INTERVAL
+from .secrets import UPDATE_MODE, WEB_CONCURRENCY, POLL_WORKERS, POLL_TIMEOUT_MIN, POLL_TIMEOUT_MAX
+from .secrets import RATE_LIMIT, RATE_LIMIT_BOT_PER_SECOND, RATE_LIMIT_PRIVATE_PER_SECOND
+from .secrets import RATE_LIMIT_GROUP_PER_MINUTE, RATE_LIMIT_GROUP_BURST, EDIT_COALESCE_WINDOW
+from .secrets import RELAY_NOTICE, RELAY_CACHE_SIZE, RELAY_RETENTION
+from .secrets import CAPTURE_DIR, CAPTURE_SALT, CAPTURE_MAX_BYTES, CAPTURE_MAX_FILES
+from .secrets import INLINE_CACHE_TIME, INLINE_CACHE_TTL, INLINE_CACHE_SIZE, ALBUM_WINDOW
+from .secrets import POLL_CLUSTER, POLL_LEASE, NODE_ID, FAST_START
+from .secrets import FLEET_ADMINS, FLEET_CONCURRENCY, FLEET_PER_SECOND, HUB_MODE, DELETE_REPROBE
+from .secrets import LEGACY_CACHE_SIZE, LEGACY_CHECKS_PER_SECOND
+from .secrets import SENT_STORE_PER_CHAT, SENT_STORE_CHATS, SENT_STORE_SPILL, SENT_STORE_SPILL_MAX
 from .sentry import add_error_reporting
 
 __author__ = 'luckydonald'
 
 logger = logging.getLogger(__name__)
-logging. add_colored_handler(level=logging.DEBUG)
+logging. add_colored_handler(level=LOG_LEVEL)
 
 app = Flask(__name__)
 app.register_blueprint(version_bp)
 sentry = add_error_reporting(app)
 
-bot = Teleflask(API_KEY, app)
+rate_limiter = RateLimiter(
+    bot_per_second=RATE_LIMIT_BOT_PER_SECOND, private_per_second=RATE_LIMIT_PRIVATE_PER_SECOND,
+    group_per_minute=RATE_LIMIT_GROUP_PER_MINUTE, group_burst=RATE_LIMIT_GROUP_BURST,
+) if RATE_LIMIT else None
+bot_pool = BotPool(
+    max_size=BOT_POOL_SIZE, idle_timeout=BOT_POOL_IDLE_TIMEOUT, connections=BOT_POOL_CONNECTIONS, base_url=TG_API_URL,
+    rate_limiter=rate_limiter,
+)
+identity_cache = IdentityCache(ttl=IDENTITY_CACHE_TTL, max_size=IDENTITY_CACHE_SIZE)
+fan_out = FanOut(workers=FANOUT_WORKERS)
+inline_answers = InlineAnswers(ttl=INLINE_CACHE_TTL, size=INLINE_CACHE_SIZE)
+delete_rights = DeleteRights(reprobe=DELETE_REPROBE)
+sent_messages = SentStore(per_chat=SENT_STORE_PER_CHAT, chats=SENT_STORE_CHATS, spill_path=SENT_STORE_SPILL, spill_max=SENT_STORE_SPILL_MAX)
+
+registrations = RegistrationIndex(RegistrationStore.connect(MONGO_HOST, MONGO_USER, MONGO_PASSWORD, MONGO_DB))
+relay_index = RelayIndex(RelayStore(registrations.store.collection.database['rp_bot_relays']), size=RELAY_CACHE_SIZE)
+relay_index.start()
+
+
+def set_up_stores():
+    """ Creates the indexes, and loads the registered bots. A few mongo round trips. """
+    try:
+        registrations.store.ensure_indexes()
+        registrations.load()
+    except Exception:
+        logger.exception('loading the registered bots failed, for now only the old style webhook urls work.')
+        registrations.loaded.set()  # nothing to wait for.
+    # end try
+    try:
+        relay_index.store.ensure_indexes(retention=RELAY_RETENTION)
+    except Exception:
+        logger.exception('setting up the relay store failed.')
+    # end try
+# end def
+
+
+if FAST_START:
+    # lookups wait for the registrations, should a request be faster.
+    Thread(target=set_up_stores, name='set-up-stores', daemon=True).start()
+else:
+    set_up_stores()
+# end if
+registrations.start_watching(poll_interval=REGISTRY_POLL_INTERVAL)
+
+# which way an update went, for the latency histogram.
+BRANCH_INLINE = 'inline'
+BRANCH_PRIVATE_START = 'private_start'
+BRANCH_PRIVATE_RELAY = 'private_relay'
+BRANCH_OWNER_REPLY = 'owner_reply'
+BRANCH_PUBLIC_PREFIX = 'public_prefix'
+BRANCH_EDIT = 'edit'
+BRANCH_DELETE = 'delete'
+BRANCH_REPLY_NOTIFICATION = 'reply_notification'
+BRANCH_ALBUM = 'album'
+BRANCH_IGNORED = 'ignored'
+
+update_seconds = histogram('update_handling_seconds', 'Time processing an update took, by the branch handling it', ('branch',))
+gauge('rp_bots_active', 'Registered RP bots', lambda: len(registrations))
+gauge('rp_bots_pooled', 'RP bots with an open api client', lambda: len(bot_pool))
+gauge('sent_messages_stored', 'Echoed messages kept in memory, for /edit', lambda: len(sent_messages))
+gauge('spool_depth', 'Updates waiting in the spool', lambda: update_spool.depth if update_spool else 0)
+
+
+@registrations.on_change
+def forget_changed_bot(old: Union[Registration, None], new: Union[Registration, None]):
+    if old and (not new or new.api_key != old.api_key):
+        identity_cache.invalidate(old.api_key)
+        bot_pool.discard(old.api_key)
+    # end if
+# end def
+
+
+hub_index = None
+chat_members = None
+if HUB_MODE:
+    hub_index = HubIndex()
+    chat_members = ChatMembers()
+    registrations.on_change(hub_index.update)
+    for registration in registrations.all():  # the ones loaded already, adding one twice doesn't hurt.
+        hub_index.update(None, registration)
+    # end for
+# end if
+
+
+class RPTeleflask(Teleflask):
+    """
+    With `FAST_START`, asking telegram who we are (`getMe`) waits for the first update, and setting the webhook
+    happens in the background. Until then, commands are only known without the `@username` part.
+    """
+    def init_bot(self):
+        if not self._bot:
+            # use the pooled connections for our own bot as well.
+            self._bot = bot_pool.get(self._api_key)
+        # end if
+        self._identify_lock = Lock()
+        if not FAST_START:
+            super().init_bot()
+            return
+        # end if
+        self._user_id = bot_id_from_api_key(self._api_key)
+        self._username = None
+    # end def
+
+    def identify(self):
+        """ Asks telegram for our username, once. Adds the `/command@username` variants of the commands known so far. """
+        if self._username is not None:
+            return
+        # end if
+        with self._identify_lock:
+            if self._username is not None:
+                return
+            # end if
+            myself = self._bot.get_me()
+            for command, registered in list(self.commands.items()):
+                if '@' not in command:
+                    self.commands[f'{command}@{myself.username}'] = registered
+                # end if
+            # end for
+            self._user_id = myself.id
+            self._username = myself.username
+        # end with
+    # end def
+
+    @property
+    def username(self):
+        self.identify()
+        return self._username
+    # end def
+
+    def _yield_commands(self, command):
+        if self._username is not None:
+            yield from super()._yield_commands(command)
+            return
+        # end if
+        # not identified yet, the `@username` variants are added then.
+        yield f'/{command}'
+        yield f'command:///{command}'
+    # end def
+
+    def process_update(self, update):
+        self.identify()
+        return super().process_update(update)
+    # end def
+
+    def view_updates(self):
+        if main_bot_ingest(request.get_json()):
+            return 'OK'
+        # end if
+        return super().view_updates()
+    # end def
+
+    def set_webhook_telegram(self):
+        if not FAST_START:
+            self.set_own_webhook()
+            return
+        # end if
+        # until it's done, telegram keeps using the old webhook, most likely the same one anyway.
+        Thread(target=self._set_webhook_telegram, name='set-webhook', daemon=True).start()
+    # end def
+
+    def _set_webhook_telegram(self):
+        try:
+            self.set_own_webhook()
+        except Exception:
+            logger.exception('setting the webhook of our bot failed.')
+        # end try
+    # end def
+
+    def set_own_webhook(self):
+        """
+        Like teleflask's, but asking for the member updates as well (:data:`ALLOWED_UPDATES`).
+        Teleflask only compares the url, so it wouldn't ever change an older webhook without them.
+        """
+        if self.disable_setting_webhook_telegram:
+            logger.info('not setting the webhook, it is disabled.')
+            return
+        # end if
+        existing = self.bot.get_webhook_info()
+        if existing.url == self._webhook_url and sorted(existing.allowed_updates or []) == sorted(ALLOWED_UPDATES):
+            logger.info('webhook set correctly, no need to change.')
+            return
+        # end if
+        logger.info(f'setting webhook to {self.hide_api_key(self._webhook_url)}')
+        self.bot.set_webhook(url=self._webhook_url, allowed_updates=ALLOWED_UPDATES)
+    # end def
+# end class
+
+
+if UPDATE_MODE == 'webhook' and WEB_CONCURRENCY > 1:
+    logger.warning(
+        f'WEB_CONCURRENCY={WEB_CONCURRENCY} with webhooks: the posts of a chat may get out of order, '
+        f'and edits, albums and the echoed messages get split between the workers. Use UPDATE_MODE=polling to scale out.'
+    )
+# end if
+
+
+if UPDATE_MODE == 'polling':
+    # the poller fetches our updates as well, so we don't have to be reachable.
+    bot = RPTeleflask(API_KEY, app, hostname=HOSTNAME or 'localhost', disable_setting_webhook_telegram=True)
+else:
+    bot = RPTeleflask(API_KEY, app)
+# end if
 # bot.on_startup(set_up_mongodb)
 bot.register_tblueprint(version_tbp)
 
@@ -58,194 +294,747 @@ def url_healthcheck():
 # end def
 
 
+@app.route("/metrics")
+def url_metrics():
+    """
+    :return: all the counters, histograms and gauges, in the prometheus text format.
+    """
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+# end def
+
+
+@app.route("/spool")
+def url_spool():
+    """
+    :return: how many updates are waiting in the spool.
+    """
+    return {'enabled': update_spool is not None, 'depth': update_spool.depth if update_spool else 0}, 200
+# end def
+
+
+@app.route("/rp_bot/<token>", methods=['POST'])
+def rp_bot_webhook(token: str):
+    """
+    This processes incoming telegram updates of a registered RP bot.
+
+    :return:
+    """
+    registration, reason = token_webhook_registration(token, request.headers, request.content_length)
+    if reason:
+        return reject(reason)
+    # end if
+    return handle_webhook(registration)
+# end def
+
+
 @app.route("/rp_bot_webhooks/<int:admin_user_id>/<base64_prefix>/<base64_api_key>", methods=['POST'])
 def rp_bot_webhooks(admin_user_id: int, base64_prefix: str, base64_api_key: str):
     """
-    This processes incoming telegram updates.
+    This processes incoming telegram updates of RP bots set up before there was the registration store,
+    with everything needed encoded in the url.
 
     :return:
     """
-    from pprint import pformat
-    from flask import request
+    registration, reason = legacy_webhook_registration(admin_user_id, base64_prefix, base64_api_key, request.headers, request.content_length)
+    if reason:
+        return reject(reason)
+    # end if
+    return handle_webhook(registration)
+# end def
+
+
+def token_webhook_registration(token: str, headers, content_length: Union[int, None]) -> Tuple[Union[Registration, None], Union[str, None]]:
+    """
+    The registration a `/rp_bot/<token>` request is for, or why it has to be rejected.
+    Everything here happens before the body is even read, so forged requests are cheap.
+    """
+    registration = registrations.get(token)
+    if not registration:
+        return None, REJECT_UNKNOWN_BOT
+    # end if
+    reason = check_request(registration.secret_token, headers, content_length)
+    if reason:
+        return None, reason
+    # end if
+    return registration, None
+# end def
+
+
+def legacy_webhook_registration(
+    admin_user_id: int, base64_prefix: str, base64_api_key: str, headers, content_length: Union[int, None],
+) -> Tuple[Union[Registration, None], Union[str, None]]:
+    """
+    The registration a `/rp_bot_webhooks/...` request is for, or why it has to be rejected.
+    Unknown bots are checked with telegram, so this may block.
+    """
+    try:
+        prefix = n(urlsafe_b64decode(base64_prefix))
+        api_key = n(urlsafe_b64decode(b(base64_api_key)))
+    except ValueError:
+        return None, REJECT_INVALID_API_KEY
+    # end try
+    if not API_KEY_REGEX.match(api_key):
+        return None, REJECT_INVALID_API_KEY
+    # end if
+    registration, reason = legacy_registration(admin_user_id, prefix, api_key)
+    if reason:
+        return None, reason
+    # end if
+    reason = check_request(None, headers, content_length)  # the api key in the url is the secret here.
+    if reason:
+        return None, reason
+    # end if
+    return registration, None
+# end def
+
+
+def legacy_registration(admin_user_id: int, prefix: str, api_key: str) -> Tuple[Union[Registration, None], Union[str, None]]:
+    """
+    Finds the registration of an old style webhook url, or why it has to be rejected.
+    Unknown ones are checked with telegram, as far as `legacy_keys` allows, and get stored in the background,
+    so they show up in the registration store from now on.
+    """
+    registration = registrations.by_bot_id(bot_id_from_api_key(api_key))
+    if registration and (registration.owner_id, registration.prefix, registration.api_key) == (admin_user_id, prefix, api_key):
+        return registration, None
+    # end if
+    key = (admin_user_id, prefix, api_key)
+    legacy = legacy_keys.get(key)
+    if legacy is not legacy_keys.MISSING:
+        return legacy, None if legacy else REJECT_UNKNOWN_BOT
+    # end if
+    if not legacy_keys.may_check():
+        return None, REJECT_CHECK_LIMITED
+    # end if
+    try:
+        identity_cache.get(bot_pool.get(api_key))  # forged urls end here, and we need the identity anyway.
+    except TgApiServerException as e:
+        bot_pool.discard(api_key)
+        if e.error_code in (401, 404):
+            logger.info(f'rejecting old style webhook url of unknown bot {bot_id_from_api_key(api_key)}.')
+            legacy_keys.put(key, None)
+            return None, REJECT_UNKNOWN_BOT
+        # end if
+        logger.warning(f'checking the old style webhook url of bot {bot_id_from_api_key(api_key)} failed.', exc_info=True)
+        return None, REJECT_API_UNAVAILABLE
+    except Exception:
+        bot_pool.discard(api_key)
+        logger.warning(f'checking the old style webhook url of bot {bot_id_from_api_key(api_key)} failed.', exc_info=True)
+        return None, REJECT_API_UNAVAILABLE
+    # end try
+    legacy = Registration.new(owner_id=admin_user_id, prefix=prefix, api_key=api_key)
+    legacy_keys.put(key, legacy)
+    if not registration:
+        # if there's a newer registration already, this is just a leftover update for the old url.
+        Thread(target=adopt_legacy_registration, args=(legacy,), name='adopt-registration', daemon=True).start()
+    # end if
+    return legacy, None
+# end def
+
+
+# the old style urls checked with telegram, they can be made up by anyone.
+legacy_keys = LegacyKeyCache(size=LEGACY_CACHE_SIZE, checks_per_second=LEGACY_CHECKS_PER_SECOND)
+
+
+def adopt_legacy_registration(registration: Registration):
+    try:
+        registrations.save(registration)
+    except Exception:
+        logger.warning('storing the registration of an old style webhook url failed.', exc_info=True)
+    # end try
+# end def
+
+
+def handle_webhook(registration: Registration):
+    update_json = request.get_json()
+    receive_webhook_update(registration, update_json, request.headers)
+    result = webhook_response(ingest_update(registration, update_json, allow_webhook_reply=WEBHOOK_REPLY))
+    if isinstance(result, WebhookReply):
+        return result.to_response()
+    # end if
+    return result
+# end def
+
+
+def receive_webhook_update(registration: Registration, update_json: dict, headers):
+    """ Captures and logs an update which came per webhook. """
+    if traffic_capture:
+        traffic_capture.record(registration.bot_id, registration.owner_id, registration.prefix, update_json)
+    # end if
+    if logger.isEnabledFor(logging.DEBUG):
+        from pprint import pformat
+        logger.debug("INCOME:\n{}\n\nHEADER:\n{}".format(pformat(update_json), headers))
+    # end if
+# end def
+
+
+def webhook_response(result: Union[str, WebhookReply]) -> Union[str, WebhookReply]:
+    """
+    Keeps the webhook reply, unless it would be too fast, or overtake calls still waiting for that chat.
+    Then it has to wait in line with the others, in the background, so the webhook request (and telegram) doesn't wait for it.
+    """
+    if isinstance(result, WebhookReply):
+        chat_id = result.params.get('chat_id')
+        if delayed_calls.pending((result.rp_bot.bot_id, chat_id)) or (
+            rate_limiter and not rate_limiter.try_acquire(result.rp_bot.bot_id, chat_id, result.api_method)
+        ):
+            send_later(result.rp_bot.bot_id, chat_id, result.execute)
+            return "OK"
+        # end if
+    # end if
+    return result
+# end def
+
+
+def send_later(bot_id: int, chat_id, send: Callable, *args, **kwargs) -> Future:
+    """
+    Does `send(*args, **kwargs)`, the (rate limited) api calls of that bot into that chat, in the background:
+    after everything sent there before, and without a request waiting for the rate limit.
+    """
+    return delayed_calls.submit((bot_id, chat_id), send_logged, send, *args, **kwargs)
+# end def
+
 
-    logger.debug("INCOME:\n{}\n\nHEADER:\n{}".format(
-        pformat(request.get_json()),
-        request.headers if hasattr(request, "headers") else None
-    ))
-    update = Update.from_array(request.get_json())
+def send_logged(send: Callable, *args, **kwargs):
+    try:
+        return send(*args, **kwargs)
+    except Exception:
+        logger.warning(f'sending in the background with {send.__qualname__} failed.', exc_info=True)
+    # end try
+# end def
+
+
+# api calls which had to wait for the rate limit, per bot and chat in the order they came.
+delayed_calls = PartitionedExecutor(DELAYED_CALL_WORKERS, name='delayed-call')
+
+
+def ingest_update(registration: Registration, update_json: dict, allow_webhook_reply: bool = False) -> Union[str, WebhookReply]:
+    """ Drops, spools or processes a new update, no matter if it came per webhook or long polling. """
+    if drop_update(registration, update_json):
+        return "OK"
+    # end if
+    return accept_update(registration, update_json, allow_webhook_reply=allow_webhook_reply)
+# end def
+
+
+def drop_update(registration: Registration, update_json: dict) -> bool:
+    """ Most of the group chatter, not worth parsing it. Cheap, no api calls. """
+    if learn_member_update(update_json):
+        return True  # it was about the rights of a bot, nothing else to do with it.
+    # end if
+    hub = False
+    if chat_members:
+        chat_id = group_chat_of(update_json)
+        if chat_id is not None:
+            chat_members.seen(chat_id, registration.bot_id)
+            # without our bot in there, the RP bot has to echo the posts itself.
+            hub = chat_members.known(chat_id, bot_id_from_api_key(API_KEY)) is True
+        # end if
+    # end if
+    return should_drop(
+        update_json, admin_user_id=registration.owner_id, rp_bot_id=registration.bot_id, prefix=registration.prefix, hub=hub,
+    )
+# end def
+
+
+def learn_member_update(update_json: dict) -> bool:
+    """ `my_chat_member` and `chat_member` updates tell where bots are, and what they may do there. Returns if it was one. """
+    if chat_members:
+        chat_members.learn_update(update_json)
+    # end if
+    return delete_rights.learn_update(update_json)
+# end def
+
+
+def group_chat_of(update_json: dict) -> Union[int, None]:
+    """ The id of the group a message is from, `None` for anything else. """
+    chat = (update_json.get('message') or {}).get('chat') or {}
+    return chat.get('id') if chat.get('type') in ('group', 'supergroup') else None
+# end def
+
+
+def accept_update(registration: Registration, update_json: dict, allow_webhook_reply: bool = False) -> Union[str, WebhookReply]:
+    """ Spools or processes an update which wasn't dropped. """
+    if update_spool:
+        # store it, the workers will do the rest. That way telegram doesn't have to wait for us.
+        update_spool.append(route=spool_route(registration), update=update_json)
+        return "OK"
+    # end if
+    return process_update(registration, update_json, allow_webhook_reply=allow_webhook_reply)
+# end def
+
+
+def process_update(registration: Registration, update_json: dict, allow_webhook_reply: bool = False) -> Union[str, WebhookReply]:
+    """
+    Processes an update a RP bot got, either directly from the webhook or from the spool.
+
+    :param allow_webhook_reply: If the main api call may be returned as :class:`WebhookReply` instead of being done.
+    """
+    stopwatch = update_seconds.time(BRANCH_IGNORED)
+    try:
+        return dispatch_update(registration, update_json, stopwatch, allow_webhook_reply=allow_webhook_reply)
+    finally:
+        stopwatch.finish()
+    # end try
+# end def
+
+
+def dispatch_update(registration: Registration, update_json: dict, stopwatch: Stopwatch, allow_webhook_reply: bool = False) -> Union[str, WebhookReply]:
+    """ Hands the update to the right branch, which labels the `stopwatch` with its name. """
+    update = Update.from_array(update_json)
     if not update.message and not update.inline_query:
         logger.debug('not an message or inline_query')
         return "OK"
     # end if
 
-
-    prefix = n(urlsafe_b64decode(base64_prefix))
-    api_key = n(urlsafe_b64decode(b(base64_api_key)))
-    rp_bot = Bot(api_key)
+    admin_user_id = registration.owner_id
+    prefix = registration.prefix
+    rp_bot = bot_pool.get(registration.api_key)
 
     if update.inline_query:
+        stopwatch.label(BRANCH_INLINE)
         inline_query = update.inline_query
         if inline_query.from_peer.id != admin_user_id:
-            rp_bot.answer_inline_query(inline_query_id=inline_query.id, results=[])
-            return 'OK'
+            return reply_or_execute(allow_webhook_reply, WebhookReply(
+                rp_bot, 'answer_inline_query', inline_query_id=inline_query.id, results=[],
+                cache_time=NOT_OWNER_CACHE_TIME, is_personal=True,
+            ))
         # end if
-        text = inline_query.query
-        id = urlsafe_b64encode(text)
-        rp_bot.answer_inline_query(inline_query_id=inline_query.id, results=[
-            InlineQueryResultArticle(
-                id=id, title='Send as this character',
-                input_message_content=InputTextMessageContent(
-                    message_text=text,
-                    parse_mode='',
-                    disable_web_page_preview=True,
-                )
-            )
-        ])
-        return 'OK'
+        # personal, or telegram would show the owner's results to everyone typing the same.
+        return reply_or_execute(allow_webhook_reply, WebhookReply(
+            rp_bot, 'answer_inline_query', inline_query_id=inline_query.id,
+            results=inline_answers.results(registration.bot_id, inline_query.query),
+            cache_time=INLINE_CACHE_TIME, is_personal=True,
+        ))
+    # end if
+
+    assert update.message
+    msg: TGMessage = update.message
+
+    if msg.chat.type == 'private':
+        return process_private_chat(update, admin_user_id, prefix, rp_bot, stopwatch, allow_webhook_reply=allow_webhook_reply)
+    # end if
+    if left_to_hub(registration, msg):
+        return "OK"
+    # end if
+    if msg.media_group_id and msg.from_peer and msg.from_peer.id == admin_user_id:
+        # the prefix may be in the caption of any item, we have to wait for all of them.
+        stopwatch.label(BRANCH_ALBUM)
+        album_buffer.add((registration.api_key, prefix, msg.chat.id, msg.media_group_id), msg)
+        return "OK"
+    # end if
+    if not msg.text and not msg.caption:
+        logger.info('not an message with text/caption')
+        return "OK"
+    # end if
+
+    return process_public_chat(msg, admin_user_id, prefix, rp_bot, stopwatch, allow_webhook_reply=allow_webhook_reply)
+# end def
+
+
+def main_bot_ingest(update_json: dict) -> bool:
+    """ What our bot's updates need before teleflask gets them. Returns `True` if that was all. """
+    return learn_member_update(update_json) or hub_ingest(update_json)
+# end def
+
+
+def left_to_hub(registration: Registration, msg: TGMessage) -> bool:
+    """
+    Hub mode: if our bot echoes that post of the owner, because it is in that chat as well.
+    Asks telegram if we don't know that yet, the prefilter only drops them if we do.
+    """
+    if not chat_members or not msg.from_peer or msg.from_peer.id != registration.owner_id:
+        return False
+    # end if
+    rmsg = msg.reply_to_message
+    if not msg.media_group_id and rmsg and rmsg.from_peer and rmsg.from_peer.id == registration.bot_id:
+        return False  # our bot leaves those to the RP bot, it may not even get them.
+    # end if
+    main_bot_id = bot_id_from_api_key(API_KEY)
+    return chat_members.check(msg.chat.id, main_bot_id, lambda: bot.bot.do('getChatMember', chat_id=msg.chat.id, user_id=main_bot_id)) is True
+# end def
+
+
+def rp_bot_in_chat(registration: Registration, chat_id: int) -> bool:
+    """ If the RP bot is in that chat, so it can echo there. Asks telegram if we don't know that yet. """
+    rp_bot = bot_pool.get(registration.api_key)
+    return chat_members.check(chat_id, registration.bot_id, lambda: rp_bot.do('getChatMember', chat_id=chat_id, user_id=registration.bot_id)) is True
+# end def
+
+
+def hub_ingest(update_json: dict) -> bool:
+    """
+    Hub mode: our bot gets every group message once, and hands the posts of owners to the RP bot whose prefix they start with.
+    Checks the raw json first, like :func:`drop_update`, as most of it is chatter of people without RP bots.
+    Returns `True` if that was all, i.e. it isn't a command for our bot.
+    """
+    if not hub_index:
+        return False
+    # end if
+    chat_id = group_chat_of(update_json)
+    if chat_id is None:
+        return False
+    # end if
+    chat_members.seen(chat_id, bot_id_from_api_key(API_KEY))
+    message = update_json['message']
+    text = message.get('text') or message.get('caption') or ''
+    if hub_index.owns(message.get('from', {}).get('id')) and (text or message.get('media_group_id')):
+        hub_dispatch(TGMessage.from_array(message))
+    # end if
+    return not text.startswith('/')
+# end def
+
+
+def hub_dispatch(msg: TGMessage):
+    """
+    Hands the post of an owner to our bot's line in that chat, see :func:`hub_echo`.
+    Albums are collected first, the prefix may be in the caption of any item.
+    """
+    if msg.media_group_id:
+        hub_albums.add((msg.from_peer.id, msg.chat.id, msg.media_group_id), msg)
+        hub_messages.inc(HUB_ALBUM)
+        return
+    # end if
+    if not hub_index.match(msg.from_peer.id, msg.text or msg.caption):
+        hub_messages.inc(HUB_NO_MATCH)
+        return
+    # end if
+    delayed_calls.submit(hub_line(msg.chat.id), send_logged, hub_echo, msg)
+# end def
+
+
+def hub_line(chat_id: int) -> tuple:
+    """
+    Where the hub posts of a chat wait in line: our bot's (bot, chat) of :data:`delayed_calls`.
+    So finding the bot (maybe asking telegram) happens in order and in the background, and the echoes get in line in that order.
+    """
+    return bot_id_from_api_key(API_KEY), chat_id
+# end def
+
+
+def hub_echo(msg: TGMessage):
+    """
+    Echoes the post of an owner with the matching RP bot in that chat. Posts replying to that bot are left to it, it gets them itself.
+    Matching bots not in that chat are skipped, their echo would fail while the original gets deleted.
+    """
+    # the same prefix may be in use by bots of other chats, so the longest prefix of a bot in here wins.
+    matches = hub_index.match(msg.from_peer.id, msg.text or msg.caption, usable=lambda registration: rp_bot_in_chat(registration, msg.chat.id))
+    if not matches:
+        hub_messages.inc(HUB_NOT_MEMBER)
+        return
+    # end if
+    rmsg = msg.reply_to_message
+    replied_to_id = rmsg.from_peer.id if rmsg and rmsg.from_peer else None
+    for registration in matches:
+        if registration.bot_id == replied_to_id:
+            hub_messages.inc(HUB_REPLY_TO_BOT)
+            continue
+        # end if
+        hub_messages.inc(HUB_ECHO)
+        stopwatch = update_seconds.time(BRANCH_IGNORED)
+        try:
+            process_public_chat(msg, registration.owner_id, registration.prefix, bot_pool.get(registration.api_key), stopwatch)
+        except Exception:
+            logger.exception(f'echoing a post for bot {registration.bot_id} failed.')
+        finally:
+            stopwatch.finish()
+        # end try
+    # end for
+# end def
+
+
+def open_hub_album(album: Album):
+    _, chat_id, _ = album.key
+    return delayed_calls.reserve(hub_line(chat_id))
+# end def
+
+
+def flush_hub_album(album: Album):
+    delayed_calls.fill(album.ticket, send_logged, hub_echo_album, album)
+# end def
+
+
+def hub_echo_album(album: Album):
+    """
+    Echoes an album of an owner with the bots of the longest prefix one of its captions starts with, of the ones in that chat.
+    Like with single posts, so overlapping prefixes (`a`, `ab`) don't make both bots echo it.
+    """
+    owner_id, chat_id, _ = album.key
+    messages = album.sorted_messages()
+    matches, prefixed = [], False
+    for msg in messages:
+        if msg.caption and hub_index.match(owner_id, msg.caption):
+            prefixed = True
+            matches = hub_index.match(owner_id, msg.caption, usable=lambda registration: rp_bot_in_chat(registration, chat_id))
+            if matches:
+                break
+            # end if
+        # end if
+    # end for
+    if not matches:
+        if prefixed:
+            hub_messages.inc(HUB_NOT_MEMBER)
+        else:
+            albums_flushed.inc(ALBUM_NO_PREFIX)
+        # end if
+        return
+    # end if
+    for registration in matches:
+        hub_messages.inc(HUB_ECHO)
+        send_later(registration.bot_id, chat_id, echo_album, registration.api_key, registration.prefix, chat_id, messages)
+    # end for
+# end def
+
+
+hub_albums = AlbumBuffer(window=ALBUM_WINDOW, flush=flush_hub_album, start=open_hub_album)
+
+
+def reply_or_execute(allow_webhook_reply: bool, reply: WebhookReply) -> Union[str, WebhookReply]:
+    """ Returns the call as webhook reply if allowed, otherwise does it right away, or in line with the chat if rate limited. """
+    if allow_webhook_reply:
+        return reply
+    # end if
+    if RateLimiter.is_limited(reply.api_method):
+        send_later(reply.rp_bot.bot_id, reply.params.get('chat_id'), reply.execute)
+    else:
+        reply.execute()
+    # end if
+    return 'OK'
+# end def
+
+
+def spool_route(registration: Registration) -> dict:
+    """ What the spool needs to find the registration again. """
+    if registrations.get(registration.token) is registration:
+        return {'token': registration.token}
+    # end if
+    # not in the store, so we have to keep everything.
+    return {'owner_id': registration.owner_id, 'prefix': registration.prefix, 'api_key': registration.api_key}
+# end def
+
+
+def spool_partition_key(route: dict, update_json: dict) -> tuple:
+    """ The posts of a chat have to stay in order, other chats can go meanwhile. """
+    return route.get('token') or route.get('api_key') or route.get('base64_api_key'), chat_of(update_json)
+# end def
+
+
+def process_spooled_update(route: dict, update_json: dict):
+    if 'token' in route:
+        registration = registrations.get(route['token'])
+        if not registration:
+            logger.warning('dropping spooled update of a bot not registered anymore.')
+            return
+        # end if
+    elif 'base64_api_key' in route:
+        # spooled before the registration store existed.
+        registration, reason = legacy_registration(
+            route['admin_user_id'], n(urlsafe_b64decode(route['base64_prefix'])), n(urlsafe_b64decode(b(route['base64_api_key']))),
+        )
+        if reason:
+            logger.warning(f'dropping spooled update of an old style webhook url: {reason}.')
+            return
+        # end if
+    else:
+        registration = Registration.new(owner_id=route['owner_id'], prefix=route['prefix'], api_key=route['api_key'])
     # end if
+    process_update(registration, update_json, allow_webhook_reply=False)
+# end def
 
-    assert update.message
-    msg: TGMessage = update.message
 
-    if msg.chat.type == 'private':
-        return process_private_chat(update, admin_user_id, prefix, rp_bot)
-    # end if
-    if not msg.text and not msg.caption:
-        logger.info('not an message with text/caption')
-        return "OK"
-    # end if
+traffic_capture = None
+if CAPTURE_DIR:
+    traffic_capture = TrafficCapture(
+        CAPTURE_DIR, salt=CAPTURE_SALT.encode() if CAPTURE_SALT else None, max_bytes=CAPTURE_MAX_BYTES, max_files=CAPTURE_MAX_FILES,
+    )
+    traffic_capture.start()
+# end if
 
-    return process_public_chat(msg, admin_user_id, prefix, rp_bot)
-    # end def
-# end def
+
+update_spool = None
+if SPOOL_DIR:
+    update_spool = UpdateSpool(
+        SPOOL_DIR, handler=process_spooled_update, workers=SPOOL_WORKERS, fsync=SPOOL_FSYNC, partition_key=spool_partition_key,
+    )
+    update_spool.start()
+# end if
 
 
-def process_private_chat(update: Update, admin_user_id: int, prefix: str, rp_bot: Bot):
+def process_private_chat(update: Update, admin_user_id: int, prefix: str, rp_bot: Bot, stopwatch: Stopwatch, allow_webhook_reply: bool = False):
+    """
+    Greets, relays messages of users to the owner, and the owner's replies back.
+    All of it is sending, so it happens in line with the chat in the background, see :func:`send_later`.
+    """
     msg = update.message
     assert msg.chat.id == msg.from_peer.id
+    if msg.text and msg.text == '/start':
+        stopwatch.label(BRANCH_PRIVATE_START)
+    elif msg.from_peer.id != admin_user_id:
+        stopwatch.label(BRANCH_PRIVATE_RELAY)
+    else:
+        stopwatch.label(BRANCH_OWNER_REPLY)
+    # end if
     logger.debug(
         f'message user: {msg.from_peer.id}, admin user: {admin_user_id}, has forward: {msg.reply_to_message is not None}'
     )
     if msg.text and msg.text == '/start':
         # somebody typed the /start command - that is either the owner or the user.
         logger.debug('somebody typed the /start command.')
-        if msg.chat.id == admin_user_id:
-            # owner started the bot
-            send_msg = HTMLMessage(
-                f'<i>Greetings.\n'
-                f'This is your own bot, set up with the prefix {escape(prefix)!r}.\n'
-                f'Here I will forward you any messages from users writing to this bot directly.\n'
-                f'Reply to those messages to send them an answer.\n'
-                f'\n'
-                f'If it doesn\'t find the message you replied to (that is you didn\'t reply to any user, or the user\'s privacy settings disallow forwards) it will instead echo what you wrote.</i>'
-            )
-        else:
-            # other user started the bot
-            rp_me = rp_bot.get_me()
-            send_msg = HTMLMessage(
-                f'<i>Greetings.\n'
-                f'Your communication with the owner of this <b>{escape(rp_me.first_name)!r}</b> bot is now ready.</i>\n'
-                f'<i>PS: You can set up your own roleplay proxy with</i> @{bot.username}<i>.</i>'
-            )
-        # end if
-        reply_chat, reply_msg = bot.msg_get_reply_params(update)
-        # noinspection PyProtectedMember
-        send_msg._apply_update_receiver(receiver=reply_chat, reply_id=reply_msg)
-        try:
-            send_msg.send(rp_bot)
-        except TgApiServerException as e:
-            logger.warning('failed to post /start greeting message.', exc_info=True)
-            try:
-                bot.send_message(HTMLMessage(f'Someone tried to PM you via @{rp_bot.username}. Please make sure you send <code>/start</code> to your bot for this feature to work.'), reply_chat=admin_user_id, reply_msg=None)
-            except TgApiServerException as e:
-                logger.warning('failed to report fail of /start greeting message.', exc_info=True)
-                return 'OKish'
-            # end try
-        # end try
+        send_later(rp_bot.bot_id, msg.chat.id, greet, update, admin_user_id, prefix, rp_bot)
     # end if
     if msg.from_peer.id != admin_user_id:
         # other user want to send something to us.
         logger.debug('other user want to send something to us.')
-        fwd_msg = None
+        send_later(rp_bot.bot_id, admin_user_id, relay_to_owner, msg, admin_user_id, rp_bot)
+    else:
+        # we wrote the bot
+        logger.debug('owner wrote the bot.')
+        send_later(rp_bot.bot_id, admin_user_id, relay_owner_reply, msg, rp_bot)
+    # end if
+    return 'OK'
+# end def
+
+
+def greet(update: Update, admin_user_id: int, prefix: str, rp_bot: Bot):
+    """ Answers /start, in the private chat with the owner or a user. """
+    msg = update.message
+    if msg.chat.id == admin_user_id:
+        # owner started the bot
+        send_msg = html_message(
+            f'<i>Greetings.\n'
+            f'This is your own bot, set up with the prefix {escape(prefix)!r}.\n'
+            f'Here I will forward you any messages from users writing to this bot directly.\n'
+            f'Reply to those messages to send them an answer.\n'
+            f'\n'
+            f'If it doesn\'t find the message you replied to (that is you didn\'t reply to any user, or the user\'s privacy settings disallow forwards) it will instead echo what you wrote.</i>'
+        )
+    else:
+        # other user started the bot
+        rp_me = identity_cache.get(rp_bot)
+        send_msg = html_message(
+            f'<i>Greetings.\n'
+            f'Your communication with the owner of this <b>{escape(rp_me.first_name)!r}</b> bot is now ready.</i>\n'
+            f'<i>PS: You can set up your own roleplay proxy with</i> @{bot.username}<i>.</i>'
+        )
+    # end if
+    reply_chat, reply_msg = bot.msg_get_reply_params(update)
+    # noinspection PyProtectedMember
+    send_msg._apply_update_receiver(receiver=reply_chat, reply_id=reply_msg)
+    try:
+        send_msg.send(rp_bot)
+    except TgApiServerException as e:
+        logger.warning('failed to post /start greeting message.', exc_info=True)
         try:
-            fwd_msg = rp_bot.forward_message(admin_user_id, from_chat_id=msg.chat.id, message_id=msg.message_id)
+            bot.send_message(html_message(f'Someone tried to PM you via @{identity_cache.get(rp_bot).username}. Please make sure you send <code>/start</code> to your bot for this feature to work.'), reply_chat=admin_user_id, reply_msg=None)
         except TgApiServerException as e:
-            logger.warning('failed to forward message.', exc_info=True)
-            try:
-                bot.send_message(HTMLMessage(f'Someone tried to PM you via @{rp_bot.username}. Please make sure you send <code>/start</code> to your bot for this feature to work.'), reply_chat=admin_user_id, reply_msg=None)
-            except TgApiServerException as e:
-                logger.warning('failed to report fail of forward message.', exc_info=True)
-                return 'OKish'
-            # end try
+            logger.warning('failed to report fail of /start greeting message.', exc_info=True)
         # end try
-        if fwd_msg is None or fwd_msg.forward_from is None:
-            logger.debug(f'detected anon forward: {msg.chat.id}')
-            # only log it, we send the anon reply thing in any case.
-        # end if
-        user_name = ""
-        user_name += msg.from_peer.first_name if msg.from_peer.first_name else ""
-        user_name += " "
-        user_name += msg.from_peer.last_name if msg.from_peer.last_name else ""
-        user_name = user_name.strip()
+    # end try
+# end def
+
+
+def relay_to_owner(msg: TGMessage, admin_user_id: int, rp_bot: Bot):
+    """ Forwards the message of a user to the owner, with a notice who sent it, and remembers them for the owner's replies. """
+    fwd_msg = None
+    try:
+        fwd_msg = rp_bot.forward_message(admin_user_id, from_chat_id=msg.chat.id, message_id=msg.message_id)
+    except TgApiServerException as e:
+        logger.warning('failed to forward message.', exc_info=True)
+        try:
+            bot.send_message(html_message(f'Someone tried to PM you via @{identity_cache.get(rp_bot).username}. Please make sure you send <code>/start</code> to your bot for this feature to work.'), reply_chat=admin_user_id, reply_msg=None)
+        except TgApiServerException as e:
+            logger.warning('failed to report fail of forward message.', exc_info=True)
+            return
+        # end try
+    # end try
+    if fwd_msg is None or fwd_msg.forward_from is None:
+        logger.debug(f'detected anon forward: {msg.chat.id}')
+        # only log it, we send the anon reply thing in any case.
+    # end if
+    user_name = ""
+    user_name += msg.from_peer.first_name if msg.from_peer.first_name else ""
+    user_name += " "
+    user_name += msg.from_peer.last_name if msg.from_peer.last_name else ""
+    user_name = user_name.strip()
 
+    relayed_message_ids = [fwd_msg.message_id] if fwd_msg else []
+    if RELAY_NOTICE:
         try:
-            rp_bot.send_message(
+            notice_msg = rp_bot.send_message(
                 chat_id=admin_user_id,
                 text=build_reply_message(msg.chat.id, user_name, msg.from_peer.username),
                 parse_mode='html',
                 reply_to_message_id=fwd_msg.message_id if fwd_msg else None,
             )
+            relayed_message_ids.append(notice_msg.message_id)
         except TgApiServerException as e:
             logger.warning('failed to post anon_reply message.', exc_info=True)
         # end try
-    else:
-        # we wrote the bot
-        logger.debug('owner wrote the bot.')
-        user_id_holder = Holder()
-        copy = None
-        send_to_self = False
-        try:
-            if msg.reply_to_message and msg.reply_to_message.forward_from:
-                # we replied to a forwarded message.
-                logger.debug('owner replied to message.')
-                copy = copy_message(chat_id=msg.reply_to_message.forward_from.id, msg=msg, reply_to_message_id=None, rp_bot=rp_bot)
-            elif msg.reply_to_message and user_id_holder(detect_anon_user_id(msg.reply_to_message)):
-                logger.debug('owner replied to anon_reply message.')
-                copy = copy_message(chat_id=user_id_holder.get(), msg=msg, reply_to_message_id=None, rp_bot=rp_bot)
-            else:
-                # we wrote the bot, not as reply -> return as if prefixed.
-                logger.debug('owner wrote the bot, not as reply -> return as if prefixed.')
-                copy = copy_message(chat_id=msg.from_peer.id, msg=msg, reply_to_message_id=msg.message_id, rp_bot=rp_bot)
-                send_to_self = True
-            # end if
-        except:
-            logger.warning('reply forward message failed.', exc_info=True)
-        # end try
+    # end if
+    # so replies of the owner find the user, no matter the privacy settings.
+    relay_index.remember(rp_bot.bot_id, relayed_message_ids, msg.chat.id)
+# end def
 
-        try:
-            rp_bot.send_message(
-                chat_id=msg.chat.id,
-                text=("<i>Reply sent to user.</i>" if not send_to_self else "<i>Reply not found, not sent.</i>") if copy else '<i>Failed to send to user.</i>',
-                parse_mode='html',
-                disable_notification=True, reply_to_message_id=msg.message_id,
-            )
-        except:
-            logger.warning('reply success message failed.', exc_info=True)
-        # end try
+
+def relay_owner_reply(msg: TGMessage, rp_bot: Bot):
+    """ Sends what the owner wrote to the user they replied to, or back to them, and tells them how that went. """
+    user_id_holder = Holder()
+    copy = None
+    send_to_self = False
+    try:
+        if msg.reply_to_message and user_id_holder(relay_index.lookup(rp_bot.bot_id, msg.reply_to_message.message_id)):
+            # we replied to a message we relayed.
+            logger.debug('owner replied to relayed message.')
+            relay_lookups.inc(SOURCE_INDEX)
+            copy = copy_message(chat_id=user_id_holder.get(), msg=msg, reply_to_message_id=None, rp_bot=rp_bot)
+        elif msg.reply_to_message and msg.reply_to_message.forward_from:
+            # we replied to a forwarded message.
+            logger.debug('owner replied to message.')
+            relay_lookups.inc(SOURCE_FORWARD)
+            copy = copy_message(chat_id=msg.reply_to_message.forward_from.id, msg=msg, reply_to_message_id=None, rp_bot=rp_bot)
+        elif msg.reply_to_message and user_id_holder(detect_anon_user_id(msg.reply_to_message)):
+            logger.debug('owner replied to anon_reply message.')
+            relay_lookups.inc(SOURCE_NOTICE)
+            copy = copy_message(chat_id=user_id_holder.get(), msg=msg, reply_to_message_id=None, rp_bot=rp_bot)
+        else:
+            if msg.reply_to_message:
+                relay_lookups.inc(SOURCE_NONE)
+            # end if
+            # we wrote the bot, not as reply -> return as if prefixed.
+            logger.debug('owner wrote the bot, not as reply -> return as if prefixed.')
+            copy = copy_message(chat_id=msg.from_peer.id, msg=msg, reply_to_message_id=msg.message_id, rp_bot=rp_bot)
+            send_to_self = True
         # end if
-    # end if
-    return 'OK'
+    except:
+        logger.warning('reply forward message failed.', exc_info=True)
+    # end try
+
+    try:
+        rp_bot.send_message(
+            chat_id=msg.chat.id,
+            text=("<i>Reply sent to user.</i>" if not send_to_self else "<i>Reply not found, not sent.</i>") if copy else '<i>Failed to send to user.</i>',
+            parse_mode='html',
+            disable_notification=True, reply_to_message_id=msg.message_id,
+        )
+    except:
+        logger.warning('reply success message failed.', exc_info=True)
+    # end try
 # end def
 
 
-def process_public_chat(msg: TGMessage, admin_user_id: int, prefix: str, rp_bot: Bot):
-    rp_bot_id = int(rp_bot.api_key.split(":")[0])
+def process_public_chat(msg: TGMessage, admin_user_id: int, prefix: str, rp_bot: Bot, stopwatch: Stopwatch, allow_webhook_reply: bool = False):
+    rp_bot_id = bot_id_from_api_key(rp_bot.api_key)
     rmsg = msg.reply_to_message
 
     if msg.from_peer.id != admin_user_id:
         # if someone replied to us, notify the owner.
         if rmsg and rmsg.from_peer and rmsg.from_peer.id == rp_bot_id:
             # is indeed a reply to this bot.
+            stopwatch.label(BRANCH_REPLY_NOTIFICATION)
+            inline_answers.remember_message(rp_bot_id, LastMessage(
+                chat_id=msg.chat.id, user_id=msg.from_peer.id, name=msg.from_peer.first_name, message_id=msg.message_id,
+                text=msg.text or msg.caption or '',
+            ))
             logger.debug(f'is reply: from {msg.from_peer.id!r} to bot {rp_bot_id!r} of user {admin_user_id!r}.')
             chat_html = format_chat(msg.chat)
             user_html = format_user(
@@ -275,14 +1064,7 @@ def process_public_chat(msg: TGMessage, admin_user_id: int, prefix: str, rp_bot:
                 message_text = f'{message_text}.'
             # end if
 
-            try:
-                rp_bot.send_message(
-                    chat_id=admin_user_id,
-                    text=message_text, parse_mode='html',
-                )
-            except:
-                logger.warning('failed to notify about reply', exc_info=True)
-            # end try
+            send_later(rp_bot_id, admin_user_id, rp_bot.send_message, chat_id=admin_user_id, text=message_text, parse_mode='html')
             return 'OK'
         # end if
         logger.info(f'not an message of an legit user: is {msg.from_peer.id!r}, should be {admin_user_id!r}.')
@@ -298,18 +1080,16 @@ def process_public_chat(msg: TGMessage, admin_user_id: int, prefix: str, rp_bot:
     message_id = msg.message_id
     reply_to_message_id = rmsg.message_id if rmsg else None
 
-    if text.startswith('/delete') or text.startswith('/edit'):
+    kind, command_text = identity_cache.get(rp_bot).matcher(prefix).classify(text)  # the username is in the commands.
+    if kind in (KIND_DELETE, KIND_EDIT, KIND_EDIT_EMPTY, KIND_OTHER_COMMAND):
         if not rmsg or not rmsg.from_peer or not rmsg.from_peer.id == rp_bot_id:
             logger.info(f'text is a \'/delete\' or \'/edit\' command, but reply is not existent or that message is not from  this bot ({rp_bot_id}): {text!r}')
             # TODO: maybe yell "reply this to a valid command", if it was not replied to something?
             return 'OK'  # not relevant
         # end if
 
-        if text.startswith('/delete') and (
-            text == '/delete' or
-            text.startswith('/delete ') or
-            (text.startswith('/delete@') and text.startswith(f'/delete@{rp_bot.username}'))  # rp_bot.username is a costly API operation, so only do that if really needed.
-        ):
+        if kind == KIND_DELETE:
+            stopwatch.label(BRANCH_DELETE)
             try:
                 rp_bot.delete_message(
                     message_id=rmsg.message_id, chat_id=chat_id,
@@ -320,95 +1100,341 @@ def process_public_chat(msg: TGMessage, admin_user_id: int, prefix: str, rp_bot:
             failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something='/delete message')
             return 'OK'  # we're done
         # end if
-        if text == '/edit':
+        if kind == KIND_EDIT_EMPTY:
             # TODO: send 'You can't edit to empty, use /delete to delete.'
             return 'OK'
-        if text.startswith('/edit') and (
-            text.startswith('/edit ') or
-            (text.startswith('/edit@') and text.startswith(f'/edit@{rp_bot.username} '))  # rp_bot.username is a costly API operation, so only do that if really needed.
-        ):
-            text = text.split(' ', maxsplit=1)[1].strip()  # remove the '/edit ' part of '/edit foo', including any following leading whitespaces.
-            fake_reply = ''  # TODO: keep old reply.
+        if kind == KIND_EDIT:
+            stopwatch.label(BRANCH_EDIT)
+            text = command_text  # without the '/edit ' part of '/edit foo', including any following leading whitespaces.
 
-            try:
-                if rmsg.text:
-                    # text message
-                    rp_bot.edit_message_text(
-                        text=fake_reply + escape(text), parse_mode='html',
-                        message_id=rmsg.message_id, chat_id=chat_id,
-                    )
-                elif rmsg.caption or rmsg.photo or rmsg.document:
-                    rp_bot.edit_message_caption(
-                        caption=fake_reply + escape(text), parse_mode='html',
-                        message_id=rmsg.message_id, chat_id=chat_id,
-                    )
+            def edit() -> bool:
+                sent = sent_messages.get(chat_id, rmsg.message_id)
+                if sent:
+                    return edit_sent(rp_bot, chat_id, sent, escape(text))
                 # end if
-                failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something='/edit message')
-                return 'OK'  # we're done
-            except:
-                logger.warning('edit failed', exc_info=True)
-                return 'OK'  # at least we tried...
-            # end if
+                # not remembered (anymore), so without its fake reply.
+                try:
+                    if rmsg.text:
+                        # text message
+                        rp_bot.edit_message_text(
+                            text=escape(text), parse_mode='html',
+                            message_id=rmsg.message_id, chat_id=chat_id,
+                        )
+                    elif rmsg.caption or rmsg.photo or rmsg.document:
+                        rp_bot.edit_message_caption(
+                            caption=escape(text), parse_mode='html',
+                            message_id=rmsg.message_id, chat_id=chat_id,
+                        )
+                    # end if
+                    return True
+                except:
+                    logger.warning('edit failed', exc_info=True)
+                    return False  # at least we tried...
+                # end try
+            # end def
+
+            # quick corrections of the same post end up as a single edit.
+            edit_coalescer.submit(
+                key=(rp_bot.api_key, chat_id, rmsg.message_id), order=message_id, command_message_id=message_id, edit=edit,
+            )
+            return 'OK'  # the rest happens when the edit is flushed.
+        # end if
+        if text.startswith(prefix):
+            # some other command, which happens to be the prefix as well.
+            kind, command_text = KIND_PREFIX, text[len(prefix):].strip()
         # end if
     # end if
 
     # now we have the commands done, it's all about posting a new post.
-    if not text.startswith(prefix):
+    if kind != KIND_PREFIX:
         # not a suffix, so no posting.
         logger.info(f'text has not the required prefix {prefix!r}: {text!r}')
         return "OK"
     # end if
 
-    fake_reply = ''
-    if rmsg.from_peer.is_bot and rmsg.from_peer.id != rp_bot_id if rmsg else False:
-        fake_reply = build_fake_reply(chat_id=chat_id if rmsg.chat.type == 'supergroup' else None, user_id=rmsg.from_peer.id, name=rmsg.from_peer.first_name, reply_id=reply_to_message_id, old_text=rmsg.caption if rmsg.caption else rmsg.text)
-    # end if
+    fake_reply = fake_reply_to(chat_id, rmsg, rp_bot_id)
 
-    # remove the prefix from the text
-    text = text[len(prefix):].strip()
-    message_echo_and_delete_original(chat_id, message_id, msg, reply_to_message_id, rp_bot, fake_reply + escape(text))
-    return "OK"
+    # the prefix is already removed from the text
+    stopwatch.label(BRANCH_PUBLIC_PREFIX)
+    text = command_text
+    return message_echo_and_delete_original(
+        chat_id, message_id, msg, reply_to_message_id, rp_bot, fake_reply + escape(text),
+        # with a webhook reply we'd never learn the message id, and /edit would lose the fake reply.
+        allow_webhook_reply=allow_webhook_reply and not fake_reply, fake_reply=fake_reply,
+    )
 # end def
 
 
-def message_echo_and_delete_original(chat_id, message_id, msg, reply_to_message_id, rp_bot, html_text):
+def edit_sent(rp_bot: Bot, chat_id, sent: SentMessage, html_body: str) -> bool:
+    """ Edits a message we echoed to the new body, keeping its fake reply. """
     try:
-        copy_message(chat_id, msg, reply_to_message_id, rp_bot, html_text)
-    except TgApiServerException as e:
-        logger.warn('sending failed', exc_info=True)
+        if sent.kind == SENT_TEXT:
+            rp_bot.edit_message_text(text=sent.header + html_body, parse_mode='html', message_id=sent.message_id, chat_id=chat_id)
+        elif sent.kind in SENT_CAPTION_KINDS:
+            rp_bot.edit_message_caption(caption=sent.header + html_body, parse_mode='html', message_id=sent.message_id, chat_id=chat_id)
+        else:
+            return True  # stickers and the like have nothing to edit, but the /edit commands still get cleaned up.
+        # end if
+    except:
+        logger.warning('edit failed', exc_info=True)
+        return False  # at least we tried...
     # end try
-    failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something='original message')
+    sent.body = html_body
+    return True
 # end def
 
 
-def failsafe_multibot_delete(rp_bot, message_id, chat_id, of_something='message'):
-    try:
-        bot.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except TgApiServerException as e:
-        logger.debug(f'deletion of {of_something} with bot.bot failed', exc_info=True)
-    # end try
+def html_message(text: str, **kwargs):
+    """ teleflask's `HTMLMessage`. Its module takes a good part of the startup time to import, so only on first use. """
+    from teleflask.messages import HTMLMessage
+    return HTMLMessage(text, **kwargs)
+# end def
+
+
+def fake_reply_to(chat_id, rmsg: Union[TGMessage, None], rp_bot_id: int) -> str:
+    """ Replies to other bots get lost when echoing, so the post gets a header looking like one. """
+    if rmsg.from_peer.is_bot and rmsg.from_peer.id != rp_bot_id if rmsg else False:
+        return build_fake_reply(chat_id=chat_id if rmsg.chat.type == 'supergroup' else None, user_id=rmsg.from_peer.id, name=rmsg.from_peer.first_name, reply_id=rmsg.message_id, old_text=rmsg.caption if rmsg.caption else rmsg.text)
+    # end if
+    return ''
+# end def
+
+
+def open_album(album: Album):
+    """ Keeps the album's place in line, so later posts of that chat wait until it is echoed. """
+    api_key, _, chat_id, _ = album.key
+    return delayed_calls.reserve((bot_id_from_api_key(api_key), chat_id))
+# end def
+
+
+def flush_album(album: Album):
+    """ The album is complete, its echo takes the place in line it got when it started. """
+    api_key, prefix, chat_id, _ = album.key
+    delayed_calls.fill(album.ticket, send_logged, echo_album, api_key, prefix, chat_id, album.sorted_messages())
+# end def
+
+
+def echo_album(api_key: str, prefix: str, chat_id: int, messages: List[TGMessage]):
+    """
+    Echoes an album, if one of its captions has the prefix, as one album again, and deletes the original.
+    Already in line with the other posts of that chat, so everything is sent right here.
+    """
+    rp_bot = bot_pool.get(api_key)
+    rp_identity = identity_cache.get(rp_bot)
+    caption_msg, command_text = None, None
+    for msg in messages:
+        if msg.caption:
+            kind, command_text = rp_identity.matcher(prefix).classify(msg.caption)
+            if kind == KIND_PREFIX:
+                caption_msg = msg
+                break
+            # end if
+        # end if
+    # end for
+    if caption_msg is None:
+        albums_flushed.inc(ALBUM_NO_PREFIX)
+        return
+    # end if
+    rmsg = caption_msg.reply_to_message
+    fake_reply = fake_reply_to(chat_id, rmsg, bot_id_from_api_key(api_key))
+    html_caption = fake_reply + escape(command_text)
+    media = [input_media(msg, html_caption if msg is caption_msg else None) for msg in messages]
+    if len(messages) < 2 or None in media:
+        # not a complete album (anymore), or something sendMediaGroup can't send.
+        albums_flushed.inc(ALBUM_ONE_BY_ONE)
+        for msg in messages:
+            try:
+                copy_message(
+                    chat_id, msg, rmsg.message_id if rmsg else None, rp_bot, html_caption if msg is caption_msg else None,
+                    fake_reply=fake_reply if msg is caption_msg else '',
+                )
+            except TgApiServerException as e:
+                logger.warning('sending an album item failed', exc_info=True)
+            # end try
+        # end for
+        failsafe_multibot_delete_many(rp_bot, [msg.message_id for msg in messages], chat_id, of_something='original album')
+        return
+    # end if
+    albums_flushed.inc(ALBUM_ECHOED)
+    timer = CallTimer('album_echo_and_delete')
+    echo = fan_out.submit(
+        timer.timed(rp_bot.send_media_group),
+        chat_id=chat_id, media=media, reply_to_message_id=rmsg.message_id if rmsg else None,
+    )
+    failsafe_multibot_delete_many(rp_bot, [msg.message_id for msg in messages], chat_id, of_something='original album')
     try:
-        rp_bot.delete_message(chat_id=chat_id, message_id=message_id)
+        for sent, item in zip(echo.result(), media):
+            header = fake_reply if item.caption else ''
+            sent_messages.add(chat_id, SentMessage(sent.message_id, header, (item.caption or '')[len(header):], item.type))
+        # end for
     except TgApiServerException as e:
-        logger.debug(f'deletion of {of_something} with rp_bot failed', exc_info=True)
+        logger.warning('sending the album failed', exc_info=True)
     # end try
+    timer.finish()
+# end def
+
+
+album_buffer = AlbumBuffer(window=ALBUM_WINDOW, flush=flush_album, start=open_album)
+
+
+def message_echo_and_delete_original(chat_id, message_id, msg, reply_to_message_id, rp_bot, html_text, allow_webhook_reply=False, fake_reply=''):
+    if allow_webhook_reply:
+        # telegram sends the echo for us, we only have to take care of the deletion.
+        echo = copy_message(chat_id, msg, reply_to_message_id, rp_bot, html_text, as_webhook_reply=True)
+        failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something='original message')
+        return echo if echo else "OK"
+    # end if
+    timer = CallTimer('echo_and_delete')
+    # echo and deletion don't depend on each other, so they can happen at the same time.
+    # the echo waits in line with the earlier posts of that chat, for the rate limit.
+    echo = send_later(
+        rp_bot.bot_id, chat_id, timer.timed(copy_message), chat_id, msg, reply_to_message_id, rp_bot, html_text, fake_reply=fake_reply,
+    )
+    failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something='original message', timer=timer)
+    echo.add_done_callback(lambda _: timer.finish())  # once both are done.
+    return "OK"
+# end def
+
+
+def flush_edit(pending: PendingEdit):
+    """ Sends the newest of the coalesced edits, in line with the other posts of that chat. """
+    api_key, chat_id, _ = pending.key
+    rp_bot = bot_pool.get(api_key)
+    send_later(rp_bot.bot_id, chat_id, edit_and_clean_up, pending, rp_bot)
+# end def
+
+
+def edit_and_clean_up(pending: PendingEdit, rp_bot: Bot):
+    """ Does the edit, and cleans up all the `/edit` commands. """
+    _, chat_id, _ = pending.key
+    if pending.edit and not pending.edit():
+        return  # keep the commands, so the user sees it didn't work.
+    # end if
+    failsafe_multibot_delete_many(
+        rp_bot=rp_bot, message_ids=pending.command_message_ids, chat_id=chat_id, of_something='/edit messages',
+    )
+# end def
+
+
+edit_coalescer = EditCoalescer(window=EDIT_COALESCE_WINDOW, flush=flush_edit)
+
+
+def failsafe_multibot_delete_many(rp_bot, message_ids: List[int], chat_id, of_something='messages') -> bool:
+    """
+    Like :func:`failsafe_multibot_delete`, but deleting many messages of a chat at once with `deleteMessages`.
+    Bot api servers not knowing that method yet get them deleted one by one.
+    """
+    if len(message_ids) == 1:
+        return failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_ids[0], chat_id=chat_id, of_something=of_something)
+    # end if
+
+    def delete_with(delete_bot, bot_id, bot_name, chunk):
+        try:
+            delete_bot.do('deleteMessages', chat_id=chat_id, message_ids=chunk)
+        except TgApiServerException as e:
+            delete_rights.learn_error(chat_id, bot_id, e)
+            logger.debug(f'deletion of {of_something} with {bot_name} failed', exc_info=True)
+            return False
+        # end try
+        delete_rights.learn(chat_id, bot_id, True)
+        return True
+    # end def
+
+    success = True
+    for i in range(0, len(message_ids), 100):  # telegram takes up to 100 at once.
+        chunk = message_ids[i:i + 100]
+        if delete_with_rights(chat_id, rp_bot, lambda delete_bot, bot_id, bot_name: delete_with(delete_bot, bot_id, bot_name, chunk)):
+            continue
+        # end if
+        for message_id in chunk:
+            success = failsafe_multibot_delete(rp_bot=rp_bot, message_id=message_id, chat_id=chat_id, of_something=of_something) and success
+        # end for
+    # end for
+    return success
+# end def
+
+
+def failsafe_multibot_delete(rp_bot, message_id, chat_id, of_something='message', timer: Union[CallTimer, None] = None):
+    """
+    Deletes a message with either our bot or the RP bot, whichever has the admin rights.
+    """
+    def delete_with(delete_bot, bot_id, bot_name):
+        try:
+            delete_bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except TgApiServerException as e:
+            delete_rights.learn_error(chat_id, bot_id, e)
+            logger.debug(f'deletion of {of_something} with {bot_name} failed', exc_info=True)
+            return False
+        # end try
+        delete_rights.learn(chat_id, bot_id, True)
+        return True
+    # end def
+    if timer:
+        delete_with = timer.timed(delete_with)
+    # end if
+    return delete_with_rights(chat_id, rp_bot, delete_with)
 # end def
 
 
-def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Union[str, None] = None):
+def delete_with_rights(chat_id, rp_bot, delete_with: Callable[[Bot, int, str], bool]) -> bool:
+    """
+    Calls `delete_with(bot, bot_id, bot_name)` with the bots which can delete in that chat, or might be able to.
+    Several of them race each other, the first success wins.
+    Should the one known to be able to fail, the others get their turn right away.
+    """
+    bots = {bot_id_from_api_key(API_KEY): (bot.bot, 'bot.bot'), bot_id_from_api_key(rp_bot.api_key): (rp_bot, 'rp_bot')}
+    tried = set()
+    plan = delete_rights.plan(chat_id, list(bots))
+    while plan:
+        tried.update(plan)
+        if fan_out.first_success(*(
+            lambda bot_id=bot_id: delete_with(bots[bot_id][0], bot_id, bots[bot_id][1]) for bot_id in plan
+        )):
+            return True
+        # end if
+        plan = [bot_id for bot_id in delete_rights.plan(chat_id, list(bots), count=False) if bot_id not in tried]
+    # end while
+    return False
+# end def
+
+
+def copy_message(
+    chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Union[str, None] = None, as_webhook_reply: bool = False,
+    fake_reply: str = '',
+):
+    """
+    Sends the content of `msg` again, with the `rp_bot`, and remembers it in `sent_messages` for later edits.
+    With `as_webhook_reply` it isn't sent, but returned as :class:`WebhookReply`.
+
+    :param fake_reply: the fake reply header `html_text` starts with.
+    """
+    call = build_copy_call(chat_id, msg, reply_to_message_id, rp_bot, html_text)
+    if call is None or as_webhook_reply:
+        return call
+    # end if
+    sent = call.execute()
+    html = call.params.get('text') or call.params.get('caption') or ''
+    sent_messages.add(chat_id, SentMessage(sent.message_id, fake_reply, html[len(fake_reply):], kind_of_method(call.method)))
+    return sent
+# end def
+
+
+def build_copy_call(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Union[str, None] = None) -> Union[WebhookReply, None]:
     if not html_text:
         html_text = msg.text if msg.text else msg.caption
-        html_text = escape(html_text)
+        html_text = escape(html_text) if html_text else None  # e.g. album items without caption.
     # end def
     if msg.text:
-        return rp_bot.send_message(
+        return WebhookReply(
+            rp_bot, 'send_message',
             text=html_text, parse_mode='html',
             chat_id=chat_id,
             disable_notification=False, reply_to_message_id=reply_to_message_id,
         )
     # end if
     if msg.photo:
-        return rp_bot.send_photo(
+        return WebhookReply(
+            rp_bot, 'send_photo',
             photo=msg.photo[0].file_id,
             chat_id=chat_id,
             caption=html_text, parse_mode='html',
@@ -416,7 +1442,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.sticker:
-        return rp_bot.send_sticker(
+        return WebhookReply(
+            rp_bot, 'send_sticker',
             sticker=msg.sticker.file_id,
             chat_id=chat_id,
             # caption=html_text, parse_mode='html',
@@ -424,7 +1451,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.animation:
-        return rp_bot.send_animation(
+        return WebhookReply(
+            rp_bot, 'send_animation',
             animation=msg.animation.file_id,
             chat_id=chat_id,
             caption=html_text, parse_mode='html',
@@ -432,7 +1460,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.video:
-        return rp_bot.send_video(
+        return WebhookReply(
+            rp_bot, 'send_video',
             video=msg.video.file_id,
             chat_id=chat_id,
             caption=html_text, parse_mode='html',
@@ -440,7 +1469,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.video_note:
-        return rp_bot.send_video_note(
+        return WebhookReply(
+            rp_bot, 'send_video_note',
             video_note=msg.video_note.file_id,
             chat_id=chat_id,
             # caption=html_text, parse_mode='html',
@@ -448,7 +1478,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.voice:
-        return rp_bot.send_voice(
+        return WebhookReply(
+            rp_bot, 'send_voice',
             voice=msg.voice.file_id,
             chat_id=chat_id,
             caption=html_text, parse_mode='html',
@@ -456,7 +1487,8 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
         )
     # end if
     if msg.document:
-        return rp_bot.send_document(
+        return WebhookReply(
+            rp_bot, 'send_document',
             document=msg.document.file_id,
             chat_id=chat_id,
             caption=html_text, parse_mode='html',
@@ -468,14 +1500,14 @@ def copy_message(chat_id, msg, reply_to_message_id, rp_bot: Bot, html_text: Unio
 
 @bot.command("start")
 def start(update, text):
-    return HTMLMessage('Hello. Do you seek /help?')
+    return html_message('Hello. Do you seek /help?')
 # end def
 
 
 @bot.command("help")
 def help_cmd(update: Update, text: str):
     assert isinstance(update, Update)
-    return HTMLMessage(
+    return html_message(
         'Go ahead, set up your bot you wanna use for RPing with @BotFather first:\n'
         '\n'
         '<b>1.</b> Write <code>/addbot</code> to @BotFather, set your <u>character\'s name</u> and then a <u>fitting username</u>.\n'
@@ -508,7 +1540,7 @@ def cmd_set_welcome(update, text):
     # end if
 
     if not text:
-        return HTMLMessage(
+        return html_message(
             "Please send your bot and prefix like this:\n"
             "<pre>/add_bot {API-KEY}\n"
             "{PREFIX}</pre>\n"
@@ -520,21 +1552,41 @@ def cmd_set_welcome(update, text):
         )
     # end if
     api_key, prefix = texts
-    prefix_based = n(urlsafe_b64encode(b(prefix)))
-    api_key_based = n(urlsafe_b64encode(b(api_key)))
-    rp_bot = Bot(api_key)
+    rp_bot = bot_pool.get(api_key)
     try:
         rp_me = rp_bot.get_me()
-        webhook_url = url_for('rp_bot_webhooks', admin_user_id=update.message.from_peer.id, base64_prefix=prefix_based, base64_api_key=api_key_based)
-        webhook_url = f"https://{HOSTNAME}{webhook_url}"
-        logger.debug(f'setting webhook to {webhook_url!r}')
-        rp_bot.set_webhook(webhook_url)
+        identity_cache.put(api_key, rp_me)  # fresh from the api, e.g. after a rename.
+        registration = Registration.new(
+            owner_id=update.message.from_peer.id, prefix=prefix, api_key=api_key, secret_token=new_secret_token(),
+        )
+        old = registrations.by_bot_id(registration.bot_id)
+        if UPDATE_MODE == 'polling':
+            logger.debug('not setting a webhook, the poller picks up the new bot.')
+        else:
+            # first the webhook, so a failure leaves the old registration working, telegram still uses its url.
+            webhook_url = rp_bot_webhook_url(registration.token)
+            logger.debug(f'setting webhook to {webhook_url!r}')
+            set_webhook(rp_bot, webhook_url, secret_token=registration.secret_token)
+        # end if
+        try:
+            registrations.save(registration)
+        except Exception:
+            logger.exception('storing the registration failed.')
+            if old and UPDATE_MODE != 'polling':
+                try:
+                    set_webhook(rp_bot, rp_bot_webhook_url(old.token), secret_token=old.secret_token)
+                except Exception:
+                    logger.exception('putting the old webhook back failed.')
+                # end try
+            # end if
+            return "Error: Could not store your bot, please try again later."
+        # end try
         return [
-            HTMLMessage(
+            html_message(
             f"Successfully registered {rp_me.first_name}.\n"
             f"Please now start your own bot (@{rp_me.username}) by sending <code>/start</code> to it.\n"
             ),
-            HTMLMessage(
+            html_message(
                 f"<b>How to use our bot @{rp_me.username} in groups</b> (The bot needs to be member of the group, additional admin to clean up your messages)\n"
                 f""
                 f"Start any message with <b>{escape(prefix)!r}</b> to have it be echoed by the bot.\n"
@@ -552,6 +1604,180 @@ def cmd_set_welcome(update, text):
 # end def
 
 
+def rp_bot_webhook_url(token: str) -> str:
+    """ Where telegram should send the updates of a registered RP bot. """
+    with app.test_request_context():  # works outside of requests too, e.g. from the fleet cli.
+        return f"https://{HOSTNAME}{url_for('rp_bot_webhook', token=token)}"
+    # end with
+# end def
+
+
+fleet = Fleet(concurrency=FLEET_CONCURRENCY, per_second=FLEET_PER_SECOND)
+fleet_running = Lock()  # one operation for all bots at a time is plenty.
+
+
+def fleet_set_webhook(registration: Registration) -> dict:
+    """ Bots without a secret token (the ones adopted from old style urls) get one. """
+    url = rp_bot_webhook_url(registration.token)
+    secret_token = registration.secret_token or new_secret_token()
+    set_webhook(bot_pool.get(registration.api_key), url, secret_token=secret_token)
+    if secret_token != registration.secret_token:
+        # telegram sends it from now on, so check it from now on.
+        registrations.save(Registration.from_document(dict(registration.to_document(), secret_token=secret_token)))
+    # end if
+    return {'url': url}
+# end def
+
+
+def fleet_webhook_info(registration: Registration) -> dict:
+    info = bot_pool.get(registration.api_key).get_webhook_info()
+    return {
+        'url': info.url, 'current': info.url == rp_bot_webhook_url(registration.token),
+        'pending_update_count': info.pending_update_count,
+        'last_error_date': info.last_error_date, 'last_error_message': info.last_error_message,
+    }
+# end def
+
+
+def set_all_webhooks(restart: bool = False) -> FleetReport:
+    """
+    Sets the webhook of every registered RP bot again, e.g. after `HOSTNAME` changed.
+    Bots done by an earlier, interrupted run for the same url are skipped, unless `restart` is set.
+    """
+    if UPDATE_MODE == 'polling':
+        raise ValueError('no webhooks to set, the bots are polled (UPDATE_MODE=polling).')
+    # end if
+    progress = FleetProgress(
+        registrations.store.collection.database['rp_bot_fleet'], f'set_webhook {rp_bot_webhook_url("")} {",".join(ALLOWED_UPDATES)}',
+        current=registrations.by_bot_id,  # with the secret token it may have gotten.
+    )
+    progress.ensure_indexes()
+    if restart:
+        progress.reset()
+    # end if
+    return fleet.run('set_webhook', registrations.all(), fleet_set_webhook, progress=progress)
+# end def
+
+
+def check_all_webhooks() -> FleetReport:
+    """ Asks telegram how the webhook of every registered RP bot is doing. """
+    return fleet.run('webhook_info', registrations.all(), fleet_webhook_info)
+# end def
+
+
+def format_fleet_report(report: FleetReport, limit: int = 30) -> str:
+    """ The summary, and the bots which failed or whose webhook has problems. """
+    lines = []
+    for result in report.results:
+        if not result.ok:
+            lines.append(f'<code>{result.bot_id}</code>: {escape(result.error)}')
+        elif result.result.get('last_error_message') or result.result.get('pending_update_count') or result.result.get('current') is False:
+            lines.append(
+                f'<code>{result.bot_id}</code>: {result.result["pending_update_count"]} pending'
+                + ('' if result.result['current'] else ', other url')
+                + (f', last error: {escape(result.result["last_error_message"])}' if result.result['last_error_message'] else '')
+            )
+        # end if
+    # end for
+    text = escape(report.summary())
+    if lines:
+        text += '\n\n' + '\n'.join(lines[:limit]) + (f'\n… and {len(lines) - limit} more.' if len(lines) > limit else '')
+    # end if
+    return text
+# end def
+
+
+def run_fleet_command(admin_user_id: int, operation: Callable[[], FleetReport]):
+    try:
+        text = format_fleet_report(operation())
+    except Exception as e:
+        logger.exception('fleet operation failed.')
+        text = f'Failed: {escape(str(e))}'
+    finally:
+        fleet_running.release()
+    # end try
+    bot.send_message(html_message(text), reply_chat=admin_user_id, reply_msg=None)
+# end def
+
+
+def start_fleet_command(update: Update, operation: Callable[[], FleetReport]):
+    if update.message.from_peer.id not in FLEET_ADMINS:
+        return None  # like an unknown command.
+    # end if
+    if not fleet_running.acquire(blocking=False):
+        return html_message('Still busy with the last one.')
+    # end if
+    Thread(target=run_fleet_command, args=(update.message.from_peer.id, operation), name='fleet', daemon=True).start()
+    return html_message(f'On it, {len(registrations)} bots. I\'ll report back.')
+# end def
+
+
+@bot.command("fleet_webhooks")
+def cmd_fleet_webhooks(update: Update, text: str):
+    """ Sets the webhooks of all RP bots again. `/fleet_webhooks restart` ignores the progress of an earlier run. """
+    restart = (text or '').strip() == 'restart'
+    return start_fleet_command(update, lambda: set_all_webhooks(restart=restart))
+# end def
+
+
+@bot.command("fleet_status")
+def cmd_fleet_status(update: Update, text: str):
+    """ Pending updates and last errors of the webhooks of all RP bots. """
+    return start_fleet_command(update, check_all_webhooks)
+# end def
+
+
+def polling_targets() -> Dict[int, str]:
+    """ Every registered RP bot, and our own. """
+    targets = {registration.bot_id: registration.api_key for registration in registrations.all()}
+    targets[bot_id_from_api_key(API_KEY)] = API_KEY
+    return targets
+# end def
+
+
+def process_polled_update(bot_id: int, update_json: dict):
+    if bot_id == bot_id_from_api_key(API_KEY):
+        if main_bot_ingest(update_json):
+            return
+        # end if
+        bot.process_update(Update.from_array(update_json))
+        return
+    # end if
+    registration = registrations.by_bot_id(bot_id)
+    if not registration:
+        logger.debug(f'dropping polled update of bot {bot_id}, it is not registered anymore.')
+        return
+    # end if
+    ingest_update(registration, update_json, allow_webhook_reply=False)
+# end def
+
+
+def run_polling():
+    """ Fetches the updates of all bots with long polling, instead of waiting for webhooks. Blocks forever. """
+    database = registrations.store.collection.database
+    offsets = OffsetStore(database['rp_bot_offsets'])
+    targets, on_stopped, leases = polling_targets, None, None
+    if POLL_CLUSTER:
+        # several of us, every bot gets polled by exactly one.
+        leases = BotLeases(database['rp_bot_nodes'], database['rp_bot_leases'], node_id=NODE_ID or default_node_id(), lease=POLL_LEASE)
+        leases.ensure_indexes()
+        targets, on_stopped = lambda: leases.wanted(polling_targets()), leases.release
+    # end if
+    poller = LongPoller(
+        targets=targets, handler=process_polled_update, offsets=offsets, api_url=TG_API_URL,
+        workers=POLL_WORKERS, min_timeout=POLL_TIMEOUT_MIN, max_timeout=POLL_TIMEOUT_MAX,
+        sync_interval=POLL_LEASE / 3 if POLL_CLUSTER else 10.0, on_stopped=on_stopped,
+    )
+    logger.info(f'polling the updates of {len(polling_targets())} bots' + (f', as node {leases.node_id}.' if leases else '.'))
+    try:
+        poller.run()
+    finally:
+        if leases:
+            leases.leave()
+        # end if
+    # end try
+# end def
+
 
 if __name__ == "__main__":  # no nginx
     # "__main__" means, this python file is called directly.
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect
+from collections import deque
+from concurrent.futures import Future
+from hashlib import blake2b
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable, Deque, Dict, Hashable, Iterable, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+partitioned_tasks = counter('partitioned_tasks_total', 'Updates handled by the partitioned executor')
+
+_STOP = object()
+_SKIP = object()
+
+
+def chat_of(update: dict) -> Union[int, None]:
+    """ Whose updates have to stay in order: the chat of a message, or the user of an inline query. """
+    message = update.get('message') or update.get('edited_message')
+    if message:
+        return (message.get('chat') or {}).get('id')
+    # end if
+    inline_query = update.get('inline_query')
+    if inline_query:
+        return (inline_query.get('from') or {}).get('id')
+    # end if
+    return None
+# end def
+
+
+def _hash(text: str) -> int:
+    """ Same in every process, unlike `hash()`. """
+    return int.from_bytes(blake2b(text.encode(), digest_size=8).digest(), 'big')
+# end def
+
+
+class HashRing(object):
+    """
+    Consistent hashing: every member gets `replicas` points on a ring, a key belongs to the member of the next point.
+    When a member joins or leaves, only the keys of its points move, everything else stays where it was.
+    Keys are hashed by their `str()`, so use ints, strings or tuples of those.
+    """
+    __slots__ = ('members', '_points', '_owners')
+
+    def __init__(self, members: Iterable[Hashable], replicas: int = 64):
+        self.members = sorted(set(members), key=str)
+        points = sorted((_hash(f'{member}#{i}'), str(member), member) for member in self.members for i in range(replicas))
+        self._points = [point for point, _, _ in points]
+        self._owners = [member for _, _, member in points]
+    # end def
+
+    def owner(self, key: Hashable):
+        """ The member the key belongs to, `None` if there are no members. """
+        if not self._points:
+            return None
+        # end if
+        return self._owners[bisect(self._points, _hash(str(key))) % len(self._points)]
+    # end def
+# end class
+
+
+class Slot(object):
+    """ A place in line for a task only known later, see :meth:`PartitionedExecutor.reserve`. """
+    __slots__ = ('key', 'task')
+
+    def __init__(self, key: Hashable, task=None):
+        self.key = key
+        self.task = task
+    # end def
+# end class
+
+
+class PartitionedExecutor(object):
+    """
+    Runs tasks on `partitions` threads, each with its own queue. Tasks with the same key always end up
+    on the same partition, so they run strictly one after another, in the order they were submitted;
+    tasks with different keys run in parallel (unless they happen to share a partition).
+
+    Use e.g. `(bot_id, chat_id)` as key, so the posts of a scene can't overtake each other,
+    while other chats don't have to wait for them.
+
+    A key can hold a place in line with :meth:`reserve`, for something which takes a while to be known (e.g. an album).
+    Tasks of that key submitted later wait until it is filled, without blocking a thread.
+    """
+    def __init__(self, partitions: int, name: str = 'partition'):
+        self.name = name
+        self._ring = HashRing(())
+        self._queues: Dict[int, Queue] = {}
+        self._pending: Dict[Hashable, int] = {}  # key -> tasks submitted but not done yet.
+        self._lines: Dict[Hashable, Deque[Slot]] = {}  # key -> tasks waiting for a reserved slot, the first one of them.
+        self._lock = Lock()
+        self.resize(partitions)
+    # end def
+
+    @property
+    def partitions(self) -> int:
+        return len(self._queues)
+    # end def
+
+    @property
+    def depth(self) -> int:
+        """ Tasks waiting, over all partitions. """
+        return sum(queue.qsize() for queue in self._queues.values())
+    # end def
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        future = Future()
+        task = (key, future, fn, args, kwargs)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            if key in self._lines:
+                self._lines[key].append(Slot(key, task))  # behind a reserved slot.
+            else:
+                self._queues[self._ring.owner(key)].put(task)
+            # end if
+        # end with
+        return future
+    # end def
+
+    def reserve(self, key: Hashable) -> Slot:
+        """ A place in line for a task of that key, see :meth:`fill`. Everything submitted after it waits for that. """
+        slot = Slot(key)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            self._lines.setdefault(key, deque()).append(slot)
+        # end with
+        return slot
+    # end def
+
+    def fill(self, slot: Slot, fn: Union[Callable, None], *args, **kwargs) -> Union[Future, None]:
+        """ Puts the task in its reserved place, or gives that up with `fn=None`. Then the ones waiting for it go as well. """
+        future = Future() if fn else None
+        with self._lock:
+            slot.task = (slot.key, future, fn, args, kwargs) if fn else _SKIP
+            line = self._lines[slot.key]
+            while line and line[0].task is not None:
+                task = line.popleft().task
+                if task is _SKIP:
+                    self._done_locked(slot.key)
+                else:
+                    self._queues[self._ring.owner(slot.key)].put(task)
+                # end if
+            # end while
+            if not line:
+                del self._lines[slot.key]
+            # end if
+        # end with
+        return future
+    # end def
+
+    def pending(self, key: Hashable) -> bool:
+        """ If tasks of that key are still queued or running, so something else for that key would overtake them. """
+        with self._lock:
+            return key in self._pending
+        # end with
+    # end def
+
+    def map_ordered(self, keyed_calls: List[Tuple[Hashable, Callable, tuple]]) -> List[Future]:
+        """ Submits all of the `(key, fn, args)`, and waits until they are done. """
+        futures = [self.submit(key, fn, *args) for key, fn, args in keyed_calls]
+        for future in futures:
+            future.exception()  # waits, without raising.
+        # end for
+        return futures
+    # end def
+
+    def resize(self, partitions: int):
+        """
+        Changes the amount of partitions. Submitting waits until all the queued tasks are done,
+        so tasks of keys moving to another partition can't overtake the ones still queued at the old one.
+        Don't call it from inside a task, that would wait for itself.
+        """
+        if partitions < 1:
+            raise ValueError('needs at least one partition.')
+        # end if
+        with self._lock:
+            for queue in self._queues.values():
+                queue.join()
+            # end for
+            for index in range(len(self._queues), partitions):
+                queue = self._queues[index] = Queue()
+                Thread(target=self._work, args=(queue,), name=f'{self.name}-{index}', daemon=True).start()
+            # end for
+            for index in range(partitions, len(self._queues)):
+                self._queues.pop(index).put(_STOP)
+            # end for
+            self._ring = HashRing(self._queues.keys())
+        # end with
+    # end def
+
+    def _work(self, queue: Queue):
+        while True:
+            task = queue.get()
+            if task is _STOP:
+                queue.task_done()
+                return
+            # end if
+            key, future, fn, args, kwargs = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args, **kwargs))
+                # end if
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._done(key)
+                partitioned_tasks.inc()
+                queue.task_done()
+            # end try
+        # end while
+    # end def
+
+    def _done(self, key: Hashable):
+        with self._lock:
+            self._done_locked(key)
+        # end with
+    # end def
+
+    def _done_locked(self, key: Hashable):
+        if self._pending[key] > 1:
+            self._pending[key] -= 1
+        else:
+            del self._pending[key]
+        # end if
+    # end def
+# end class
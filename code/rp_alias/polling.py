@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Callable, Dict, List, Set, Union
+
+from luckydonaldUtils.logger import logging
+
+from .partition import PartitionedExecutor, chat_of
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# the member updates tell which bot is in which chat, and if it may delete there. Telegram only sends `chat_member` if asked for.
+ALLOWED_UPDATES = ['message', 'inline_query', 'my_chat_member', 'chat_member']
+MAX_BACKOFF = 60.0
+
+polls = counter('poll_requests_total', 'getUpdates requests done by the long poller', ('result',))
+polled_updates = counter('polled_updates_total', 'Updates received by the long poller')
+
+
+class OffsetStore(object):
+    """ The next `getUpdates` offset of every polled bot, persisted in a mongo collection. """
+    def __init__(self, collection):
+        """
+        :param collection: the `pymongo` collection.
+        :type  collection: pymongo.collection.Collection
+        """
+        self.collection = collection
+    # end def
+
+    def load(self, bot_id: int) -> Union[int, None]:
+        document = self.collection.find_one({'bot_id': bot_id})
+        return document['offset'] if document else None
+    # end def
+
+    def save(self, bot_id: int, offset: int):
+        self.collection.update_one({'bot_id': bot_id}, {'$set': {'offset': offset}}, upsert=True)
+    # end def
+# end class
+
+
+class PollState(object):
+    """ Where the long polling of a single bot is at. """
+    __slots__ = ('offset', 'timeout', 'ceiling', 'errors')
+
+    def __init__(self, offset: Union[int, None], timeout: int, ceiling: int):
+        self.offset = offset
+        self.timeout = timeout
+        self.ceiling = ceiling
+        self.errors = 0
+    # end def
+# end class
+
+
+class PollError(Exception):
+    """ The bot api answered with `ok: false`, or something not json at all. """
+    def __init__(self, error_code: int, description: str, retry_after: Union[int, None] = None):
+        super().__init__(f'{error_code}: {description}')
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+    # end def
+# end class
+
+
+class LongPoller(object):
+    """
+    Fetches the updates of many bots with `getUpdates`, all long polls sharing one asyncio event loop
+    and one connection pool, instead of a thread per bot.
+    The updates are handed to `handler` one batch at a time per bot, spread over `workers` partitions by chat:
+    the updates of a chat are handled in order, different chats in parallel.
+    The offset is stored only after a batch was handled, so a restart continues where it left off.
+    A bot removed from the targets is stopped between batches, never in the middle of one.
+
+    Idle bots back off to long polls (up to `max_timeout` seconds), so they cost next to nothing.
+    If a poll breaks after waiting for a while, something in between (NAT, proxies) drops idle connections,
+    so the longest timeout of that bot is halved.
+    """
+    def __init__(
+        self, targets: Callable[[], Dict[int, str]], handler: Callable[[int, dict], None], offsets: OffsetStore,
+        api_url: str, workers: int = 16, min_timeout: int = 1, max_timeout: int = 50, sync_interval: float = 10.0,
+        on_stopped: Union[Callable[[int], None], None] = None,
+    ):
+        """
+        :param targets: returns the bots to poll, as `{bot_id: api_key}`. Checked every `sync_interval` seconds.
+        :param handler: called as `handler(bot_id, update)` for every update, in a worker thread.
+        :param offsets: where the offsets are kept.
+        :param api_url: the bot api url, with the `{api_key}` and `{command}` placeholders.
+        :param workers: threads (partitions) running the handler.
+        :param min_timeout: long poll timeout in seconds right after a bot got updates.
+        :param max_timeout: long poll timeout in seconds of idle bots.
+        :param sync_interval: seconds between checking for added or removed bots.
+        :param on_stopped: called with the bot id after polling a bot stopped, and its last batch is done.
+        """
+        self.targets = targets
+        self.handler = handler
+        self.offsets = offsets
+        self.api_url = api_url
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.sync_interval = sync_interval
+        self.on_stopped = on_stopped
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poll-io')
+        self._partitions = PartitionedExecutor(workers, name='poll-handler')
+        self._rejected: Set[str] = set()  # api keys telegram doesn't know.
+    # end def
+
+    def run(self):
+        """ Blocks, polling forever. """
+        asyncio.run(self._main())
+    # end def
+
+    async def _main(self):
+        import httpx
+
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(10.0)) as client:
+            tasks: Dict[int, asyncio.Task] = {}
+            api_keys: Dict[int, str] = {}
+            while True:
+                wanted = await self._in_thread(self.targets)
+                for bot_id, task in list(tasks.items()):
+                    if wanted.get(bot_id) != api_keys[bot_id] and not task.done():
+                        task.cancel()  # it keeps running until the current batch is done.
+                    # end if
+                    if task.done():
+                        del tasks[bot_id], api_keys[bot_id]
+                    # end if
+                # end for
+                for bot_id, api_key in wanted.items():
+                    if bot_id not in tasks and api_key not in self._rejected:
+                        logger.debug(f'starting to poll bot {bot_id}.')
+                        tasks[bot_id] = asyncio.ensure_future(self._run(client, bot_id, api_key))
+                        api_keys[bot_id] = api_key
+                    # end if
+                # end for
+                await asyncio.sleep(self.sync_interval)
+            # end while
+        # end with
+    # end def
+
+    async def _run(self, client, bot_id: int, api_key: str):
+        try:
+            await self._poll(client, bot_id, api_key)
+        finally:
+            if self.on_stopped:
+                await self._in_thread(self.on_stopped, bot_id)
+            # end if
+        # end try
+    # end def
+
+    async def _poll(self, client, bot_id: int, api_key: str):
+        import httpx
+
+        offset = await self._in_thread(self.offsets.load, bot_id)
+        state = PollState(offset=offset, timeout=self.min_timeout, ceiling=self.max_timeout)
+        webhook_deleted = False
+        while True:
+            started = monotonic()
+            try:
+                if not webhook_deleted:
+                    # telegram refuses getUpdates as long as a webhook is set.
+                    await self._call(client, api_key, 'deleteWebhook')
+                    webhook_deleted = True
+                # end if
+                updates = await self._call(
+                    client, api_key, 'getUpdates', request_timeout=state.timeout + 10,
+                    offset=state.offset, timeout=state.timeout, allowed_updates=ALLOWED_UPDATES,
+                )
+            except PollError as e:
+                polls.inc('error')
+                if e.error_code in (401, 404):
+                    logger.warning(f'stopped polling bot {bot_id}, telegram does not know it: {e}')
+                    self._rejected.add(api_key)
+                    return
+                # end if
+                if e.error_code == 409:
+                    webhook_deleted = False  # someone set a webhook again.
+                # end if
+                await self._backoff(bot_id, state, e.retry_after, e)
+                continue
+            except httpx.HTTPError as e:
+                polls.inc('error')
+                if webhook_deleted and monotonic() - started > min(10, state.timeout):
+                    # it broke while waiting, so long waits don't survive the way to telegram.
+                    state.ceiling = max(self.min_timeout, state.timeout // 2)
+                    state.timeout = min(state.timeout, state.ceiling)
+                # end if
+                await self._backoff(bot_id, state, None, e)
+                continue
+            # end try
+            state.errors = 0
+            if not updates:
+                polls.inc('empty')
+                state.timeout = min(state.timeout * 2, state.ceiling)
+                continue
+            # end if
+            polls.inc('updates')
+            polled_updates.inc(amount=len(updates))
+            state.timeout = self.min_timeout
+            finishing = asyncio.ensure_future(self._finish_batch(bot_id, state, updates))
+            try:
+                await asyncio.shield(finishing)
+            except asyncio.CancelledError:
+                # stopping, but only once the batch is handled and the offset stored, so whoever continues starts after it.
+                await finishing
+                raise
+            # end try
+        # end while
+    # end def
+
+    async def _finish_batch(self, bot_id: int, state: PollState, updates: List[dict]):
+        await self._in_thread(self._handle_batch, bot_id, updates)
+        state.offset = updates[-1]['update_id'] + 1
+        try:
+            await self._in_thread(self.offsets.save, bot_id, state.offset)
+        except Exception:
+            # we still continue with the new offset, only a restart would see the updates again.
+            logger.exception(f'storing the offset of bot {bot_id} failed.')
+        # end try
+    # end def
+
+    async def _call(self, client, api_key: str, command: str, request_timeout: Union[float, None] = None, **query):
+        url = self.api_url.format(api_key=api_key, command=command)
+        data = {key: value for key, value in query.items() if value is not None}
+        kwargs = {} if request_timeout is None else {'timeout': request_timeout}
+        response = await client.post(url, json=data, **kwargs)
+        try:
+            result = response.json()
+        except ValueError:
+            # e.g. the html error page of a proxy in between.
+            raise PollError(response.status_code, f'no json in the answer: {response.text[:100]!r}')
+        # end try
+        if not result.get('ok'):
+            parameters = result.get('parameters') or {}
+            raise PollError(result.get('error_code', response.status_code), result.get('description'), parameters.get('retry_after'))
+        # end if
+        return result['result']
+    # end def
+
+    async def _backoff(self, bot_id: int, state: PollState, retry_after: Union[int, None], error: Exception):
+        state.errors += 1
+        delay = retry_after if retry_after else min(MAX_BACKOFF, 0.5 * 2 ** state.errors)
+        logger.warning(f'polling bot {bot_id} failed ({error!s}), retrying in {delay} seconds.')
+        await asyncio.sleep(delay)
+    # end def
+
+    def _handle_batch(self, bot_id: int, updates: List[dict]):
+        self._partitions.map_ordered([((bot_id, chat_of(update)), self._handle, (bot_id, update)) for update in updates])
+    # end def
+
+    def _handle(self, bot_id: int, update: dict):
+        try:
+            self.handler(bot_id, update)
+        except Exception:
+            logger.exception(f'handling polled update {update.get("update_id")} of bot {bot_id} failed.')
+        # end try
+    # end def
+
+    def _in_thread(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+    # end def
+# end class
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from typing import Union
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# reasons for dropping an update.
+DROP_KIND = 'not_message_or_inline_query'
+DROP_NO_TEXT = 'no_text_or_caption'
+DROP_NO_SENDER = 'no_sender'
+DROP_FOREIGN_USER = 'not_owner_and_no_reply_to_bot'
+DROP_COMMAND_WITHOUT_REPLY = 'command_not_replying_to_bot'
+DROP_NO_PREFIX = 'no_prefix'
+DROP_LEFT_TO_HUB = 'left_to_hub'
+
+COMMANDS = ('/delete', '/edit')
+
+updates_dropped = counter('updates_dropped_total', 'Updates dropped before processing them', ('reason',))
+
+
+def prefilter(update: dict, admin_user_id: int, rp_bot_id: int, prefix: str, hub: bool = False) -> Union[str, None]:
+    """
+    Checks the raw update json, before any `pytgbot` objects are built.
+    It only drops what the full processing would ignore as well.
+
+    :param update: the update, as parsed json.
+    :param admin_user_id: the owner of the RP bot.
+    :param rp_bot_id: the user id of the RP bot, i.e. the number in front of the api key.
+    :param prefix: the prefix a post has to start with.
+    :param hub: if the main bot echoes the posts of the owners in that chat (`HUB_MODE`, and it is known to be in there),
+                except the ones replying to the RP bot itself.
+    :return: why it can be dropped, or `None` if it needs to be processed.
+    """
+    message = update.get('message')
+    if message is None:
+        return None if 'inline_query' in update else DROP_KIND
+    # end if
+    chat = message.get('chat')
+    if chat and chat.get('type') == 'private':
+        return None  # there everything is relevant.
+    # end if
+    sender = message.get('from')
+    if message.get('media_group_id') and sender and sender.get('id') == admin_user_id:
+        # the prefix can be in the caption of another item of the album.
+        return DROP_LEFT_TO_HUB if hub else None
+    # end if
+    text = message.get('text') or message.get('caption')
+    if not text:
+        return DROP_NO_TEXT
+    # end if
+    if not sender:
+        return DROP_NO_SENDER
+    # end if
+    reply = message.get('reply_to_message')
+    replied_to_bot = bool(reply and reply.get('from') and reply['from'].get('id') == rp_bot_id)
+    if sender.get('id') != admin_user_id:
+        # we only notify the owner about replies to the bot.
+        return None if replied_to_bot else DROP_FOREIGN_USER
+    # end if
+    if text.startswith(COMMANDS):
+        return None if replied_to_bot else DROP_COMMAND_WITHOUT_REPLY
+    # end if
+    if text.startswith(prefix):
+        return DROP_LEFT_TO_HUB if hub and not replied_to_bot else None
+    # end if
+    return DROP_NO_PREFIX
+# end def
+
+
+def should_drop(update: dict, admin_user_id: int, rp_bot_id: int, prefix: str, hub: bool = False) -> bool:
+    """ Like :func:`prefilter`, but counting the reason of dropped updates. """
+    reason = prefilter(update, admin_user_id, rp_bot_id, prefix, hub=hub)
+    if reason is None:
+        return False
+    # end if
+    updates_dropped.inc(reason)
+    return True
+# end def
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import re
+from threading import Condition, Lock
+from time import monotonic, sleep
+from typing import Callable, Dict, Tuple, TypeVar, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.exceptions import TgApiServerException
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar('T')
+
+# api methods which count as sending a message.
+LIMITED_PREFIXES = ('send', 'forward', 'copy', 'edit')
+
+rate_limit_waits = counter('rate_limit_waits_total', 'Api calls which had to wait for the rate limit', ('scope',))
+rate_limit_wait_seconds = counter('rate_limit_wait_seconds_total', 'Seconds spent waiting for the rate limit', ('scope',))
+rate_limit_retries = counter('rate_limit_retries_total', 'Api calls repeated after telegram answered 429')
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls per second on average, and bursts of up to `capacity` calls.
+    Calls reserve a token right away and are told how long to wait for it, so nobody has to sleep while holding a lock.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+    # end def
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        # end if
+    # end def
+
+    def reserve(self, now: float) -> float:
+        """ Takes a token, returns the seconds to wait until it may be used. """
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+    # end def
+
+    def available(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1 and self.blocked_until <= now
+    # end def
+
+    def block(self, now: float, seconds: float):
+        """ Telegram told us to wait (429), nothing goes through until then. """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+    # end def
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+    # end def
+# end class
+
+
+class Strand(object):
+    """ A lock handing out its turns in the order they were asked for, so messages to a chat keep their order. """
+    __slots__ = ('bucket', '_condition', '_next_ticket', '_serving')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self._condition = Condition(Lock())
+        self._next_ticket = 0
+        self._serving = 0
+    # end def
+
+    def __enter__(self):
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._condition.wait()
+            # end while
+        # end with
+        return self
+    # end def
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._serving += 1
+            self._condition.notify_all()
+        # end with
+    # end def
+
+    @property
+    def busy(self) -> bool:
+        return self._next_ticket != self._serving
+    # end def
+# end class
+
+
+class RateLimiter(object):
+    """
+    Schedules the sending api calls of all bots, so we stay below telegram's limits instead of getting 429s:
+    a token bucket per bot and chat (about 1 message per second in private chats, 20 per minute in groups),
+    and one per bot (30 per second over all chats).
+
+    Calls to the same chat wait in line, calls to different chats proceed in parallel.
+    A 429 blocks that chat for `retry_after` seconds, and the call is repeated.
+    """
+    def __init__(
+        self, bot_per_second: float = 30.0, private_per_second: float = 1.0, group_per_minute: float = 20.0,
+        group_burst: float = 5.0, max_retries: int = 3, max_chats: int = 4096,
+    ):
+        """
+        :param bot_per_second: sending calls per second of a single bot, over all chats.
+        :param private_per_second: sending calls per second into a single private chat.
+        :param group_per_minute: sending calls per minute into a single group or channel.
+        :param group_burst: how many calls may go into a group at once, before the per minute rate kicks in.
+        :param max_retries: how often a call is repeated after a 429, before the error is raised.
+        :param max_chats: idle chats are forgotten when more are tracked.
+        """
+        self.bot_per_second = bot_per_second
+        self.private_per_second = private_per_second
+        self.group_per_minute = group_per_minute
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._bots: Dict[int, TokenBucket] = {}
+        self._strands: Dict[Tuple[int, Union[int, str]], Strand] = {}
+        self._lock = Lock()
+    # end def
+
+    @staticmethod
+    def is_limited(command: str) -> bool:
+        return command.startswith(LIMITED_PREFIXES)
+    # end def
+
+    def call(self, bot_id: int, chat_id: Union[int, str, None], command: str, function: Callable[[], T]) -> T:
+        """ Does `function()`, the api call `command` of that bot into that chat, as soon as the limits allow. """
+        if chat_id is None or not self.is_limited(command):
+            return function()
+        # end if
+        strand = self._strand(bot_id, chat_id)
+        with strand:
+            for attempt in range(self.max_retries + 1):
+                self._wait(bot_id, strand.bucket)
+                try:
+                    return function()
+                except TgApiServerException as e:
+                    if e.error_code != 429 or attempt == self.max_retries:
+                        raise
+                    # end if
+                    retry_after = retry_after_of(e)
+                    logger.info(f'bot {bot_id} is sending too fast into chat {chat_id}, retrying in {retry_after} seconds.')
+                    rate_limit_retries.inc()
+                    with self._lock:
+                        strand.bucket.block(monotonic(), retry_after)
+                    # end with
+                # end try
+            # end for
+        # end with
+    # end def
+
+    def try_acquire(self, bot_id: int, chat_id: Union[int, str, None], command: str) -> bool:
+        """
+        Takes the tokens for a call done by someone else (a webhook reply), but only if that can happen right now.
+        :return: `False` if the call would have to wait, then better do it through :meth:`call`.
+        """
+        if chat_id is None or not self.is_limited(command):
+            return True
+        # end if
+        strand = self._strand(bot_id, chat_id)
+        now = monotonic()
+        with self._lock:
+            bot_bucket = self._bot_bucket(bot_id)
+            if strand.busy or not strand.bucket.available(now) or not bot_bucket.available(now):
+                return False
+            # end if
+            strand.bucket.reserve(now)
+            bot_bucket.reserve(now)
+        # end with
+        return True
+    # end def
+
+    def _wait(self, bot_id: int, bucket: TokenBucket):
+        now = monotonic()
+        with self._lock:
+            chat_wait = bucket.reserve(now)
+            bot_wait = self._bot_bucket(bot_id).reserve(now)
+        # end with
+        wait = max(chat_wait, bot_wait)
+        if wait > 0:
+            scope = 'chat' if chat_wait >= bot_wait else 'bot'
+            rate_limit_waits.inc(scope)
+            rate_limit_wait_seconds.inc(scope, amount=wait)
+            sleep(wait)
+        # end if
+    # end def
+
+    def _bot_bucket(self, bot_id: int) -> TokenBucket:
+        """ Needs the lock. """
+        bucket = self._bots.get(bot_id)
+        if bucket is None:
+            bucket = self._bots[bot_id] = TokenBucket(rate=self.bot_per_second, capacity=self.bot_per_second)
+        # end if
+        return bucket
+    # end def
+
+    def _strand(self, bot_id: int, chat_id: Union[int, str]) -> Strand:
+        key = (bot_id, chat_id)
+        with self._lock:
+            strand = self._strands.get(key)
+            if strand is None:
+                if len(self._strands) >= self.max_chats:
+                    self._forget_idle()
+                # end if
+                strand = self._strands[key] = Strand(self._chat_bucket(chat_id))
+            # end if
+            return strand
+        # end with
+    # end def
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        if isinstance(chat_id, int) and chat_id > 0:
+            return TokenBucket(rate=self.private_per_second, capacity=1)
+        # end if
+        # groups, channels (negative ids) and @channel usernames.
+        return TokenBucket(rate=self.group_per_minute / 60, capacity=self.group_burst)
+    # end def
+
+    def _forget_idle(self):
+        """ Needs the lock. """
+        now = monotonic()
+        for key, strand in list(self._strands.items()):
+            if not strand.busy and strand.bucket.idle(now):
+                del self._strands[key]
+            # end if
+        # end for
+    # end def
+# end class
+
+
+def retry_after_of(e: TgApiServerException, default: float = 1.0) -> float:
+    """ The seconds telegram wants us to wait, from the `parameters` of the error, or its description. """
+    try:
+        return float(e.response.json()['parameters']['retry_after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        pass
+    # end try
+    match = re.search(r'retry after (\d+)', e.description or '')
+    return float(match.group(1)) if match else default
+# end def
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from threading import Event, Lock, Thread
+from secrets import token_urlsafe
+from time import sleep
+from typing import Callable, Dict, List, Union
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# seconds a lookup waits for the registrations, if they are still being loaded in the background.
+LOAD_WAIT = 10.0
+
+
+class Registration(object):
+    """ A RP bot set up with /add_bot: who owns it, the prefix, and the api key. """
+    __slots__ = ('token', 'bot_id', 'owner_id', 'prefix', 'api_key', 'secret_token', 'created_at', 'updated_at')
+
+    def __init__(
+        self, token: str, bot_id: int, owner_id: int, prefix: str, api_key: str, secret_token: Union[str, None] = None,
+        created_at: Union[datetime, None] = None, updated_at: Union[datetime, None] = None,
+    ):
+        """
+        :param token: opaque, random part of the webhook url.
+        :param bot_id: user id of the RP bot, the number in front of the api key.
+        :param owner_id: user id of the owner.
+        :param secret_token: what telegram sends as `X-Telegram-Bot-Api-Secret-Token` header.
+                             `None` for bots whose webhook was set without one.
+        """
+        self.token = token
+        self.bot_id = bot_id
+        self.owner_id = owner_id
+        self.prefix = prefix
+        self.api_key = api_key
+        self.secret_token = secret_token
+        self.created_at = created_at or datetime.utcnow()
+        self.updated_at = updated_at or self.created_at
+    # end def
+
+    @classmethod
+    def new(cls, owner_id: int, prefix: str, api_key: str, secret_token: Union[str, None] = None) -> 'Registration':
+        return cls(
+            token=new_token(), bot_id=bot_id_from_api_key(api_key), owner_id=owner_id, prefix=prefix, api_key=api_key,
+            secret_token=secret_token,
+        )
+    # end def
+
+    def to_document(self) -> Dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+    # end def
+
+    @classmethod
+    def from_document(cls, document: Dict) -> 'Registration':
+        return cls(**{slot: document.get(slot) for slot in cls.__slots__})
+    # end def
+
+    def __eq__(self, other):
+        return isinstance(other, Registration) and self.to_document() == other.to_document()
+    # end def
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(bot_id={self.bot_id!r}, owner_id={self.owner_id!r}, prefix={self.prefix!r})'
+    # end def
+# end class
+
+
+def new_token() -> str:
+    return token_urlsafe(24)
+# end def
+
+
+def bot_id_from_api_key(api_key: str) -> int:
+    return int(api_key.split(':')[0])
+# end def
+
+
+class RegistrationStore(object):
+    """ The registrations, persisted in a mongo collection. One registration per bot. """
+    def __init__(self, collection):
+        """
+        :param collection: the `pymongo` collection.
+        :type  collection: pymongo.collection.Collection
+        """
+        self.collection = collection
+    # end def
+
+    @classmethod
+    def connect(cls, host: str, user: str, password: str, database: str, collection='rp_bots') -> 'RegistrationStore':
+        from pymongo import MongoClient
+        client = MongoClient(host=host, username=user, password=password, serverSelectionTimeoutMS=5000, connect=False)
+        store = cls(client[database][collection])
+        return store
+    # end def
+
+    def ensure_indexes(self):
+        from pymongo import ASCENDING
+        self.collection.create_index([('token', ASCENDING)], unique=True)
+        self.collection.create_index([('bot_id', ASCENDING)], unique=True)
+    # end def
+
+    def load_all(self) -> List[Registration]:
+        return [Registration.from_document(document) for document in self.collection.find({}, {'_id': False})]
+    # end def
+
+    def save(self, registration: Registration):
+        """ Inserts or replaces the registration of that bot. """
+        registration.updated_at = datetime.utcnow()
+        self.collection.replace_one({'bot_id': registration.bot_id}, registration.to_document(), upsert=True)
+    # end def
+
+    def delete(self, bot_id: int):
+        self.collection.delete_one({'bot_id': bot_id})
+    # end def
+
+    def watch(self, callback: Callable[[], None]):
+        """
+        Blocks, calling `callback()` whenever something in the collection changed.
+        Needs a replica set, raises `pymongo.errors.OperationFailure` otherwise.
+        """
+        with self.collection.watch() as stream:
+            for _ in stream:
+                callback()
+            # end for
+        # end with
+    # end def
+# end class
+
+
+class RegistrationIndex(object):
+    """
+    All registrations in memory, so a webhook request resolves to its bot with a single dict lookup.
+    Loaded from the store on start, and reloaded on changes (change streams, or polling as fallback).
+    Listeners registered with :meth:`on_change` get called with `(old, new)` for every changed registration,
+    either one being `None` for added or removed registrations.
+
+    If loading happens in the background, lookups not finding anything wait until `loaded` is set.
+    """
+    def __init__(self, store: Union[RegistrationStore, None]):
+        self.store = store
+        self._by_token: Dict[str, Registration] = {}
+        self._by_bot_id: Dict[int, Registration] = {}
+        self._listeners: List[Callable[[Union[Registration, None], Union[Registration, None]], None]] = []
+        self._lock = Lock()
+        self.loaded = Event()  # set after the first load, or once that's given up on.
+    # end def
+
+    def get(self, token: str) -> Union[Registration, None]:
+        registration = self._by_token.get(token)
+        if registration is None and not self.loaded.is_set():
+            self.loaded.wait(LOAD_WAIT)
+            registration = self._by_token.get(token)
+        # end if
+        return registration
+    # end def
+
+    def by_bot_id(self, bot_id: int) -> Union[Registration, None]:
+        registration = self._by_bot_id.get(bot_id)
+        if registration is None and not self.loaded.is_set():
+            self.loaded.wait(LOAD_WAIT)
+            registration = self._by_bot_id.get(bot_id)
+        # end if
+        return registration
+    # end def
+
+    def all(self) -> List[Registration]:
+        return list(self._by_bot_id.values())
+    # end def
+
+    def __len__(self):
+        return len(self._by_bot_id)
+    # end def
+
+    def on_change(self, listener: Callable[[Union[Registration, None], Union[Registration, None]], None]):
+        self._listeners.append(listener)
+        return listener
+    # end def
+
+    def load(self):
+        """ (Re)loads everything from the store. """
+        self._replace_all(self.store.load_all())
+    # end def
+
+    def save(self, registration: Registration):
+        """ Persists the registration, and updates the index right away. """
+        self.store.save(registration)
+        with self._lock:
+            old = self._by_bot_id.get(registration.bot_id)
+            self._set(old, registration)
+        # end with
+        self._notify(old, registration)
+    # end def
+
+    def delete(self, bot_id: int):
+        self.store.delete(bot_id)
+        with self._lock:
+            old = self._by_bot_id.get(bot_id)
+            self._set(old, None)
+        # end with
+        self._notify(old, None)
+    # end def
+
+    def start_watching(self, poll_interval: float = 60.0) -> Thread:
+        """ Keeps the index up to date in a background thread. """
+        thread = Thread(target=self._watch, args=(poll_interval,), name='registration-watcher', daemon=True)
+        thread.start()
+        return thread
+    # end def
+
+    def _watch(self, poll_interval: float):
+        from pymongo.errors import OperationFailure
+        try:
+            self.store.watch(self.load)
+        except OperationFailure:
+            logger.info(f'no change streams available (no replica set?), polling every {poll_interval} seconds.')
+        except Exception:
+            logger.exception(f'watching for changes failed, polling every {poll_interval} seconds.')
+        # end try
+        while True:
+            sleep(poll_interval)
+            try:
+                self.load()
+            except Exception:
+                logger.exception('reloading registrations failed.')
+            # end try
+        # end while
+    # end def
+
+    def _replace_all(self, registrations: List[Registration]):
+        changes = []
+        with self._lock:
+            new_by_bot_id = {registration.bot_id: registration for registration in registrations}
+            for bot_id in set(self._by_bot_id) | set(new_by_bot_id):
+                old, new = self._by_bot_id.get(bot_id), new_by_bot_id.get(bot_id)
+                if old != new:
+                    changes.append((old, new))
+                # end if
+            # end for
+            self._by_bot_id = new_by_bot_id
+            self._by_token = {registration.token: registration for registration in registrations}
+        # end with
+        self.loaded.set()
+        for old, new in changes:
+            self._notify(old, new)
+        # end for
+    # end def
+
+    def _set(self, old: Union[Registration, None], new: Union[Registration, None]):
+        """ Needs the lock. """
+        if old:
+            self._by_token.pop(old.token, None)
+            self._by_bot_id.pop(old.bot_id, None)
+        # end if
+        if new:
+            self._by_token[new.token] = new
+            self._by_bot_id[new.bot_id] = new
+        # end if
+    # end def
+
+    def _notify(self, old: Union[Registration, None], new: Union[Registration, None]):
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception:
+                logger.exception('registration change listener failed.')
+            # end try
+        # end for
+    # end def
+# end class
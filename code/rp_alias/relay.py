@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import datetime
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# where the user of an owner's reply was found.
+SOURCE_INDEX = 'index'
+SOURCE_FORWARD = 'forward_from'
+SOURCE_NOTICE = 'notice_entities'
+SOURCE_NONE = 'not_found'
+
+relay_lookups = counter('relay_lookups_total', 'Owner replies in private chats, by where the user was found', ('source',))
+relay_writes_dropped = counter('relay_writes_dropped_total', 'Relay mappings only kept in memory, because the mongo writer was behind')
+
+
+class RelayStore(object):
+    """ Which user a message in the owner's chat with the RP bot came from, persisted in a mongo collection. """
+    def __init__(self, collection):
+        """
+        :param collection: the `pymongo` collection.
+        :type  collection: pymongo.collection.Collection
+        """
+        self.collection = collection
+    # end def
+
+    def ensure_indexes(self, retention: Union[float, None] = None):
+        """ :param retention: seconds after which mappings get deleted by mongo. `None` keeps them. """
+        from pymongo import ASCENDING
+        self.collection.create_index([('bot_id', ASCENDING), ('message_id', ASCENDING)], unique=True)
+        if retention:
+            self.collection.create_index([('created_at', ASCENDING)], expireAfterSeconds=int(retention))
+        # end if
+    # end def
+
+    def put_many(self, mappings: List[Tuple[int, int, int]]):
+        """ :param mappings: `(bot_id, message_id, user_id)` tuples, written with a single round trip. Later ones win. """
+        from pymongo import ReplaceOne
+        now = datetime.utcnow()
+        latest = {(bot_id, message_id): user_id for bot_id, message_id, user_id in mappings}  # unordered writes below.
+        self.collection.bulk_write([
+            ReplaceOne(
+                {'bot_id': bot_id, 'message_id': message_id},
+                {'bot_id': bot_id, 'message_id': message_id, 'user_id': user_id, 'created_at': now},
+                upsert=True,
+            )
+            for (bot_id, message_id), user_id in latest.items()
+        ], ordered=False)
+    # end def
+
+    def get(self, bot_id: int, message_id: int) -> Union[int, None]:
+        document = self.collection.find_one({'bot_id': bot_id, 'message_id': message_id}, {'user_id': True})
+        return document['user_id'] if document else None
+    # end def
+# end class
+
+
+class RelayIndex(object):
+    """
+    Maps `(rp bot, message id in the owner's chat)` to the user a relayed message came from,
+    so the owner's reply can be routed without `forward_from` (hidden by privacy settings) or parsing the notice.
+    The recently used ones are kept in memory, everything is written to the store by a background thread,
+    so the request only updates the memory. If the writer falls behind, mappings only live in memory.
+    """
+    def __init__(self, store: Union[RelayStore, None], size: int = 10000, queue_size: int = 10000, batch_size: int = 100):
+        self.store = store
+        self.size = size
+        self.batch_size = batch_size
+        self._cache: Dict[Tuple[int, int], int] = OrderedDict()
+        self._lock = Lock()
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = None
+    # end def
+
+    def start(self):
+        """ Starts writing to the store. Until then, and without a store, everything only lives in memory. """
+        if self.store and self._thread is None:
+            self._thread = Thread(target=self._write_forever, name='relay-writer', daemon=True)
+            self._thread.start()
+        # end if
+    # end def
+
+    def remember(self, bot_id: int, message_ids: Iterable[int], user_id: int):
+        """ The given messages in the owner's chat (forward, notice) came from that user. """
+        for message_id in message_ids:
+            self._cache_put((bot_id, message_id), user_id)
+            if self._thread is not None:
+                try:
+                    self._queue.put_nowait((bot_id, message_id, user_id))
+                except Full:
+                    relay_writes_dropped.inc()
+                # end try
+            # end if
+        # end for
+    # end def
+
+    def _write_forever(self):
+        while True:
+            mappings = [self._queue.get()]
+            try:
+                while len(mappings) < self.batch_size:
+                    mappings.append(self._queue.get_nowait())
+                # end while
+            except Empty:
+                pass
+            # end try
+            try:
+                self.store.put_many(mappings)
+            except Exception:
+                logger.warning(f'storing {len(mappings)} relay mappings failed, they only live in memory now.', exc_info=True)
+            # end try
+        # end while
+    # end def
+
+    def lookup(self, bot_id: int, message_id: int) -> Union[int, None]:
+        key = (bot_id, message_id)
+        with self._lock:
+            user_id = self._cache.get(key)
+            if user_id is not None:
+                self._cache.move_to_end(key)
+                return user_id
+            # end if
+        # end with
+        if not self.store:
+            return None
+        # end if
+        try:
+            user_id = self.store.get(bot_id, message_id)
+        except Exception:
+            logger.warning('looking up the relay mapping failed.', exc_info=True)
+            return None
+        # end try
+        if user_id is not None:
+            self._cache_put(key, user_id)
+        # end if
+        return user_id
+    # end def
+
+    def _cache_put(self, key: Tuple[int, int], user_id: int):
+        with self._lock:
+            self._cache[key] = user_id
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+            # end while
+        # end with
+    # end def
+
+    def __len__(self):
+        return len(self._cache)
+    # end def
+# end class
@@ -6,6 +6,9 @@ __author__ = 'luckydonald'
 logger = logging.getLogger(__name__)
 
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# DEBUG logs every update, with the whole payload pretty printed (slow), and how it was handled.
+
 API_KEY = os.getenv('TG_API_KEY', None)
 assert(API_KEY is not None)  # TG_API_KEY environment variable
 
@@ -27,3 +30,162 @@ assert MONGO_PASSWORD is not None  # MONGO_PASSWORD environment variable
 MONGO_DB = os.getenv('MONGO_DB', None)
 assert MONGO_DB is not None  # MONGO_DB environment variable
 
+TG_API_URL = os.getenv('TG_API_URL', 'https://api.telegram.org/bot{api_key}/{command}')
+# can be pointed to a local bot api server, needs the {api_key} and {command} placeholders.
+
+BOT_POOL_SIZE = int(os.getenv('BOT_POOL_SIZE', '256'))
+# maximum amount of RP bot clients kept around.
+
+BOT_POOL_IDLE_TIMEOUT = float(os.getenv('BOT_POOL_IDLE_TIMEOUT', '600'))
+# seconds after which an unused RP bot client (and idle connections) get dropped.
+
+BOT_POOL_CONNECTIONS = int(os.getenv('BOT_POOL_CONNECTIONS', '32'))
+# maximum keep-alive connections to the bot api server.
+
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', str(24 * 60 * 60)))
+# seconds a RP bot's getMe (name, username) is cached.
+
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '4096'))
+# maximum RP bot identities kept, the least recently used one is dropped first.
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', None)
+# if set, webhooks only store the update in this folder and answer right away; worker threads process them.
+
+SPOOL_WORKERS = int(os.getenv('SPOOL_WORKERS', '4'))
+# amount of threads processing spooled updates.
+
+SPOOL_FSYNC = os.getenv('SPOOL_FSYNC', 'true').lower() in ('1', 'true', 'yes')
+# if spooled updates should be flushed to the disk before answering the webhook.
+
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', '8'))
+# threads for running independent api calls (echo and deletes) at the same time. 0 runs them one after another.
+
+WEBHOOK_REPLY = os.getenv('WEBHOOK_REPLY', 'true').lower() in ('1', 'true', 'yes')
+# if the main api call of an update (echo, inline answer, …) should be sent as the webhook's response.
+
+REGISTRY_POLL_INTERVAL = float(os.getenv('REGISTRY_POLL_INTERVAL', '60'))
+# seconds between reloading the registered bots, if mongo has no change streams.
+
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'webhook').lower()
+assert UPDATE_MODE in ('webhook', 'polling')  # UPDATE_MODE environment variable
+# 'polling' fetches the updates of all bots with getUpdates instead (run `python poll.py`), e.g. behind NAT.
+
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+# worker processes of the web server. With webhooks only 1 is supported: telegram may deliver the updates of a chat to
+# any of them, so posts could overtake each other, and the state kept in memory (edits, albums, echoed messages,
+# delete rights) would be split. Scaling out is only supported with UPDATE_MODE=polling (and POLL_CLUSTER).
+
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '16'))
+# threads processing the polled updates. The chats are split between them, so the posts of a chat stay in order.
+
+POLL_TIMEOUT_MIN = int(os.getenv('POLL_TIMEOUT_MIN', '1'))
+# long poll timeout in seconds for bots which just got updates.
+
+POLL_TIMEOUT_MAX = int(os.getenv('POLL_TIMEOUT_MAX', '50'))
+# long poll timeout in seconds idle bots grow to.
+
+RATE_LIMIT = os.getenv('RATE_LIMIT', 'true').lower() in ('1', 'true', 'yes')
+# if sending messages should be slowed down to telegram's limits (and repeated after a 429), instead of failing.
+
+RATE_LIMIT_BOT_PER_SECOND = float(os.getenv('RATE_LIMIT_BOT_PER_SECOND', '30'))
+# messages a single bot may send per second, over all chats.
+
+RATE_LIMIT_PRIVATE_PER_SECOND = float(os.getenv('RATE_LIMIT_PRIVATE_PER_SECOND', '1'))
+# messages a bot may send per second into a single private chat.
+
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv('RATE_LIMIT_GROUP_PER_MINUTE', '20'))
+# messages a bot may send per minute into a single group.
+
+RATE_LIMIT_GROUP_BURST = float(os.getenv('RATE_LIMIT_GROUP_BURST', '5'))
+# messages a bot may send into a group at once, before the per minute limit applies.
+
+DELAYED_CALL_WORKERS = int(os.getenv('DELAYED_CALL_WORKERS', '16'))
+# threads doing the rate limited sends (echoes, relays, edits, too fast webhook replies). The chats are split between them, keeping their order.
+
+EDIT_COALESCE_WINDOW = float(os.getenv('EDIT_COALESCE_WINDOW', '1.5'))
+# seconds to wait for more /edit commands of the same post, only the newest one is sent. 0 edits right away.
+
+RELAY_NOTICE = os.getenv('RELAY_NOTICE', 'true').lower() in ('1', 'true', 'yes')
+# if private messages forwarded to the owner get the extra "Sent by user" notice. Replies work without it.
+
+RELAY_CACHE_SIZE = int(os.getenv('RELAY_CACHE_SIZE', '10000'))
+# relayed messages kept in memory to route the owner's replies, all of them are in mongo as well.
+
+RELAY_RETENTION = float(os.getenv('RELAY_RETENTION', str(180 * 24 * 60 * 60)))
+# seconds after which the owner can't reply to a relayed message anymore (unless forward/notice still show the user).
+
+LEGACY_CACHE_SIZE = int(os.getenv('LEGACY_CACHE_SIZE', '4096'))
+# old style webhook urls (`/rp_bot_webhooks/…`) remembered, with what telegram said about their bot.
+
+LEGACY_CHECKS_PER_SECOND = float(os.getenv('LEGACY_CHECKS_PER_SECOND', '1'))
+# unknown old style webhook urls checked with telegram per second at most, the others get a 503 and are retried by telegram.
+
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', None)
+# if set, incoming webhook updates are written (redacted, gzipped) to this folder, for replaying them later.
+
+CAPTURE_SALT = os.getenv('CAPTURE_SALT', None)
+# secret for the pseudonyms in captures. Random if unset, then they only match within one process.
+
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', str(64 * 1024 * 1024)))
+# (uncompressed) size after which a new capture file is started.
+
+CAPTURE_MAX_FILES = int(os.getenv('CAPTURE_MAX_FILES', '24'))
+# capture files kept per process, older ones get deleted.
+
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '10'))
+# seconds telegram may show the owner the same inline results again, without asking us.
+
+INLINE_CACHE_TTL = float(os.getenv('INLINE_CACHE_TTL', '30'))
+# seconds built inline results are kept on our side.
+
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', '4096'))
+# inline queries kept on our side at most.
+
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', '1.0'))
+# seconds to wait for the rest of an album, after its first item arrived. Later posts of that chat wait for it.
+
+POLL_CLUSTER = os.getenv('POLL_CLUSTER', 'false').lower() in ('1', 'true', 'yes')
+# run several polling processes (or machines), the bots get split between them by consistent hashing.
+
+POLL_LEASE = float(os.getenv('POLL_LEASE', '30'))
+# seconds after which the bots of a polling node which stopped responding are taken over by the others.
+
+NODE_ID = os.getenv('NODE_ID', None)
+# unique name of this polling node. Hostname and process id if unset.
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', '512'))
+# threads running the update handlers in the asgi app (`uvicorn asgi:app`). Waiting for the bot api costs them next to nothing.
+
+ASGI_CONNECTIONS = int(os.getenv('ASGI_CONNECTIONS', '256'))
+# maximum connections to the bot api server in the asgi app, shared by all bots.
+
+FAST_START = os.getenv('FAST_START', 'false').lower() in ('1', 'true', 'yes')
+# start serving right away: asking telegram who our bot is, setting its webhook and setting up mongo happen later or in the background.
+
+FLEET_ADMINS = [int(user_id) for user_id in os.getenv('FLEET_ADMINS', '').split(',') if user_id.strip()]
+# user ids allowed to use /fleet_webhooks and /fleet_status, comma separated.
+
+FLEET_CONCURRENCY = int(os.getenv('FLEET_CONCURRENCY', '8'))
+# RP bots handled at the same time, when something is done for all of them (e.g. setting their webhooks).
+
+FLEET_PER_SECOND = float(os.getenv('FLEET_PER_SECOND', '20'))
+# api calls per second at most, over all RP bots, when something is done for all of them.
+
+HUB_MODE = os.getenv('HUB_MODE', 'false').lower() in ('1', 'true', 'yes')
+# our bot echoes the prefixed posts of the owners for their RP bots, so it has to be in the groups with privacy mode disabled.
+# The RP bots can keep privacy mode enabled then, and a group with 15 of them doesn't send us every message 15 times.
+
+DELETE_REPROBE = float(os.getenv('DELETE_REPROBE', '3600'))
+# seconds until a bot which couldn't delete messages in a chat is tried again there, maybe it got admin rights meanwhile.
+
+SENT_STORE_PER_CHAT = int(os.getenv('SENT_STORE_PER_CHAT', '256'))
+# echoed messages per chat kept in memory, so /edit keeps their fake reply.
+
+SENT_STORE_CHATS = int(os.getenv('SENT_STORE_CHATS', '4096'))
+# chats to keep the echoed messages of in memory, the ones quiet the longest are dropped (or spilled to disk).
+
+SENT_STORE_SPILL = os.getenv('SENT_STORE_SPILL', None)
+# sqlite file for the echoed messages which don't fit in memory anymore. Unset to just forget them.
+
+SENT_STORE_SPILL_MAX = int(os.getenv('SENT_STORE_SPILL_MAX', '1000000'))
+# echoed messages kept in that file at most.
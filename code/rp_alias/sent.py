@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Union
+
+from luckydonaldUtils.logger import logging
+
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+# what was sent, named like the media: `text`, `photo`, `sticker`, `video`, …
+KIND_TEXT = 'text'
+CAPTION_KINDS = frozenset(('photo', 'animation', 'video', 'voice', 'document', 'audio'))  # editable with editMessageCaption.
+
+# where a lookup was answered from.
+LOOKUP_MEMORY = 'memory'
+LOOKUP_SPILL = 'spill'
+LOOKUP_MISS = 'miss'
+
+sent_lookups = counter('sent_messages_lookups_total', 'Lookups of echoed messages (for /edit), by where they were found', ('result',))
+
+
+def kind_of_method(method: str) -> str:
+    """ The kind of message a pytgbot send method (e.g. `send_photo`) sends. """
+    return KIND_TEXT if method == 'send_message' else method[len('send_'):]
+# end def
+
+
+class SentMessage(object):
+    """ A message we echoed: the fake reply header and the body (both html) separately, so an edit can keep the header. """
+    __slots__ = ('message_id', 'header', 'body', 'kind')
+
+    def __init__(self, message_id: int, header: str, body: str, kind: str):
+        self.message_id = message_id
+        self.header = header
+        self.body = body
+        self.kind = kind
+    # end def
+
+    @property
+    def html(self) -> str:
+        return self.header + self.body
+    # end def
+# end class
+
+
+class ChatRing(object):
+    """ The last `size` messages sent to a chat, oldest overwritten first. Only grows as far as needed. """
+    __slots__ = ('size', 'records', 'positions', 'next')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.records: List[SentMessage] = []
+        self.positions: Dict[int, int] = {}  # message id -> index in `records`
+        self.next = 0  # once full, the index to overwrite next.
+    # end def
+
+    def add(self, record: SentMessage) -> Union[SentMessage, None]:
+        """ Returns the record which had to make room. """
+        position = self.positions.get(record.message_id)
+        evicted = None
+        if position is None and len(self.records) < self.size:
+            position = len(self.records)
+            self.records.append(record)
+        else:
+            if position is None:
+                position = self.next
+                self.next = (self.next + 1) % self.size
+                evicted = self.records[position]
+                del self.positions[evicted.message_id]
+            # end if
+            self.records[position] = record
+        # end if
+        self.positions[record.message_id] = position
+        return evicted
+    # end def
+
+    def get(self, message_id: int) -> Union[SentMessage, None]:
+        position = self.positions.get(message_id)
+        return None if position is None else self.records[position]
+    # end def
+
+    def __iter__(self):
+        return iter(self.records)
+    # end def
+# end class
+
+
+class SentStore(object):
+    """
+    The messages we echoed, so `/edit` can rebuild them with a single lookup.
+    Per chat a :class:`ChatRing` of `per_chat` messages, and rings of at most `chats` chats, least recently used ones dropped.
+    With `spill_path`, what gets dropped goes to a sqlite file instead, keeping the newest `spill_max` messages.
+
+    Echoes sent as webhook reply aren't in here, we never learn their message id.
+    """
+    def __init__(self, per_chat: int = 256, chats: int = 4096, spill_path: Union[str, None] = None, spill_max: int = 1000000):
+        self.per_chat = per_chat
+        self.chats = chats
+        self.spill_max = spill_max
+        self._rings = OrderedDict()  # chat id -> ChatRing, least recently used first.
+        self._lock = Lock()
+        self._spill: Union[sqlite3.Connection, None] = None
+        self._spilled = 0
+        if spill_path:
+            self._spill = sqlite3.connect(spill_path, check_same_thread=False, isolation_level=None)
+            self._spill.execute('PRAGMA journal_mode=WAL')
+            self._spill.execute(
+                'CREATE TABLE IF NOT EXISTS sent (chat_id INTEGER, message_id INTEGER, record TEXT, PRIMARY KEY (chat_id, message_id))'
+            )
+        # end if
+    # end def
+
+    def add(self, chat_id: int, record: SentMessage):
+        with self._lock:
+            ring = self._rings.get(chat_id)
+            if ring is None:
+                ring = self._rings[chat_id] = ChatRing(self.per_chat)
+            # end if
+            self._rings.move_to_end(chat_id)
+            evicted = ring.add(record)
+            if evicted:
+                self._spill_records(chat_id, [evicted])
+            # end if
+            while len(self._rings) > self.chats:
+                old_chat_id, old_ring = self._rings.popitem(last=False)
+                self._spill_records(old_chat_id, list(old_ring))
+            # end while
+        # end with
+    # end def
+
+    def get(self, chat_id: int, message_id: int) -> Union[SentMessage, None]:
+        with self._lock:
+            ring = self._rings.get(chat_id)
+            record = ring.get(message_id) if ring else None
+        # end with
+        if record is not None:
+            sent_lookups.inc(LOOKUP_MEMORY)
+            return record
+        # end if
+        record = self._unspill(chat_id, message_id)
+        if record is None:
+            sent_lookups.inc(LOOKUP_MISS)
+            return None
+        # end if
+        sent_lookups.inc(LOOKUP_SPILL)
+        self.add(chat_id, record)  # edited once, likely edited again.
+        return record
+    # end def
+
+    def _spill_records(self, chat_id: int, records: List[SentMessage]):
+        """ Needs the lock. """
+        if not self._spill or not records:
+            return
+        # end if
+        try:
+            self._spill.executemany(
+                'INSERT OR REPLACE INTO sent (chat_id, message_id, record) VALUES (?, ?, ?)',
+                [(chat_id, r.message_id, json.dumps([r.header, r.body, r.kind])) for r in records],
+            )
+            self._spilled += len(records)
+            if self._spilled >= max(1, self.spill_max // 10):
+                # every now and then, instead of on every write.
+                self._spilled = 0
+                self._spill.execute('DELETE FROM sent WHERE rowid <= (SELECT MAX(rowid) FROM sent) - ?', (self.spill_max,))
+            # end if
+        except sqlite3.Error:
+            logger.warning('spilling sent messages to disk failed.', exc_info=True)
+        # end try
+    # end def
+
+    def _unspill(self, chat_id: int, message_id: int) -> Union[SentMessage, None]:
+        if not self._spill:
+            return None
+        # end if
+        try:
+            with self._lock:
+                row = self._spill.execute(
+                    'SELECT record FROM sent WHERE chat_id = ? AND message_id = ?', (chat_id, message_id),
+                ).fetchone()
+            # end with
+        except sqlite3.Error:
+            logger.warning('reading spilled sent messages failed.', exc_info=True)
+            return None
+        # end try
+        if row is None:
+            return None
+        # end if
+        header, body, kind = json.loads(row[0])
+        return SentMessage(message_id, header, body, kind)
+    # end def
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(ring.positions) for ring in self._rings.values())
+        # end with
+    # end def
+# end class
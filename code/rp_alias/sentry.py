@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+
 from luckydonaldUtils.logger import logging
-from raven.contrib.flask import Sentry
 
 
 __author__ = 'luckydonald'
@@ -8,6 +9,12 @@ logger = logging.getLogger(__name__)
 
 
 def add_error_reporting(app):
+    if not os.getenv('SENTRY_DSN') and not app.config.get('SENTRY_DSN'):
+        # raven wouldn't report anything anyway, so don't spend the startup time importing it.
+        logger.debug('no SENTRY_DSN set, not reporting errors.')
+        return None
+    # end if
+    from raven.contrib.flask import Sentry
     sentry = Sentry(app)  # set SENTRY_DSN env!
     app.add_url_rule('/sentry', 'is_sentry', is_sentry(sentry))
     return sentry
@@ -18,4 +25,4 @@ def is_sentry(sentry):
     def view():
         return "{}".format(sentry)
     # end if
-# end if
\ No newline at end of file
+# end if
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import os
+from threading import Lock
+from typing import Callable, Dict, Hashable, Set, Union
+
+from luckydonaldUtils.logger import logging
+
+from .partition import PartitionedExecutor
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+JOURNAL_FILE = 'journal.jsonl'
+ACKS_FILE = 'acks.log'
+LOCK_FILE = 'lock'
+
+
+class UpdateSpool(object):
+    """
+    Append-only on-disk journal of incoming updates, drained by a pool of worker threads.
+    Updates with the same `partition_key` (e.g. of the same chat) are handled one after another, in order.
+
+    Every update is written (and optionally fsync'ed) to the journal before the webhook answers,
+    and its sequence number is appended to the ack log only after the handler is done with it.
+    On start everything in the journal without an ack is queued again, so updates are handled at least once,
+    even if the process died in between.
+
+    Every process claims its own numbered slot folder below `path` (guarded by a file lock),
+    so multiple server workers never share a journal, and a restarted worker picks up the slot left behind.
+    """
+    def __init__(
+        self, path: str, handler: Callable[[Dict, Dict], None], workers: int = 4, fsync: bool = True,
+        compact_bytes: int = 4 * 1024 * 1024, partition_key: Union[Callable[[Dict, Dict], Hashable], None] = None,
+    ):
+        """
+        :param path: folder to keep the journals in.
+        :param handler: called as `handler(route, update)` for every spooled update.
+        :param workers: amount of threads draining the spool.
+        :param fsync: if every append should hit the disk before we acknowledge the webhook.
+        :param compact_bytes: start new journal files once everything is handled and they are bigger than this.
+        :param partition_key: called as `partition_key(route, update)`, updates with the same key keep their order.
+            Without, updates are spread over the workers in no particular order.
+        """
+        self.path = path
+        self.handler = handler
+        self.workers = workers
+        self.fsync = fsync
+        self.compact_bytes = compact_bytes
+        self.partition_key = partition_key
+        self.slot_path: Union[str, None] = None
+        self._partitions: Union[PartitionedExecutor, None] = None
+        self._lock = Lock()
+        self._next_seq = 0
+        self._pending: Set[int] = set()  # queued or in the works, but not acknowledged yet.
+        self._journal = None
+        self._acks = None
+        self._slot_lock = None
+    # end def
+
+    @property
+    def depth(self) -> int:
+        """ How many updates are waiting or being processed right now. """
+        return len(self._pending)
+    # end def
+
+    def start(self):
+        self._claim_slot()
+        self._partitions = PartitionedExecutor(self.workers, name='spool-worker')
+        self._recover()
+        logger.info(f'update spool at {self.slot_path!r} started with {self.workers} workers and {self.depth} recovered updates.')
+    # end def
+
+    def append(self, route: Dict, update: Dict) -> int:
+        """ Durably stores the update, and queues it. Returns the sequence number. """
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._journal.write(json.dumps({'seq': seq, 'route': route, 'update': update}, separators=(',', ':')) + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            # end if
+            self._pending.add(seq)
+            self._queue(seq, route, update)  # still locked, so the partitions get them in journal order.
+        # end with
+        return seq
+    # end def
+
+    def _ack(self, seq: int):
+        with self._lock:
+            self._acks.write(f'{seq}\n')
+            self._acks.flush()
+            self._pending.discard(seq)
+            if not self._pending and self._journal.tell() > self.compact_bytes:
+                self._compact()
+            # end if
+        # end with
+    # end def
+
+    def _queue(self, seq: int, route: Dict, update: Dict):
+        key = self.partition_key(route, update) if self.partition_key else seq
+        self._partitions.submit(key, self._work, seq, route, update)
+    # end def
+
+    def _work(self, seq: int, route: Dict, update: Dict):
+        try:
+            self.handler(route, update)
+        except Exception:
+            # we don't retry, a broken update would block us forever.
+            logger.exception(f'handling spooled update {seq} failed.')
+        finally:
+            self._ack(seq)
+        # end try
+    # end def
+
+    def _claim_slot(self):
+        slot = 0
+        while True:
+            slot_path = os.path.join(self.path, str(slot))
+            os.makedirs(slot_path, exist_ok=True)
+            lock_file = open(os.path.join(slot_path, LOCK_FILE), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                slot += 1
+                continue
+            # end try
+            self._slot_lock = lock_file
+            self.slot_path = slot_path
+            return
+        # end while
+    # end def
+
+    def _recover(self):
+        journal_path = os.path.join(self.slot_path, JOURNAL_FILE)
+        acks_path = os.path.join(self.slot_path, ACKS_FILE)
+        acked = set()
+        if os.path.exists(acks_path):
+            with open(acks_path, 'r') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        acked.add(int(line))
+                    # end if
+                # end for
+            # end with
+        # end if
+        self._next_seq = max(acked) + 1 if acked else 0  # never reuse a number which might still be in the acks.
+        unacked = []
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        logger.warning('dropping partially written last journal entry.')
+                        break
+                    # end if
+                    record = json.loads(line)
+                    self._next_seq = max(self._next_seq, record['seq'] + 1)
+                    if record['seq'] not in acked:
+                        unacked.append(record)
+                    # end if
+                # end for
+            # end with
+        # end if
+
+        # only keep the leftovers, and swap the files atomically, so a crash right now doesn't lose them.
+        tmp_path = journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in unacked:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            # end for
+            f.flush()
+            os.fsync(f.fileno())
+        # end with
+        os.replace(tmp_path, journal_path)
+        with self._lock:
+            self._open_files()
+            self._acks.truncate(0)
+            for record in unacked:
+                self._pending.add(record['seq'])
+                self._queue(record['seq'], record['route'], record['update'])
+            # end for
+        # end with
+    # end def
+
+    def _compact(self):
+        """ Everything is acknowledged, so we can start over with empty files. Needs the lock. """
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        self._acks.truncate(0)
+        self._acks.seek(0)
+    # end def
+
+    def _open_files(self):
+        self._journal = open(os.path.join(self.slot_path, JOURNAL_FILE), 'a', encoding='utf-8')
+        self._acks = open(os.path.join(self.slot_path, ACKS_FILE), 'a')
+    # end def
+# end class
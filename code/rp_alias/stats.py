@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+class Counter(object):
+    """
+    A number only going up, optionally split by label values.
+    Cheap enough for the hot path: a lock and a dict lookup, no string formatting.
+    """
+    __slots__ = ('name', 'documentation', 'label_names', '_values', '_lock')
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[Tuple, float] = {}
+        self._lock = Lock()
+    # end def
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+        # end with
+    # end def
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+    # end def
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+        # end with
+    # end def
+# end class
+
+
+# seconds, from a cache hit up to a slow api call.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Counts observed values (e.g. durations) into buckets, optionally split by label values.
+    Like :class:`Counter`, observing is a lock, a bisect and a few list operations.
+    """
+    __slots__ = ('name', 'documentation', 'label_names', 'buckets', '_values', '_lock')
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, List] = {}  # label values -> [count per bucket (last one is +Inf), sum]
+        self._lock = Lock()
+    # end def
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            # end if
+            values[0][index] += 1
+            values[1] += value
+        # end with
+    # end def
+
+    def time(self, *label_values) -> 'Stopwatch':
+        return Stopwatch(self, label_values)
+    # end def
+
+    def items(self):
+        """ :return: list of (label values, (counts per bucket, sum)), the counts not yet cumulative. """
+        with self._lock:
+            return [(label_values, (list(counts), total)) for label_values, (counts, total) in self._values.items()]
+        # end with
+    # end def
+# end class
+
+
+class Stopwatch(object):
+    """
+    Measures from creation until :meth:`finish`, into a :class:`Histogram`.
+    The label values can still be changed before finishing, e.g. once it's known which way an update went.
+    """
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram: Histogram, label_values: Tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = perf_counter()
+    # end def
+
+    def label(self, *label_values):
+        self.label_values = label_values
+    # end def
+
+    def finish(self) -> float:
+        duration = perf_counter() - self.started
+        self.histogram.observe(duration, *self.label_values)
+        return duration
+    # end def
+# end class
+
+
+class Gauge(object):
+    """ A current value, e.g. a size, asked for only when the metrics are collected. """
+    __slots__ = ('name', 'documentation', 'label_names', 'function')
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = ()
+        self.function = function
+    # end def
+
+    def items(self):
+        return [((), self.function())]
+    # end def
+# end class
+
+
+REGISTRY: Dict[str, Union[Counter, Histogram, Gauge]] = OrderedDict()
+_registry_lock = Lock()
+
+
+def counter(name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+    """ Returns the counter with that name, registering it first if needed. """
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Counter(name, documentation, label_names)
+        # end if
+        return REGISTRY[name]
+    # end with
+# end def
+
+
+def histogram(name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    """ Returns the histogram with that name, registering it first if needed. """
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Histogram(name, documentation, label_names, buckets)
+        # end if
+        return REGISTRY[name]
+    # end with
+# end def
+
+
+def gauge(name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+    """ Registers (or replaces) the gauge with that name. """
+    with _registry_lock:
+        REGISTRY[name] = Gauge(name, documentation, function)
+        return REGISTRY[name]
+    # end with
+# end def
+
+
+def _labels(label_names: Tuple[str, ...], label_values: Tuple, extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    # end if
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+# end def
+
+
+def render() -> str:
+    """ Everything registered, in the prometheus text format. All the formatting happens here, not when counting. """
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    # end with
+    lines = []
+    for metric in metrics:
+        kind = 'counter' if isinstance(metric, Counter) else 'histogram' if isinstance(metric, Histogram) else 'gauge'
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {kind}')
+        if isinstance(metric, Histogram):
+            for label_values, (counts, total) in metric.items():
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = 'le="{}"'.format('+Inf' if bound == float('inf') else repr(bound))
+                    lines.append(f'{metric.name}_bucket{_labels(metric.label_names, label_values, le)} {cumulative}')
+                # end for
+                lines.append(f'{metric.name}_sum{_labels(metric.label_names, label_values)} {total!r}')
+                lines.append(f'{metric.name}_count{_labels(metric.label_names, label_values)} {cumulative}')
+            # end for
+            continue
+        # end if
+        try:
+            items = metric.items()
+        except Exception:
+            logger.warning(f'collecting {metric.name} failed.', exc_info=True)
+            continue
+        # end try
+        for label_values, value in items:
+            lines.append(f'{metric.name}{_labels(metric.label_names, label_values)} {value!r}')
+        # end for
+    # end for
+    return '\n'.join(lines) + '\n'
+# end def
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from flask import Blueprint
+from teleflask import TBlueprint
+
+__author__ = 'luckydonald'
+
+
+# the same as `luckydonaldUtils.tg_bots.gitinfo`'s, but that imports `teleflask.messages`,
+# which pulls in libmagic and setuptools: a good part of the startup time. Now that happens on the first use.
+version_bp = Blueprint('version', __name__)
+version_tbp = TBlueprint(__name__)
+
+
+@version_bp.route('/version/')
+def route_version():
+    from luckydonaldUtils.tg_bots.gitinfo import route_version
+    return route_version()
+# end def
+
+
+@version_tbp.command('version')
+def cmd_version(update, text):
+    from luckydonaldUtils.tg_bots.gitinfo import cmd_version
+    return cmd_version(update, text)
+# end def
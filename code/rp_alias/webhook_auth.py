@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import hmac
+import re
+from collections import OrderedDict
+from secrets import token_urlsafe
+from threading import Lock
+from time import monotonic
+from typing import Hashable, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot import Bot
+
+from .polling import ALLOWED_UPDATES
+from .ratelimit import TokenBucket
+from .stats import counter
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+API_KEY_REGEX = re.compile(r'\A\d+:[A-Za-z0-9_-]{30,}\Z')
+MAX_UPDATE_BYTES = 1024 * 1024  # way more than any real update.
+
+# reasons for rejecting a webhook request.
+REJECT_UNKNOWN_BOT = 'unknown_bot'
+REJECT_INVALID_API_KEY = 'invalid_api_key'
+REJECT_MISSING_SECRET = 'missing_secret_token'
+REJECT_WRONG_SECRET = 'wrong_secret_token'
+REJECT_TOO_LARGE = 'too_large'
+REJECT_CHECK_LIMITED = 'check_limited'      # too many unknown old style urls at once, telegram retries later.
+REJECT_API_UNAVAILABLE = 'api_unavailable'  # couldn't ask telegram, it retries later.
+
+STATUS_CODES = {
+    REJECT_UNKNOWN_BOT: 404,
+    REJECT_INVALID_API_KEY: 404,
+    REJECT_MISSING_SECRET: 401,
+    REJECT_WRONG_SECRET: 403,
+    REJECT_TOO_LARGE: 413,
+    REJECT_CHECK_LIMITED: 503,
+    REJECT_API_UNAVAILABLE: 503,
+}
+
+# what the lookup of an old style url found.
+LEGACY_CACHED = 'cached'
+LEGACY_CHECKED = 'checked'
+LEGACY_LIMITED = 'limited'
+
+webhooks_rejected = counter('webhook_rejected_total', 'Webhook requests rejected before reading the update', ('reason',))
+legacy_lookups = counter('legacy_webhook_lookups_total', 'Lookups of unknown old style webhook urls, by how they were answered', ('result',))
+
+
+def new_secret_token() -> str:
+    """ Telegram allows 1-256 characters of `A-Z`, `a-z`, `0-9`, `_` and `-`. """
+    return token_urlsafe(32)
+# end def
+
+
+def check_request(expected_secret_token: Union[str, None], headers, content_length: Union[int, None]) -> Union[str, None]:
+    """
+    Checks the headers of a webhook request, so we don't even have to read the body of forged ones.
+
+    :param expected_secret_token: what we registered with `setWebhook`. Bots registered without one (`None`) aren't checked.
+    :param headers: the request headers.
+    :param content_length: the request's content length.
+    :return: why it should be rejected, or `None` if it is fine.
+    """
+    if content_length is not None and content_length > MAX_UPDATE_BYTES:
+        return REJECT_TOO_LARGE
+    # end if
+    if expected_secret_token is None:
+        return None
+    # end if
+    given = headers.get(SECRET_TOKEN_HEADER)
+    if not given:
+        return REJECT_MISSING_SECRET
+    # end if
+    if not hmac.compare_digest(given.encode(), expected_secret_token.encode()):
+        return REJECT_WRONG_SECRET
+    # end if
+    return None
+# end def
+
+
+def reject(reason: str):
+    """ Counts the rejection, and returns the flask response for it. """
+    webhooks_rejected.inc(reason)
+    return reason, STATUS_CODES[reason]
+# end def
+
+
+def set_webhook(rp_bot: Bot, url: str, secret_token: Union[str, None]):
+    """
+    Like `rp_bot.set_webhook(url)`, but registering the `secret_token` telegram sends with every update,
+    and asking for the same updates as the poller (:data:`ALLOWED_UPDATES`).
+    Our pytgbot version predates that parameter, so the method is called directly.
+    """
+    return rp_bot.do('setWebhook', url=url, secret_token=secret_token, allowed_updates=ALLOWED_UPDATES)
+# end def
+
+
+class LegacyKeyCache(object):
+    """
+    What telegram said about the bots of old style webhook urls, for `ttl` seconds, or `negative_ttl` for unknown ones.
+    At most `size` of them, least recently used dropped first.
+    New ones may only be checked `checks_per_second` times, so forged urls can't have us call telegram at will.
+    """
+    MISSING = object()
+
+    def __init__(self, ttl: float = 24 * 60 * 60, negative_ttl: float = 10 * 60, size: int = 4096, checks_per_second: float = 1.0, burst: float = 10.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self._bucket = TokenBucket(rate=checks_per_second, capacity=burst)
+        self._entries = OrderedDict()  # key -> (value, valid until), least recently used first.
+        self._lock = Lock()
+    # end def
+
+    def get(self, key: Hashable):
+        """ The cached value, or :attr:`MISSING`. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return self.MISSING
+            # end if
+            if entry[1] < monotonic():
+                del self._entries[key]
+                return self.MISSING
+            # end if
+            self._entries.move_to_end(key)
+        # end with
+        legacy_lookups.inc(LEGACY_CACHED)
+        return entry[0]
+    # end def
+
+    def put(self, key: Hashable, value):
+        """ `None` means telegram doesn't know that bot, those are kept for `negative_ttl`. """
+        with self._lock:
+            self._entries[key] = (value, monotonic() + (self.ttl if value is not None else self.negative_ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            # end while
+        # end with
+    # end def
+
+    def may_check(self) -> bool:
+        """ Takes one of the checks with telegram, if there's one left. """
+        with self._lock:
+            now = monotonic()
+            if not self._bucket.available(now):
+                legacy_lookups.inc(LEGACY_LIMITED)
+                return False
+            # end if
+            self._bucket.reserve(now)
+        # end with
+        legacy_lookups.inc(LEGACY_CHECKED)
+        return True
+    # end def
+
+    def __len__(self):
+        return len(self._entries)
+    # end def
+# end class
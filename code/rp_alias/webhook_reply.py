@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import re
+
+from flask import jsonify
+from luckydonaldUtils.logger import logging
+from pytgbot import Bot
+from pytgbot.api_types import as_array
+
+__author__ = 'luckydonald'
+logger = logging.getLogger(__name__)
+
+
+class WebhookReply(object):
+    """
+    A single bot api call, which can be answered as the response of the webhook request,
+    saving us the round trip of doing that request ourself.
+    Telegram doesn't tell us the result of those, so only use it for calls where we don't need that.
+
+    If the update didn't come from a webhook request (e.g. from the spool), use :meth:`execute` to do it the usual way.
+    """
+    __slots__ = ('rp_bot', 'method', 'params')
+
+    def __init__(self, rp_bot: Bot, method: str, **params):
+        """
+        :param rp_bot: the bot which would do the call.
+        :param method: the pytgbot method name, e.g. `send_message`.
+        :param params: the pytgbot method's parameters.
+        """
+        self.rp_bot = rp_bot
+        self.method = method
+        self.params = params
+    # end def
+
+    @property
+    def api_method(self) -> str:
+        """ The bot api name of the method, e.g. `sendMessage`. """
+        return re.sub(r'_([a-z])', lambda m: m.group(1).upper(), self.method)
+    # end def
+
+    def to_array(self) -> dict:
+        array = {'method': self.api_method}
+        for key, value in self.params.items():
+            if value is not None:
+                array[key] = as_array(value)
+            # end if
+        # end for
+        return array
+    # end def
+
+    def to_response(self):
+        """ The flask response to the webhook request. """
+        return jsonify(self.to_array())
+    # end def
+
+    def execute(self):
+        """ Do the call ourself. """
+        return getattr(self.rp_bot, self.method)(**self.params)
+    # end def
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(method={self.method!r}, params={self.params!r})'
+    # end def
+# end class
@@ -7,4 +7,7 @@ requirements = [
     "raven[flask]",
     "emoji",
     "pymongo",
+    "requests",
+    "httpx",
+    "uvicorn",
 ]